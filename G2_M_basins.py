@@ -0,0 +1,106 @@
+"""Basins of attraction of the MPF switch over initial conditions.
+
+Whether a cell enters mitosis depends on where it starts: X4_0/X5_0
+(preMPF/MPF) and X10_0 (sequestered Cdc25) differ by orders of magnitude
+between the variants (1e-6 against 1e-2).  basin_map() integrates a grid or
+a sample of initial states in column batches with
+G2_M_network.batch_step and retires every run as soon as it has committed:
+
+  MITOSIS   the MPF observable reached the activation threshold
+  ARREST    MPF stays below arrest_level and the state has stopped moving
+            (change per unit time below tol relative to |y| + atol for
+            `patience` consecutive steps)
+  UNDECIDED neither by t_end
+
+Outcomes are stored as an int8 array over the grid together with the
+commitment time, so a million-point map costs a few megabytes.
+
+    result = basin_map(net, {'X4_0': np.logspace(-6, -1, 50),
+                             'X10_0': np.logspace(-6, -1, 50)}, damage=0.005)
+    result['outcome']          # (50, 50) of ARREST / MITOSIS / UNDECIDED
+"""
+from __future__ import division, print_function
+
+import numpy as np
+
+import G2_M_ssa
+from G2_M_network import batch_step
+
+UNDECIDED, ARREST, MITOSIS = -1, 0, 1
+
+
+def _basin_chunk(args):
+    p, row, threshold, arrest_level, t_end, dt, tol, atol, patience = args
+    network = G2_M_ssa.worker_network()
+    n = p.shape[1]
+    outcome = np.full(n, UNDECIDED, dtype=np.int8)
+    when = np.full(n, np.nan, dtype=np.float32)
+    still = np.zeros(n, dtype=int)
+    y = network.initial_state(p)
+    live = np.arange(n)
+    t = 0.0
+    while len(live) and t < t_end:
+        new = batch_step(network, y, p[:, live], dt)
+        t += dt
+        mpf = row.dot(new)
+        change = np.max(np.abs(new - y) / (dt * (np.abs(new) + atol)), axis=0)
+        still[live] = np.where(change < tol, still[live] + 1, 0)
+        active = mpf >= threshold
+        settled = ~active & (still[live] >= patience) & (mpf < arrest_level)
+        outcome[live[active]] = MITOSIS
+        outcome[live[settled]] = ARREST
+        done = active | settled
+        when[live[done]] = t
+        keep = ~done
+        live, y = live[keep], new[:, keep]
+    return outcome, when
+
+
+def basin_map(network, axes, p=None, damage=None, t_end=4000.0, dt=1.0,
+              threshold=0.1, arrest_level=None, tol=1e-4, atol=1e-6, patience=100,
+              observable='OBS_MPF', chunk_size=2048, processes=None):
+    """Outcome of every initial state on a grid (dict of axes) or a sample.
+
+    axes  -- {initial-condition parameter: values} for a full grid, or
+             (names, array of shape (n, len(names))) for scattered samples
+    p     -- base parameter vector (defaults, with DDS_0 = damage if given)
+
+    Returns {'names', 'outcome' (int8), 'time' (float32, commitment time)}
+    shaped like the grid, or (n,) for samples."""
+    if isinstance(axes, dict):
+        names = sorted(axes)
+        grids = np.meshgrid(*[np.asarray(axes[k], dtype=float) for k in names], indexing='ij')
+        shape = grids[0].shape
+        points = np.column_stack([g.ravel() for g in grids])
+    else:
+        names, points = axes
+        points = np.asarray(points, dtype=float)
+        shape = (len(points),)
+    values = {} if damage is None else {'DDS_0': damage}
+    base = network.parameter_array(**values) if p is None else np.asarray(p, dtype=float)
+    arrest_level = 0.5 * threshold if arrest_level is None else arrest_level
+    row = network.obs_matrix[network.obs_index(observable)]
+    rows = [network.param_index(k) for k in names]
+
+    parts = [np.arange(i, min(i + chunk_size, len(points))) for i in range(0, len(points), chunk_size)]
+    tasks = []
+    for c in parts:
+        pc = np.tile(base[:, None], (1, len(c)))
+        pc[rows] = points[c].T
+        tasks.append((pc, row, threshold, arrest_level, t_end, dt, tol, atol, patience))
+    pool = G2_M_ssa.worker_pool(network, processes)
+    try:
+        out = pool.map(_basin_chunk, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    outcome = np.concatenate([o[0] for o in out]).reshape(shape)
+    when = np.concatenate([o[1] for o in out]).reshape(shape)
+    return {'names': names, 'outcome': outcome, 'time': when}
+
+
+def basin_fractions(result):
+    """Fraction of the mapped initial states in each outcome."""
+    o = result['outcome']
+    return dict((label, float(np.mean(o == code))) for label, code in
+                (('arrest', ARREST), ('mitosis', MITOSIS), ('undecided', UNDECIDED)))
@@ -0,0 +1,217 @@
+"""Adaptive tracing of the arrest/no-arrest boundary in parameter space.
+
+A parameter point is classified as arrested when OBS_MPF stays below the
+activation threshold up to t_end (one terminal-event ODE run, as in
+G2_M_first_passage).  Instead of a grid over set_dna_damage values, the
+tracer works in the unit cube of the chosen parameter ranges:
+
+  1. classify a small space-filling design
+  2. pair points of opposite class and bisect along the segment between
+     them; every bisection level is one batch over the worker pool
+  3. fit a kernel surrogate of the class label and acquire new points
+     where it is uncertain and far from existing samples, then pair and
+     bisect those as well
+
+Each boundary point carries the bracket that contains the crossing along its
+segment, which is the confidence interval of the boundary location.  Points
+whose ODE run fails are counted in n_failed and left out of the
+classification; a failed midpoint leaves its bracket unchanged.
+
+    tracer = BoundaryTracer(net, {'DDS_0': (0.0, 0.01), 'G2_M_k9': (1e-4, 5e-3)},
+                            log=['G2_M_k9'])
+    result = tracer.run()
+    result['points'], result['halfwidth'], result['mesh']
+    tracer.close()
+"""
+from __future__ import division, print_function
+
+import numpy as np
+from scipy.spatial import Delaunay, cKDTree
+
+import G2_M_ssa
+from G2_M_first_passage import FAILED, ode_chunk
+
+
+def latin_hypercube(rng, n, dim):
+    """n points of a Latin hypercube sample of the unit cube, (n, dim)."""
+    return (rng.uniform(size=(n, dim)) +
+            np.array([rng.permutation(n) for _ in range(dim)]).T) / n
+
+
+class ParameterBox(object):
+    """Parameter ranges mapped onto the unit cube.
+
+    bounds     -- {parameter: (low, high)}; names are kept sorted
+    log        -- parameters on a log axis
+    """
+
+    def __init__(self, bounds, log=()):
+        self.names = sorted(bounds)
+        lo = np.array([bounds[n][0] for n in self.names], dtype=float)
+        hi = np.array([bounds[n][1] for n in self.names], dtype=float)
+        self.log = np.array([n in log for n in self.names])
+        self.lo = np.where(self.log, np.log(np.where(self.log, lo, 1.0)), lo)
+        self.hi = np.where(self.log, np.log(np.where(self.log, hi, 1.0)), hi)
+
+    @property
+    def dim(self):
+        return len(self.names)
+
+    def to_unit(self, values):
+        """{parameter: value} to a unit-cube point."""
+        x = np.array([values[n] for n in self.names], dtype=float)
+        x = np.where(self.log, np.log(np.maximum(x, 1e-300)), x)
+        return (x - self.lo) / (self.hi - self.lo)
+
+    def to_parameters(self, u):
+        """Unit-cube points (n, dim) to parameter values (n, dim)."""
+        x = self.lo + u * (self.hi - self.lo)
+        return np.where(self.log, np.exp(x), x)
+
+
+class BoundaryTracer(ParameterBox):
+    """Bisection and surrogate-guided sampling of the arrest boundary.
+
+    bounds     -- {parameter: (low, high)}
+    log        -- parameters sampled uniformly in log space
+    fixed      -- other parameter overrides applied to every run
+    """
+
+    def __init__(self, network, bounds, log=(), fixed=None, t_end=4000.0,
+                 threshold=0.1, observable='OBS_MPF', processes=None, seed=None):
+        ParameterBox.__init__(self, bounds, log)
+        self.network = network
+        self.rows = [network.param_index(n) for n in self.names]
+        self.fixed = fixed or {}
+        self.t_end = t_end
+        self.threshold = threshold
+        self.row = network.obs_matrix[network.obs_index(observable)]
+        self.rng = np.random.RandomState(seed)
+        self.pool = G2_M_ssa.worker_pool(network, processes)
+        self.samples = np.zeros((0, len(self.names)))
+        self.labels = np.zeros(0, dtype=bool)
+        self.boundary = np.zeros((0, len(self.names)))
+        self.width = np.zeros(0)
+        self.n_failed = 0
+        self.n_simulations = 0
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def classify(self, u):
+        """(arrest, ok): arrest is True where MPF does not activate by t_end,
+        ok is False where the run failed.  Successful runs are recorded."""
+        u = np.atleast_2d(u)
+        p = self.network.parameter_array(n=len(u), **self.fixed)
+        p[self.rows] = self.to_parameters(u).T
+        chunks = [c for c in np.array_split(np.arange(len(u)), 4 * G2_M_ssa.pool_size(self.pool))
+                  if len(c)]
+        out = self.pool.map(ode_chunk, [(p[:, c], self.row, self.threshold, self.t_end,
+                                         1e-6, 1e-10) for c in chunks])
+        times = np.concatenate(out)
+        ok = times != FAILED
+        arrest = np.isnan(times)
+        self.n_simulations += len(u)
+        self.n_failed += int(np.sum(~ok))
+        self.samples = np.vstack([self.samples, u[ok]])
+        self.labels = np.concatenate([self.labels, arrest[ok]])
+        return arrest, ok
+
+    # ***Refinement***
+
+    def pairs(self, points, labels):
+        """Segments from each point to the nearest sample of the other class.
+
+        Returns (arrested ends, escaping ends); a segment found from both of
+        its ends is returned once."""
+        a, b = [], []
+        for cls in (True, False):
+            others = self.samples[self.labels != cls]
+            mine = points[labels == cls]
+            if not len(others) or not len(mine):
+                continue
+            _, j = cKDTree(others).query(mine)
+            a.append(mine if cls else others[j])
+            b.append(others[j] if cls else mine)
+        if not a:
+            return np.zeros((0, self.dim)), np.zeros((0, self.dim))
+        segments = np.unique(np.hstack([np.vstack(a), np.vstack(b)]), axis=0)
+        return segments[:, :self.dim], segments[:, self.dim:]
+
+    def bisect(self, arrest, escape, depth=6):
+        """Bisect segments from arrested to escaping points depth times."""
+        arrest, escape = arrest.copy(), escape.copy()
+        for _ in range(depth):
+            mid = 0.5 * (arrest + escape)
+            lab, ok = self.classify(mid)
+            arrest[ok & lab] = mid[ok & lab]
+            escape[ok & ~lab] = mid[ok & ~lab]
+        self.boundary = np.vstack([self.boundary, 0.5 * (arrest + escape)])
+        self.width = np.concatenate([self.width, np.linalg.norm(escape - arrest, axis=1)])
+
+    def surrogate(self, u):
+        """Kernel estimate of P(arrest) at u and its label uncertainty."""
+        h = 0.5 * max(len(self.labels), 1) ** (-1.0 / (self.dim + 4))
+        d2 = ((u[:, None, :] - self.samples[None, :, :]) ** 2).sum(axis=2)
+        w = np.exp(-0.5 * d2 / h ** 2) + 1e-300
+        prob = w.dot(self.labels) / w.sum(axis=1)
+        return prob, 1.0 - np.abs(2.0 * prob - 1.0)
+
+    def acquire(self, n, n_candidates=2000):
+        """Candidates that maximise surrogate uncertainty times spacing."""
+        cand = self.rng.uniform(size=(n_candidates, self.dim))
+        _, uncertainty = self.surrogate(cand)
+        spacing, _ = cKDTree(np.vstack([self.samples, self.boundary])).query(cand)
+        chosen = []
+        score = uncertainty * spacing
+        for _ in range(n):
+            i = int(np.argmax(score))
+            chosen.append(i)
+            # keep the batch spread out
+            score = score * np.minimum(1.0, np.linalg.norm(cand - cand[i], axis=1) / (spacing[i] + 1e-12))
+        return cand[chosen]
+
+    def run(self, n_initial=None, rounds=4, batch=16, depth=6):
+        """Initial design, bisection, then rounds of acquisition + bisection."""
+        n_initial = n_initial or 8 * 2 ** min(self.dim, 3)
+        design = latin_hypercube(self.rng, n_initial, self.dim)
+        labels, ok = self.classify(design)
+        self.bisect(*self.pairs(design[ok], labels[ok]), depth=depth)
+        for _ in range(rounds):
+            new = self.acquire(batch)
+            labels, ok = self.classify(new)
+            self.bisect(*self.pairs(new[ok], labels[ok]), depth=depth)
+        return self.result()
+
+    # ***Output***
+
+    def mesh(self):
+        """Simplices over the boundary points (indices into 'points').
+
+        The points are projected onto their principal (dim - 1)-dimensional
+        subspace: consecutive pairs in 2-D, a Delaunay triangulation above."""
+        pts = self.boundary
+        if self.dim < 2 or len(pts) < self.dim:
+            return np.zeros((0, self.dim), dtype=int)
+        centred = pts - pts.mean(axis=0)
+        _, _, vt = np.linalg.svd(centred, full_matrices=False)
+        proj = centred.dot(vt[:self.dim - 1].T)
+        if self.dim == 2:
+            order = np.argsort(proj[:, 0])
+            return np.column_stack([order[:-1], order[1:]])
+        return Delaunay(proj).simplices
+
+    def result(self):
+        """Boundary points in parameter units with their bracket half-widths."""
+        unit_half = 0.5 * self.width[:, None] / np.sqrt(self.dim)
+        lo = self.to_parameters(np.clip(self.boundary - unit_half, 0.0, 1.0))
+        hi = self.to_parameters(np.clip(self.boundary + unit_half, 0.0, 1.0))
+        return {'names': self.names,
+                'points': self.to_parameters(self.boundary),
+                'halfwidth': 0.5 * (hi - lo),
+                'mesh': self.mesh(),
+                'samples': self.to_parameters(self.samples),
+                'arrest': self.labels.copy(),
+                'n_simulations': self.n_simulations,
+                'n_failed': self.n_failed}
@@ -0,0 +1,138 @@
+"""Prebuilt model bundles: a Network without pysb, BNG or sympy at load time.
+
+Every run otherwise imports pysb, runs declare_monomers() ... declare_rules(),
+sympifies the expressions, calls BNG and lambdifies the rate laws, which
+dominates the life of short worker processes.  build() does all of that once
+per variant and writes a versioned bundle with the species, stoichiometry,
+rate laws (as strings), observables, initial conditions, default parameters
+and the generated numpy source of the rate and Jacobian functions.  load()
+only needs numpy: the source is executed on first use, and because it
+travels with the Network it also spares pool workers the recompilation.
+
+    python G2_M_bundle.py v1 OLD            # writes bundles/v1.g2mb, bundles/OLD.g2mb
+    net = load('v1')                        # a Network, in milliseconds
+"""
+from __future__ import division, print_function
+
+import hashlib
+import os
+import pickle
+import time
+import warnings
+
+import numpy as np
+
+from G2_M_network import VARIANTS, Network
+
+BUNDLE_FORMAT = 1
+EXTENSION = '.g2mb'
+DEFAULT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bundles')
+
+
+def _module_hash(variant):
+    """sha1 of the variant's model file, to detect stale bundles."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        VARIANTS.get(variant, variant) + '.py')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def function_source(network, exprs):
+    """numpy source of f(y, p) returning the list of exprs."""
+    import sympy
+    try:
+        from sympy.printing.numpy import NumPyPrinter
+    except ImportError:
+        from sympy.printing.pycode import NumPyPrinter
+    names = dict((s, sympy.Symbol('y[%d]' % i)) for i, s in enumerate(network.y_symbols))
+    names.update((s, sympy.Symbol('p[%d]' % k)) for k, s in enumerate(network.p_symbols))
+    printer = NumPyPrinter()
+    lines = ['        %s,' % printer.doprint(sympy.sympify(e).xreplace(names)) for e in exprs]
+    return ('from __future__ import division\n\n\ndef f(y, p):\n    return [\n%s\n    ]\n'
+            % '\n'.join(lines))
+
+
+def bundle_network(network, path, variant=None):
+    """Write a bundle for an already built Network; returns its version."""
+    content = {
+        'species': network.species,
+        'parameters': list(zip(network.param_names, network.param_values.tolist())),
+        'stoich': network.stoich,
+        'reactants': network.reactants,
+        'rate_exprs': [str(e) for e in network.rate_exprs],
+        'observables': [(name, dict((int(i), float(row[i])) for i in np.nonzero(row)[0]))
+                        for name, row in zip(network.obs_names, network.obs_matrix)],
+        'initials': network.initials,
+        'rules': network.rules,
+        'name': network.name,
+    }
+    entries = network.jacobian_entries()
+    precompiled = {
+        'rates': function_source(network, network.rate_exprs),
+        'jac': function_source(network, [e[2] for e in entries]),
+        'deps': network._rate_dependencies(),
+        'jac_index': ([int(e[0]) for e in entries], [int(e[1]) for e in entries]),
+    }
+    digest = hashlib.sha1(pickle.dumps((content, precompiled), 2)).hexdigest()
+    bundle = {'format': BUNDLE_FORMAT, 'version': digest, 'variant': variant,
+              'source_hash': _module_hash(variant) if variant else None,
+              'built': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'network': content, 'precompiled': precompiled}
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'wb') as f:
+        pickle.dump(bundle, f, 2)
+    return digest
+
+
+def build(variant, directory=DEFAULT_DIRECTORY):
+    """Generate the variant's network with pysb/BNG and write its bundle."""
+    from G2_M_network import load_variant
+    network = Network.from_model(load_variant(variant))
+    path = os.path.join(directory, variant + EXTENSION)
+    bundle_network(network, path, variant)
+    return path
+
+
+def read(path):
+    """Raw bundle dictionary (format checked)."""
+    with open(path, 'rb') as f:
+        bundle = pickle.load(f)
+    if bundle.get('format') != BUNDLE_FORMAT:
+        raise ValueError("%s has bundle format %r, expected %d"
+                         % (path, bundle.get('format'), BUNDLE_FORMAT))
+    return bundle
+
+
+def load(variant_or_path, directory=DEFAULT_DIRECTORY, check_source=True):
+    """Network from a bundle, by variant name or file path.
+
+    Warns when the variant's model file changed since the bundle was built."""
+    path = variant_or_path
+    if not os.path.exists(path):
+        path = os.path.join(directory, variant_or_path + EXTENSION)
+    bundle = read(path)
+    variant = bundle['variant']
+    if check_source and variant and bundle['source_hash'] is not None:
+        current = _module_hash(variant)
+        if current is not None and current != bundle['source_hash']:
+            warnings.warn("%s.py changed since %s was built; rebuild the bundle"
+                          % (VARIANTS.get(variant, variant), path))
+    c = bundle['network']
+    network = Network(c['species'], c['parameters'], c['stoich'], c['reactants'],
+                      c['rate_exprs'], c['observables'], c['initials'],
+                      rules=c['rules'], name=c['name'], precompiled=bundle['precompiled'])
+    network.bundle_version = bundle['version']
+    return network
+
+
+if __name__ == '__main__':
+    import sys
+    for name in sys.argv[1:] or sorted(VARIANTS):
+        try:
+            print("%-12s -> %s" % (name, build(name)))
+        except Exception as e:
+            print("%-12s failed: %s: %s" % (name, type(e).__name__, e))
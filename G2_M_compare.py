@@ -0,0 +1,158 @@
+"""Side-by-side comparison of the G2_M model variants.
+
+The variants differ in structure (MPF monomer in G2_M_OLD/v1/ssa_params,
+CycB % CDK1_nuc complexes in G2_M_v2), in initial conditions (X1_0 = 1e-6
+against 1e-2, ...) and in observable names (OBSMPF against OBS_MPF).
+compare() runs every variant under the same protocols in a process pool,
+maps their observables onto common names and reports trajectory divergence
+against a reference variant together with runtime and network size.
+
+    python G2_M_compare.py                  # all variants, default protocols
+    result = compare(['OLD', 'v1', 'ssa_params'], reference='v1')
+    print(format_report(result))
+"""
+from __future__ import division, print_function
+
+import re
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from G2_M_network import VARIANTS, Network, load_variant
+
+# Protocols every variant is run under; parameter values override defaults
+DEFAULT_PROTOCOLS = [
+    {'name': 'no_damage', 't_end': 4000.0, 'n_points': 4000, 'params': {'DDS_0': 0.0}},
+    {'name': 'damage_0.005', 't_end': 4000.0, 'n_points': 4000, 'params': {'DDS_0': 0.005}},
+]
+
+# Species patterns used when a variant has no observable for a common name
+SPECIES_FALLBACK = {
+    'MPF': [r"^MPF\(b=None, state='a'\)$",
+            r"^CDK1_nuc\(b=None, c=1, phos='p'\) % CycB\(c=1\)$",
+            r"^CycB\(c=1\) % CDK1_nuc\(b=None, c=1, phos='p'\)$"],
+    'p53': [r"^p53\((b=None)?\)$"],
+    'Wee1': [r"^Wee1\(phos='u'\)$"],
+    'aCdc25': [r"^Cdc25\(b=None, .*phos='u', state='a'.*\)$"],
+    'Mdm2': [r"^Mdm2\((b=None)?\)$"],
+}
+
+
+def common_name(observable):
+    """OBSMPF, OBS_MPF -> MPF; other observables keep their name."""
+    return re.sub(r'^OBS_?', '', observable)
+
+
+def common_observables(network):
+    """Map common observable names to rows over the network's species."""
+    rows = {}
+    for name, row in zip(network.obs_names, network.obs_matrix):
+        rows[common_name(name)] = row
+    for name, patterns in SPECIES_FALLBACK.items():
+        if name in rows:
+            continue
+        row = np.zeros(network.n_species)
+        for i, sp in enumerate(network.species):
+            if any(re.match(pat, sp) for pat in patterns):
+                row[i] = 1.0
+        if row.any():
+            rows[name] = row
+    return rows
+
+
+def _run(task):
+    variant, protocol, method = task
+    from G2_M_solvers import solve
+    result = {'variant': variant, 'protocol': protocol['name']}
+    try:
+        start = time.time()
+        network = Network.from_model(load_variant(variant))
+        t = np.linspace(0, protocol['t_end'], protocol['n_points'])
+        values = dict((k, v) for k, v in protocol['params'].items() if k in network.param_names)
+        p = network.parameter_array(**values)
+        # compile rate and Jacobian functions outside the timed solve
+        network.jacobian(network.initial_state(p), p)
+        result['build_time'] = time.time() - start
+        start = time.time()
+        y = solve(network, t, p, method=method)
+        result['runtime'] = time.time() - start
+    except Exception as e:
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+        return result
+    result['n_species'] = network.n_species
+    result['n_reactions'] = network.n_reactions
+    result['time'] = t
+    result['observables'] = dict((name, row.dot(y.T))
+                                 for name, row in common_observables(network).items())
+    return result
+
+
+def divergence(reference, other, t):
+    """Trajectory divergence of one observable against the reference."""
+    diff = other - reference
+    scale = np.ptp(reference) or np.max(np.abs(reference)) or 1.0
+    return {'max_abs': float(np.max(np.abs(diff))),
+            'rmse': float(np.sqrt(np.mean(diff ** 2))),
+            'nrmse': float(np.sqrt(np.mean(diff ** 2)) / scale),
+            'final_rel': float(abs(diff[-1]) / (abs(reference[-1]) or 1.0)),
+            'peak_shift': float(t[np.argmax(other)] - t[np.argmax(reference)])}
+
+
+def compare(variants=None, protocols=None, reference='v1', method='LSODA', processes=None):
+    """Run variants x protocols in parallel and compare against reference.
+
+    Returns {'runs': {(variant, protocol): run}, 'divergence':
+    {(variant, protocol): {observable: metrics}}, 'relative_runtime':
+    {(variant, protocol): runtime / reference runtime}}.  Variants that fail
+    to build keep an 'error' entry instead of stopping the comparison."""
+    variants = sorted(VARIANTS) if variants is None else list(variants)
+    protocols = DEFAULT_PROTOCOLS if protocols is None else protocols
+    tasks = [(v, p, method) for p in protocols for v in variants]
+    pool = Pool(processes)
+    try:
+        runs = pool.map(_run, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    runs = dict(((r['variant'], r['protocol']), r) for r in runs)
+
+    div, rel = {}, {}
+    for protocol in protocols:
+        ref = runs.get((reference, protocol['name']))
+        if ref is None or 'error' in ref:
+            continue
+        for v in variants:
+            run = runs[(v, protocol['name'])]
+            if v == reference or 'error' in run:
+                continue
+            common = set(ref['observables']) & set(run['observables'])
+            div[(v, protocol['name'])] = dict(
+                (name, divergence(ref['observables'][name], run['observables'][name], ref['time']))
+                for name in sorted(common))
+            rel[(v, protocol['name'])] = run['runtime'] / ref['runtime']
+    return {'reference': reference, 'runs': runs, 'divergence': div, 'relative_runtime': rel}
+
+
+def format_report(result):
+    lines = ['Reference variant: %s' % result['reference'], '']
+    lines.append('%-12s %-14s %8s %10s %10s' % ('variant', 'protocol', 'species', 'reactions', 'runtime'))
+    for (v, proto), run in sorted(result['runs'].items()):
+        if 'error' in run:
+            lines.append('%-12s %-14s  failed: %s' % (v, proto, run['error']))
+        else:
+            lines.append('%-12s %-14s %8d %10d %9.3fs' % (v, proto, run['n_species'],
+                                                         run['n_reactions'], run['runtime']))
+    lines.append('')
+    lines.append('%-12s %-14s %-10s %10s %10s %10s %8s' % ('variant', 'protocol', 'observable',
+                                                         'max_abs', 'nrmse', 'peak_shift', 'runtime'))
+    for key in sorted(result['divergence']):
+        for name, m in sorted(result['divergence'][key].items()):
+            lines.append('%-12s %-14s %-10s %10.3g %10.3g %10.1f %7.2fx' % (
+                key[0], key[1], name, m['max_abs'], m['nrmse'], m['peak_shift'],
+                result['relative_runtime'][key]))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    print(format_report(compare()))
@@ -0,0 +1,208 @@
+"""Moiety conservation analysis and elimination of dependent species.
+
+Some parts of the networks only move mass around: Chk1 cycles between
+phos='u' and phos='p' through Chk1_Phos/Chk1_Dephos with no synthesis or
+degradation, so Chk1(u) + Chk1(p) is constant and one of the two is not an
+independent state.  conservation_laws() finds every such law as the left
+null space of the stoichiometry matrix (exact rational arithmetic, in
+reduced row echelon form so that each law defines one dependent species):
+
+    x_dep[k] = T[k] - sum_j G[k, j] x_ind[j]
+
+ConservedModel integrates only the independent species, with the totals T
+as extra parameters (computed from the initial conditions; their defaults
+are the totals of the default initial state), and rebuilds
+the dependent species afterwards.  The reduced Jacobian is non-singular,
+totals cannot drift, and the same reduced network feeds
+
+  steady_state()   Newton iteration on the independent species
+  lna()            the covariance ODE of G2_M_langevin on n_ind^2 entries
+  ssa()            G2_M_ssa with totals from the rounded copy numbers
+
+Observables become rows over the independent species plus a constant offset
+from the totals.  The reduced network can also be passed to
+G2_M_reduction.reduce(), which then no longer trips over conserved pairs.
+
+    cm = ConservedModel(net)
+    print(cm.dependent_names, cm.laws())
+    y = cm.odeint(t, p)                  # full (len(t), n_species) values
+    x = steady_state(cm, p)
+"""
+from __future__ import division, print_function
+
+import numpy as np
+import sympy
+from scipy.optimize import root
+
+import G2_M_langevin
+import G2_M_ssa
+from G2_M_network import Network, species_symbol
+
+
+def conservation_laws(stoich, reference=None):
+    """Dependent species and law matrix G of the left null space of stoich.
+
+    Returns (dependent, G) with G of shape (n_laws, n_species), G[k,
+    dependent[k]] = 1 and G[k, dependent[m]] = 0 for m != k.  Within each
+    law the species with the largest reference value is preferred as the
+    dependent one, which keeps the reconstruction well conditioned."""
+    stoich = np.asarray(stoich)
+    n = stoich.shape[0]
+    s = sympy.Matrix(np.rint(stoich).astype(int).tolist())
+    basis = s.T.nullspace()
+    if not basis:
+        return [], np.zeros((0, n))
+    reference = np.zeros(n) if reference is None else np.asarray(reference, dtype=float)
+    # columns in order of preference: large reference values first
+    order = sorted(range(n), key=lambda i: (-reference[i], i))
+    g = sympy.Matrix.hstack(*basis).T[:, order]
+    rref, pivots = g.rref()
+    law = np.zeros((len(pivots), n))
+    for k in range(len(pivots)):
+        for c, i in enumerate(order):
+            law[k, i] = float(rref[k, c])
+    dependent = [order[c] for c in pivots]
+    return dependent, law
+
+
+class ConservedModel(object):
+    """A Network with its conserved moieties eliminated.
+
+    network       -- Network over the independent species; its parameters
+                     are the full ones followed by the totals Total_k
+    full          -- the original Network
+    independent, dependent -- species indices of the original network
+    law           -- G, one row per conservation law
+    """
+
+    def __init__(self, network, reference=None):
+        self.full = network
+        reference = network.initial_state() if reference is None else reference
+        self.dependent, self.law = conservation_laws(network.stoich, reference)
+        self.independent = [i for i in range(network.n_species) if i not in self.dependent]
+        self.total_names = ['Total_%d' % k for k in range(len(self.dependent))]
+        self.network = self._reduced_network()
+
+    @property
+    def dependent_names(self):
+        return [self.full.species[i] for i in self.dependent]
+
+    def laws(self):
+        """Human-readable conservation laws."""
+        out = []
+        for row in self.law:
+            terms = ['%s%s' % ('' if c == 1 else '%g*' % c, self.full.species[i])
+                     for i, c in enumerate(row) if c != 0]
+            out.append(' + '.join(terms) + ' = const')
+        return out
+
+    def _reduced_network(self):
+        full = self.full
+        new_index = dict((old, k) for k, old in enumerate(self.independent))
+        totals = [sympy.Symbol(name) for name in self.total_names]
+        subs = dict((full.y_symbols[old], species_symbol(k)) for old, k in new_index.items())
+        for k, d in enumerate(self.dependent):
+            subs[full.y_symbols[d]] = totals[k] - sum(
+                self.law[k, j] * species_symbol(new_index[j])
+                for j in self.independent if self.law[k, j] != 0)
+        rates = [e.xreplace(subs) for e in full.rate_exprs]
+        self._obs_offset = full.obs_matrix[:, self.dependent]
+        reduced_obs = (full.obs_matrix[:, self.independent] -
+                       self._obs_offset.dot(self.law[:, self.independent]))
+        observables = [(name, dict((k, c) for k, c in enumerate(row) if c != 0))
+                       for name, row in zip(full.obs_names, reduced_obs)]
+        return Network([full.species[i] for i in self.independent],
+                       list(zip(full.param_names, full.param_values.tolist())) +
+                       list(zip(self.total_names, self.totals().tolist())),
+                       full.stoich[self.independent],
+                       [[new_index[i] for i in r if i in new_index] for r in full.reactants],
+                       rates, observables,
+                       [(new_index[i], name) for i, name in full.initials if i in new_index],
+                       rules=full.rules, name='%s_conserved' % full.name)
+
+    # ***Parameters and states***
+
+    def totals(self, p=None, omega=None):
+        """Conserved totals from the initial conditions (rounded copies if omega)."""
+        y0 = self.full.initial_state(self.full.param_values if p is None else p)
+        if omega is not None:
+            y0 = np.round(omega * y0) / omega
+        return np.tensordot(self.law, y0, axes=1)
+
+    def parameters(self, p=None, omega=None):
+        """Parameter vector (or columns) of the reduced network."""
+        p = self.full.param_values if p is None else np.asarray(p, dtype=float)
+        return np.concatenate([p, self.totals(p, omega)], axis=0)
+
+    def reduce_state(self, y):
+        return np.asarray(y)[self.independent]
+
+    def full_state(self, y, p=None, totals=None):
+        """Full species values from reduced states (species along the first axis)."""
+        y = np.asarray(y, dtype=float)
+        totals = np.asarray(self.totals(p) if totals is None else totals)
+        out = np.zeros((self.full.n_species,) + y.shape[1:])
+        out[self.independent] = y
+        g = self.law[:, self.independent]
+        dep = np.tensordot(g, y, axes=1)
+        t = np.asarray(totals).reshape(totals.shape + (1,) * (dep.ndim - np.ndim(totals)))
+        out[self.dependent] = t - dep
+        return out
+
+    def observable_offsets(self, p=None, omega=None):
+        """Constant part of each observable (rows of obs_names) from the totals."""
+        return np.tensordot(self._obs_offset, self.totals(p, omega), axes=1)
+
+    # ***Engines***
+
+    def odeint(self, t, p=None, **kwargs):
+        """Integrate the independent species; returns full (len(t), n_species) values."""
+        p = self.full.param_values if p is None else np.asarray(p, dtype=float)
+        y = self.network.odeint(t, p=self.parameters(p), **kwargs)
+        return self.full_state(y.T, p).T
+
+    def lna(self, t, volume, p=None, observables=None, **kwargs):
+        """G2_M_langevin.lna on the reduced network, with the offsets added back."""
+        p = self.full.param_values if p is None else np.asarray(p, dtype=float)
+        result = G2_M_langevin.lna(self.network, t, volume, self.parameters(p),
+                                   observables, **kwargs)
+        omega = G2_M_langevin.system_size(volume)
+        offsets = self.observable_offsets(p)
+        for name in result:
+            result[name]['mean'] = result[name]['mean'] + omega * offsets[self.full.obs_index(name)]
+        return result
+
+    def ssa(self, t, volume, p=None, n_paths=100, observables=None, seed=None):
+        """G2_M_ssa.ssa on the independent species, totals fixed in copy numbers."""
+        p = self.full.param_values if p is None else np.asarray(p, dtype=float)
+        omega = G2_M_langevin.system_size(volume)
+        result = G2_M_ssa.ssa(self.network, t, volume, self.parameters(p, omega), n_paths,
+                              observables, seed)
+        offsets = omega * self.observable_offsets(p, omega)
+        for name, r in result.items():
+            shift = offsets[self.full.obs_index(name)]
+            r['mean'] = r['mean'] + shift
+            r['paths'] = r['paths'] + shift
+        return result
+
+
+def steady_state(model, p=None, y0=None, t_settle=1000.0, tol=1e-10):
+    """Steady state of a ConservedModel by Newton on the independent species.
+
+    The starting point is the state after t_settle time units from y0 (or
+    the initial conditions); the totals of the initial conditions fix which
+    of the steady states on the conservation manifold is found.  Returns the
+    full species vector."""
+    p = model.full.param_values if p is None else np.asarray(p, dtype=float)
+    q = model.parameters(p)
+    totals = model.totals(p)
+    if y0 is None:
+        x = model.network.odeint(np.linspace(0.0, t_settle, 101), p=q)[-1] if t_settle else \
+            model.network.initial_state(q)
+    else:
+        x = model.reduce_state(y0)
+    sol = root(lambda z: model.network.rhs(z, q), x,
+               jac=lambda z: model.network.jacobian(z, q), method='hybr', tol=tol)
+    if not sol.success or np.any(sol.x < -1e-9 * max(1.0, np.abs(sol.x).max())):
+        raise RuntimeError("steady state not found: %s" % sol.message)
+    return model.full_state(np.maximum(sol.x, 0.0), totals=totals)
@@ -0,0 +1,154 @@
+"""Co-simulation interface: G2_M as a steppable component of a larger model.
+
+An outer orchestrator (DNA repair upstream, apoptosis downstream) owns the
+clock and exchanges values with the checkpoint model every macro step:
+
+    sim = CoSimulation(net, n_instances=500, inputs=['Signal()', 'Deg_0'],
+                       outputs=['OBS_MPF', 'OBS_p53'])
+    for k in range(400):
+        sim.set('Signal()', repair.damage())    # one value or one per instance
+        out = sim.do_step(10.0)                 # {output: (n_instances,) values}
+        apoptosis.feed(out['OBS_p53'])
+
+Inputs are parameter names (the value replaces the parameter from then on)
+or species names/indices (the value overwrites the current state, e.g. the
+Signal() amount handed over by the repair model).  Outputs are observables or
+species.  Changing an initial-condition parameter such as DDS_0 does not
+touch the state; reset() re-initialises from the parameters.
+
+All instances are columns of one state array (species x instances) and are
+integrated as one stacked system by a scipy OdeSolver (BDF by default) with
+the block-diagonal analytic Jacobian in sparse form; the instances share
+the solver's step size.  The solver object is kept between macro steps, so
+a do_step continues the integration with its order, step size and
+Jacobian history and reads the state at the step end from the dense
+output.  set(), reset() and restore() restart the solver at the current
+time and state, since they introduce a discontinuity; after a parameter
+set() the new solver takes the last step size as its first step instead of
+searching for one.  A set() that does not change the value does nothing.
+snapshot()/restore() copy the state for orchestrators that reject and
+repeat a macro step.
+"""
+from __future__ import division, print_function
+
+import numpy as np
+from scipy.integrate import BDF, LSODA, Radau
+
+METHODS = {'BDF': BDF, 'Radau': Radau, 'LSODA': LSODA}
+
+
+class CoSimulation(object):
+    """n_instances copies of a Network stepped together.
+
+    p       -- parameter vector, or one column per instance
+    inputs  -- names of the values the orchestrator may set
+    outputs -- observables and species returned by get() and do_step()
+               (default: all observables)
+    method  -- 'BDF', 'Radau' or 'LSODA' (dense Jacobian; for few instances)
+    """
+
+    def __init__(self, network, n_instances=1, p=None, inputs=(), outputs=None,
+                 t0=0.0, rtol=1e-6, atol=1e-10, method='BDF'):
+        self.network = network
+        self.n_instances = n_instances
+        p = network.param_values if p is None else np.asarray(p, dtype=float)
+        if p.ndim == 2 and p.shape[1] != n_instances:
+            raise ValueError("p has %d columns for %d instances" % (p.shape[1], n_instances))
+        self.p = np.tile(p[:, None], (1, n_instances)) if p.ndim == 1 else p.copy()
+        self.inputs = {}
+        for name in inputs:
+            if name in network.param_names:
+                self.inputs[name] = ('parameter', network.param_index(name))
+            else:
+                self.inputs[name] = ('species', self._species_index(name))
+        names = network.obs_names if outputs is None else list(outputs)
+        observables = [n for n in names if n in network.obs_names]
+        species = [n for n in names if n not in network.obs_names]
+        self.projection = network.projection(observables, [self._species_index(s) for s in species])
+        self.output_names = observables + [str(s) for s in species]
+        self.method, self.rtol = METHODS[method], rtol
+        atol = np.asarray(atol, dtype=float)
+        self.atol = np.repeat(atol, n_instances) if atol.ndim else atol
+        self.reset(t0)
+
+    def _species_index(self, name):
+        if isinstance(name, (int, np.integer)):
+            return int(name)
+        if name not in self.network.species:
+            raise ValueError("%r is neither a parameter nor a species" % (name,))
+        return self.network.species.index(name)
+
+    def reset(self, t0=0.0):
+        """Initial state from the current parameters; the clock restarts at t0."""
+        self.y = self.network.initial_state(self.p)
+        self.time = float(t0)
+        self._solver = None
+        self._first_step = None
+
+    # ***Exchange***
+
+    def set(self, name, value):
+        """Set an input, to one value or one value per instance."""
+        kind, i = self.inputs[name]
+        target = self.p if kind == 'parameter' else self.y
+        if np.array_equal(np.broadcast_to(value, target[i].shape), target[i]):
+            return
+        target[i] = value
+        if kind == 'parameter' and self._solver is not None:
+            self._first_step = self._solver.step_size
+        self._solver = None
+
+    def get(self):
+        """{output: (n_instances,) values} at the current time."""
+        values = self.projection(self.y)
+        return dict((name, values[k]) for k, name in enumerate(self.output_names))
+
+    def snapshot(self):
+        return self.time, self.y.copy(), self.p.copy()
+
+    def restore(self, snapshot):
+        time, y, p = snapshot
+        self.time, self.y, self.p = time, y.copy(), p.copy()
+        self._solver = None
+        self._first_step = None
+
+    # ***Stepping***
+
+    def _start(self):
+        """Solver for the stacked system, flat index = species * n_instances + instance."""
+        network, shape, m = self.network, self.y.shape, self.n_instances
+        size = self.y.size
+
+        def rhs(_t, y):
+            return network.rhs(y.reshape(shape), self.p).ravel()
+
+        if self.method is LSODA:
+            def jac(_t, y):
+                out = np.zeros((size, size))
+                blocks = network.jacobian(y.reshape(shape), self.p)
+                for b in range(m):
+                    out[b::m, b::m] = blocks[b]
+                return out
+        else:
+            def jac(_t, y):
+                return network.batch_sparse_jacobian(y.reshape(shape), self.p)
+
+        self._solver = self.method(rhs, self.time, self.y.ravel(), np.inf, rtol=self.rtol,
+                                   atol=self.atol, jac=jac, first_step=self._first_step or None)
+        self._first_step = None
+
+    def do_step(self, dt):
+        """Advance every instance by dt; returns get() at the new time."""
+        t_end = self.time + dt
+        if self._solver is None:
+            self._start()
+        solver = self._solver
+        while solver.t < t_end:
+            message = solver.step()
+            if solver.status == 'failed':
+                self._solver = None
+                raise RuntimeError("step to %g failed at t=%g: %s" % (t_end, solver.t, message))
+        y = solver.y if solver.t == t_end else solver.dense_output()(t_end)
+        self.y = np.maximum(y, 0.0).reshape(self.y.shape)
+        self.time = t_end
+        return self.get()
@@ -0,0 +1,461 @@
+"""Distributed work queue for ensembles that outgrow one node.
+
+Tasks are (function, arguments) items grouped in jobs.  A broker holds the
+queue; any number of workers, on this machine or on others, claim items in
+chunks, run them and write the results back:
+
+  chunking    a worker claims as many items as fit in target_seconds at
+              its running average cost per item (1 to max_chunk), so cheap
+              items do not pay one scheduling round trip each
+  heartbeats  workers touch a heartbeat every heartbeat_interval seconds;
+              items held by a worker silent for longer than stale_after are
+              put back in the queue
+  retries     an item that raises, or whose worker died, is retried up to
+              max_attempts times and then recorded as failed with its
+              traceback
+  idempotent  results are written under the item's id with a hard link from
+              a temporary file, so the first write wins and a re-run item
+              (retry after a lost heartbeat) cannot produce a second result;
+              ensemble items carry their own seeds so every run of an item
+              gives the same answer
+
+Broker is the interface; FileBroker keeps everything in a directory with
+atomic renames, so it runs on one Linux box and unchanged on several nodes
+sharing the directory (NFS, Lustre).
+
+    broker = FileBroker('/scratch/g2m-queue')
+    workers = start_local_workers(broker.root, 8)     # or, on each node:
+                                                      # python G2_M_distributed.py worker /scratch/g2m-queue
+    stats = ssa_ensemble(broker, 'v1', np.linspace(0, 2000, 201), 1e-21, 10 ** 6)
+    stats['OBS_MPF']['mean']
+"""
+from __future__ import division, print_function
+
+import importlib
+import os
+import pickle
+import socket
+import sys
+import threading
+import time
+import traceback
+import uuid
+from abc import ABC, abstractmethod
+from multiprocessing import Process
+
+import numpy as np
+
+import G2_M_bundle
+from G2_M_ssa import ssa
+
+# ***Brokers***
+
+
+class Broker(ABC):
+    """Interface of a task broker; see FileBroker."""
+
+    @abstractmethod
+    def submit(self, function, items, job=None):
+        """Queue items (argument tuples) for function; returns the job id."""
+
+    @abstractmethod
+    def claim(self, worker, size):
+        """[(item id, function, args)] assigned to worker.
+
+        size(function) is the number of items to take; a claim only takes
+        items of the function of the first one available."""
+
+    @abstractmethod
+    def complete(self, worker, item, result):
+        """Record the result of a claimed item; the first result wins."""
+
+    @abstractmethod
+    def fail(self, worker, item, error):
+        """Retry a claimed item, or record error once attempts run out."""
+
+    @abstractmethod
+    def heartbeat(self, worker):
+        """Mark worker as alive."""
+
+    @abstractmethod
+    def requeue_stale(self):
+        """Retry the items of workers without a recent heartbeat."""
+
+    @abstractmethod
+    def progress(self, job):
+        """{'total', 'done', 'failed'} counts of a job."""
+
+    @abstractmethod
+    def results(self, job):
+        """({index: result}, {index: error}) written so far."""
+
+
+class FileBroker(Broker):
+    """Broker in a shared directory.
+
+    Items live in pending/ as <job>.<index>.<attempt> files and are claimed
+    by renaming them into running/<worker>/, which only one worker can do.
+    Results go to results/<job>/<index>, failures to failed/<job>/<index>;
+    an item with a result never keeps a failure record.
+    """
+
+    def __init__(self, root, max_attempts=3, stale_after=60.0):
+        self.root = os.path.abspath(root)
+        self.max_attempts = max_attempts
+        self.stale_after = stale_after
+        for sub in ('pending', 'running', 'results', 'failed', 'workers', 'jobs'):
+            self._makedirs(os.path.join(self.root, sub))
+
+    @staticmethod
+    def _makedirs(path):
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+
+    def _path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def _write(self, path, value):
+        """Atomic write: temporary file, then rename."""
+        tmp = '%s.tmp-%s' % (path, uuid.uuid4().hex)
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, 2)
+        os.rename(tmp, path)
+
+    def _write_once(self, path, value):
+        """Write unless path exists; returns whether this call wrote it."""
+        tmp = '%s.tmp-%s' % (path, uuid.uuid4().hex)
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, 2)
+        try:
+            os.link(tmp, path)
+            return True
+        except OSError:
+            return False
+        finally:
+            os.unlink(tmp)
+
+    @staticmethod
+    def _parse(name):
+        job, index, attempt = name.rsplit('.', 2)
+        return job, int(index), int(attempt)
+
+    def submit(self, function, items, job=None):
+        job = job or uuid.uuid4().hex[:12]
+        name = function if isinstance(function, str) else '%s:%s' % (function.__module__,
+                                                                     function.__name__)
+        items = list(items)
+        self._makedirs(self._path('results', job))
+        self._makedirs(self._path('failed', job))
+        self._write(self._path('jobs', job), {'function': name, 'total': len(items),
+                                              'submitted': time.time()})
+        for index, args in enumerate(items):
+            self._write(self._path('pending', '%s.%08d.0' % (job, index)), (name, tuple(args)))
+        return job
+
+    def claim(self, worker, size):
+        mine = self._path('running', worker)
+        self._makedirs(mine)
+        claimed = []
+        count = None
+        for name in sorted(os.listdir(self._path('pending'))):
+            if count is not None and len(claimed) >= count:
+                break
+            if '.tmp-' in name:
+                continue
+            try:
+                os.rename(self._path('pending', name), os.path.join(mine, name))
+            except OSError:
+                continue
+            job, index, _ = self._parse(name)
+            if os.path.exists(self._path('results', job, str(index))):
+                os.unlink(os.path.join(mine, name))
+                continue
+            with open(os.path.join(mine, name), 'rb') as f:
+                function, args = pickle.load(f)
+            if count is None:
+                first, count = function, size(function)
+            elif function != first:
+                os.rename(os.path.join(mine, name), self._path('pending', name))
+                break
+            claimed.append((name, function, args))
+        return claimed
+
+    def complete(self, worker, item, result):
+        job, index, _ = self._parse(item)
+        self._write_once(self._path('results', job, str(index)), result)
+        # a late result of a requeued item wins over its recorded failure
+        self._remove(self._path('failed', job, str(index)))
+        self._release(worker, item)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def _release(self, worker, item):
+        self._remove(self._path('running', worker, item))
+
+    def _retry(self, source, item, error):
+        """Move an item back to pending with one more attempt, or fail it."""
+        job, index, attempt = self._parse(item)
+        if attempt + 1 >= self.max_attempts:
+            done = self._path('results', job, str(index))
+            failed = self._path('failed', job, str(index))
+            if not os.path.exists(done):
+                self._write_once(failed, error)
+                # the first result may have landed in between
+                if os.path.exists(done):
+                    self._remove(failed)
+            self._remove(source)
+        else:
+            try:
+                os.rename(source, self._path('pending', '%s.%08d.%d' % (job, index, attempt + 1)))
+            except OSError:
+                pass
+
+    def fail(self, worker, item, error):
+        self._retry(self._path('running', worker, item), item, error)
+
+    def heartbeat(self, worker):
+        path = self._path('workers', worker)
+        with open(path, 'a'):
+            os.utime(path, None)
+
+    def requeue_stale(self):
+        """Return the items of workers without a recent heartbeat; returns their count."""
+        now = time.time()
+        count = 0
+        for worker in os.listdir(self._path('running')):
+            beat = self._path('workers', worker)
+            try:
+                alive = now - os.path.getmtime(beat) < self.stale_after
+            except OSError:
+                alive = False
+            if alive:
+                continue
+            held = self._path('running', worker)
+            for item in os.listdir(held):
+                self._retry(os.path.join(held, item), item,
+                            'worker %s stopped sending heartbeats' % worker)
+                count += 1
+            try:
+                os.rmdir(held)
+                os.unlink(beat)
+            except OSError:
+                pass
+        return count
+
+    def progress(self, job):
+        total = self._read(self._path('jobs', job))['total']
+        done = len([n for n in os.listdir(self._path('results', job)) if '.tmp-' not in n])
+        failed = len([n for n in os.listdir(self._path('failed', job)) if '.tmp-' not in n])
+        return {'total': total, 'done': done, 'failed': failed}
+
+    @staticmethod
+    def _read(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def results(self, job):
+        out = []
+        for sub in ('results', 'failed'):
+            found = {}
+            for name in os.listdir(self._path(sub, job)):
+                if '.tmp-' not in name:
+                    found[int(name)] = self._read(self._path(sub, job, name))
+            out.append(found)
+        return tuple(out)
+
+
+# ***Workers***
+
+_functions = {}
+
+
+def _function(name):
+    if name not in _functions:
+        module, attr = name.split(':')
+        _functions[name] = getattr(importlib.import_module(module), attr)
+    return _functions[name]
+
+
+class Worker(object):
+    """Claims, runs and reports items, adapting its chunk size to their cost.
+
+    target_seconds  -- wall time one claimed chunk should take
+    """
+
+    def __init__(self, broker, name=None, target_seconds=5.0, max_chunk=256,
+                 heartbeat_interval=10.0, poll=0.5):
+        self.broker = broker
+        self.name = name or '%s-%d-%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:6])
+        self.target_seconds = target_seconds
+        self.max_chunk = max_chunk
+        self.heartbeat_interval = heartbeat_interval
+        self.poll = poll
+        self.cost = {}
+        self.completed = 0
+        self._stop = threading.Event()
+
+    def chunk_size(self, function):
+        """Items of function that fit in target_seconds; 1 until timed."""
+        cost = self.cost.get(function)
+        if cost is None:
+            return 1
+        return int(max(1, min(self.max_chunk, self.target_seconds / max(cost, 1e-6))))
+
+    def _beat(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            self.broker.heartbeat(self.name)
+
+    def run_item(self, item, function, args):
+        start = time.time()
+        try:
+            result = _function(function)(*args)
+        except Exception:
+            self.broker.fail(self.name, item, traceback.format_exc())
+            return
+        elapsed = time.time() - start
+        previous = self.cost.get(function)
+        self.cost[function] = elapsed if previous is None else 0.7 * previous + 0.3 * elapsed
+        self.broker.complete(self.name, item, result)
+        self.completed += 1
+
+    def run(self, idle_timeout=None, max_items=None):
+        """Work until the queue stays empty for idle_timeout seconds."""
+        self.broker.heartbeat(self.name)
+        beat = threading.Thread(target=self._beat)
+        beat.daemon = True
+        beat.start()
+        idle_since = time.time()
+        try:
+            while max_items is None or self.completed < max_items:
+                claimed = self.broker.claim(self.name, self.chunk_size)
+                if not claimed:
+                    self.broker.requeue_stale()
+                    if idle_timeout is not None and time.time() - idle_since > idle_timeout:
+                        break
+                    time.sleep(self.poll)
+                    continue
+                for item, function, args in claimed:
+                    self.run_item(item, function, args)
+                idle_since = time.time()
+        finally:
+            self._stop.set()
+        return self.completed
+
+
+def _worker_main(root, idle_timeout, kwargs):
+    Worker(FileBroker(root), **kwargs).run(idle_timeout)
+
+
+def start_local_workers(root, n, idle_timeout=None, **kwargs):
+    """n worker processes on this machine for a FileBroker at root."""
+    workers = [Process(target=_worker_main, args=(root, idle_timeout, kwargs)) for _ in range(n)]
+    for w in workers:
+        w.daemon = True
+        w.start()
+    return workers
+
+
+def gather(broker, job, timeout=None, poll=0.5, callback=None):
+    """Wait for a job and return its results in item order.
+
+    Raises RuntimeError with the first traceback if any item failed."""
+    start = time.time()
+    while True:
+        state = broker.progress(job)
+        if callback is not None:
+            callback(state)
+        if state['done'] + state['failed'] >= state['total']:
+            break
+        if timeout is not None and time.time() - start > timeout:
+            raise RuntimeError("job %s: %d of %d items after %.0f s"
+                               % (job, state['done'], state['total'], timeout))
+        broker.requeue_stale()
+        time.sleep(poll)
+    results, errors = broker.results(job)
+    if errors:
+        index = min(errors)
+        raise RuntimeError("job %s: %d items failed; item %d:\n%s"
+                           % (job, len(errors), index, errors[index]))
+    return [results[i] for i in range(state['total'])]
+
+
+def distribute(broker, function, items, **gather_args):
+    """Run function over argument tuples on the broker's workers."""
+    return gather(broker, broker.submit(function, items), **gather_args)
+
+
+# ***Ensembles***
+
+_networks = {}
+
+
+def network_for(variant):
+    """Network of a variant (or bundle path), loaded once per worker."""
+    if variant not in _networks:
+        path = os.path.join(G2_M_bundle.DEFAULT_DIRECTORY, variant + G2_M_bundle.EXTENSION)
+        if os.path.exists(variant) or os.path.exists(path):
+            _networks[variant] = G2_M_bundle.load(variant)
+        else:
+            from G2_M_network import Network, load_variant
+            _networks[variant] = Network.from_model(load_variant(variant))
+    return _networks[variant]
+
+
+def ssa_task(variant, t, volume, values, n_paths, seed, observables, keep_paths=False):
+    """One ensemble item: {observable: {'n', 'sum', 'sumsq'}} per time point.
+
+    The (len(t), n_paths) float32 paths are added as 'paths' only with
+    keep_paths."""
+    network = network_for(variant)
+    out = ssa(network, np.asarray(t), volume, network.parameter_array(**values),
+              n_paths, observables, seed)
+    moments = {}
+    for name, r in out.items():
+        paths = np.asarray(r['paths'], dtype=float)
+        moments[name] = {'n': paths.shape[1], 'sum': paths.sum(axis=1),
+                         'sumsq': (paths ** 2).sum(axis=1)}
+        if keep_paths:
+            moments[name]['paths'] = paths.astype(np.float32)
+    return moments
+
+
+def ssa_ensemble(broker, variant, t, volume, n_cells, values=None, observables=None,
+                 cells_per_item=200, seed=0, keep_paths=False, **gather_args):
+    """SSA over n_cells cells split into seeded items; mean and variance per observable.
+
+    Item k uses seed + k, so the ensemble is reproducible whatever the
+    workers, retries or chunking.  Items return per-time sums, so the
+    paths only travel with keep_paths."""
+    t = [float(x) for x in t]
+    sizes = [min(cells_per_item, n_cells - i) for i in range(0, n_cells, cells_per_item)]
+    items = [(variant, t, volume, values or {}, size, seed + k, observables, keep_paths)
+             for k, size in enumerate(sizes)]
+    parts = distribute(broker, 'G2_M_distributed:ssa_task', items, **gather_args)
+    out = {}
+    for name in parts[0]:
+        n = sum(r[name]['n'] for r in parts)
+        mean = sum(r[name]['sum'] for r in parts) / n
+        sumsq = sum(r[name]['sumsq'] for r in parts)
+        var = np.maximum(sumsq - n * mean ** 2, 0.0) / max(n - 1, 1)
+        out[name] = {'mean': mean, 'var': var}
+        if keep_paths:
+            out[name]['paths'] = np.hstack([r[name]['paths'] for r in parts])
+    return out
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['worker']:
+        root = sys.argv[2]
+        idle = float(sys.argv[3]) if len(sys.argv) > 3 else None
+        print("worker finished %d items" % Worker(FileBroker(root)).run(idle))
+    else:
+        print("usage: python G2_M_distributed.py worker QUEUE_DIRECTORY [IDLE_SECONDS]")
@@ -0,0 +1,241 @@
+"""Gaussian-process emulator of the damage response.
+
+Dashboards ask for the MPF peak and the arrest time (first crossing of the
+MPF activation threshold, t_end if it never activates) at given damage and
+rate constants.  Emulator trains one Gaussian process per output on batched
+ODE runs over a box of parameters (the unit cube, with optional log axes;
+G2_M_boundary.ParameterBox), checks it against held-out runs, and answers queries with
+a mean and a standard deviation from precomputed Cholesky factors.  Queries
+outside the box are rejected.  Queries whose predictive uncertainty is large
+are queued; once retrain_batch of them are pending a background thread
+simulates them and swaps in the refitted processes, so a query never waits
+for a simulation (with background=False the owner calls retrain() instead).
+Training (train, add, retrain) is serialised by one lock, so concurrent
+calls never lose points.  One worker pool serves the emulator until close().
+
+    em = Emulator(net, {'DDS_0': (0.0, 0.01), 'G2_M_k9': (1e-4, 5e-3)}, log=['G2_M_k9'])
+    em.train(200)
+    em.validate(50)                         # {'rmse', 'coverage', ...}
+    mean, std = em.predict({'DDS_0': 0.004, 'G2_M_k9': 6e-4})
+    em.close()
+"""
+from __future__ import division, print_function
+
+import threading
+
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve, solve_triangular
+from scipy.optimize import minimize
+
+import G2_M_ssa
+from G2_M_boundary import ParameterBox, latin_hypercube
+from G2_M_solvers import solve
+
+OUTPUTS = ('mpf_peak', 'arrest_time')
+
+
+def _response_chunk(args):
+    p, row, threshold, t = args
+    network = G2_M_ssa.worker_network()
+    out = np.zeros((p.shape[1], len(OUTPUTS)))
+    for k in range(p.shape[1]):
+        mpf = solve(network, t, p[:, k]).dot(row)
+        above = np.nonzero(mpf >= threshold)[0]
+        if len(above) == 0:
+            crossing = t[-1]
+        elif above[0] == 0:
+            crossing = t[0]
+        else:
+            i = above[0]
+            crossing = t[i - 1] + (threshold - mpf[i - 1]) / (mpf[i] - mpf[i - 1]) * (t[i] - t[i - 1])
+        out[k] = mpf.max(), crossing
+    return out
+
+
+class GaussianProcess(object):
+    """Zero-mean GP with a squared-exponential ARD kernel on standardised targets."""
+
+    def __init__(self, x, y, noise=1e-6):
+        self.x = np.asarray(x, dtype=float)
+        self.mean = y.mean()
+        self.scale = y.std() or 1.0
+        self.y = (y - self.mean) / self.scale
+        self.noise = noise
+        self.fit()
+
+    def _kernel(self, a, b, lengths):
+        d2 = (((a[:, None, :] - b[None, :, :]) / lengths) ** 2).sum(axis=2)
+        return np.exp(-0.5 * d2)
+
+    def _nll(self, log_params):
+        lengths, amp = np.exp(log_params[:-1]), np.exp(log_params[-1])
+        k = amp * self._kernel(self.x, self.x, lengths) + (self.noise + 1e-8 * amp) * np.eye(len(self.x))
+        try:
+            c = cho_factor(k, lower=True)
+        except np.linalg.LinAlgError:
+            return 1e25
+        alpha = cho_solve(c, self.y)
+        return 0.5 * self.y.dot(alpha) + np.log(np.diag(c[0])).sum()
+
+    def fit(self):
+        """Maximise the marginal likelihood over length scales and amplitude."""
+        start = np.concatenate([np.full(self.x.shape[1], np.log(0.3)), [0.0]])
+        res = minimize(self._nll, start, method='L-BFGS-B',
+                       bounds=[(np.log(1e-2), np.log(1e2))] * self.x.shape[1] + [(-5.0, 5.0)])
+        self.lengths, self.amp = np.exp(res.x[:-1]), np.exp(res.x[-1])
+        k = self.amp * self._kernel(self.x, self.x, self.lengths)
+        k += (self.noise + 1e-8 * self.amp) * np.eye(len(self.x))
+        self.chol = np.linalg.cholesky(k)
+        self.alpha = cho_solve((self.chol, True), self.y)
+
+    def predict(self, x):
+        """Mean and standard deviation at the rows of x, in target units."""
+        ks = self.amp * self._kernel(np.atleast_2d(x), self.x, self.lengths)
+        v = solve_triangular(self.chol, ks.T, lower=True)
+        var = np.maximum(self.amp - (v ** 2).sum(axis=0), 0.0)
+        return self.mean + self.scale * ks.dot(self.alpha), self.scale * np.sqrt(var)
+
+
+class Emulator(ParameterBox):
+    """Trained surrogate for MPF peak and arrest time over a parameter box.
+
+    bounds         -- {parameter: (low, high)}
+    log            -- parameters on a log axis
+    fixed          -- overrides applied to every training run
+    max_std        -- relative predictive std (of each output's training
+                      range) above which a query is queued for retraining
+    background     -- retrain in a background thread once retrain_batch
+                      queries are queued; otherwise only on retrain()
+    """
+
+    def __init__(self, network, bounds, log=(), fixed=None, t_end=4000.0,
+                 n_points=1000, threshold=0.1, observable='OBS_MPF',
+                 max_std=0.05, retrain_batch=16, background=True, processes=None, seed=None):
+        ParameterBox.__init__(self, bounds, log)
+        self.network = network
+        self.rows = [network.param_index(n) for n in self.names]
+        self.fixed = fixed or {}
+        self.t = np.linspace(0.0, t_end, n_points)
+        self.threshold = threshold
+        self.row = network.obs_matrix[network.obs_index(observable)]
+        self.max_std = max_std
+        self.retrain_batch = retrain_batch
+        self.background = background
+        self.processes = processes
+        self._pool = None
+        self._lock = threading.Lock()           # pending queries
+        self._train_lock = threading.RLock()    # x, y and the fitted models
+        self._thread = None
+        self.rng = np.random.RandomState(seed)
+        self.x = np.zeros((0, len(self.names)))
+        self.y = np.zeros((0, len(OUTPUTS)))
+        # models and the output spans they were fitted on, swapped together
+        self._fitted = None
+        self.pending = []
+
+    @property
+    def models(self):
+        return None if self._fitted is None else self._fitted[0]
+
+    def _require_fitted(self):
+        fitted = self._fitted
+        if fitted is None:
+            raise RuntimeError("the emulator is not trained; call train() first")
+        return fitted
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = G2_M_ssa.worker_pool(self.network, self.processes)
+        return self._pool
+
+    def close(self):
+        """Wait for a running retrain and stop the worker pool."""
+        if self._thread is not None:
+            self._thread.join()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    # ***Training***
+
+    def simulate(self, u):
+        """Run the model at unit-cube points; returns (n, len(OUTPUTS))."""
+        p = self.network.parameter_array(n=len(u), **self.fixed)
+        p[self.rows] = self.to_parameters(u).T
+        parts = [c for c in np.array_split(np.arange(len(u)), 4 * G2_M_ssa.pool_size(self.pool))
+                 if len(c)]
+        out = self.pool.map(_response_chunk, [(p[:, c], self.row, self.threshold, self.t)
+                                              for c in parts])
+        return np.vstack(out)
+
+    def design(self, n):
+        """Latin hypercube sample of the unit cube."""
+        return latin_hypercube(self.rng, n, self.dim)
+
+    def add(self, u):
+        """Simulate unit-cube points u, add them and refit."""
+        with self._train_lock:
+            x = np.vstack([self.x, u])
+            y = np.vstack([self.y, self.simulate(u)])
+            models = [GaussianProcess(x, y[:, k]) for k in range(len(OUTPUTS))]
+            spans = [np.ptp(y[:, k]) or 1.0 for k in range(len(OUTPUTS))]
+            self.x, self.y, self._fitted = x, y, (models, spans)
+
+    def train(self, n):
+        self.add(self.design(n))
+
+    def validate(self, n):
+        """Error of the emulator on n fresh held-out runs (not added)."""
+        models, spans = self._require_fitted()
+        u = self.design(n)
+        truth = self.simulate(u)
+        result = {}
+        for k, name in enumerate(OUTPUTS):
+            mean, std = models[k].predict(u)
+            err = mean - truth[:, k]
+            span = spans[k]
+            result[name] = {'rmse': float(np.sqrt(np.mean(err ** 2))),
+                            'nrmse': float(np.sqrt(np.mean(err ** 2)) / span),
+                            'max_abs': float(np.max(np.abs(err))),
+                            'coverage': float(np.mean(np.abs(err) <= 1.96 * std + 1e-12))}
+        return result
+
+    # ***Queries***
+
+    def predict(self, values):
+        """({output: mean}, {output: std}) for one parameter dict.
+
+        Raises ValueError outside the box.  Poorly covered queries are
+        queued; a full queue starts a background retrain and the query is
+        answered by the current models."""
+        models, spans = self._require_fitted()
+        u = self.to_unit(values)
+        outside = [n for n, v in zip(self.names, u) if not -1e-12 <= v <= 1.0 + 1e-12]
+        if outside:
+            raise ValueError("%s outside the emulator's box" % ', '.join(outside))
+        means, stds = {}, {}
+        uncertain = False
+        for k, name in enumerate(OUTPUTS):
+            mean, std = models[k].predict(u[None, :])
+            means[name], stds[name] = float(mean[0]), float(std[0])
+            if std[0] > self.max_std * spans[k]:
+                uncertain = True
+        if uncertain:
+            with self._lock:
+                self.pending.append(u)
+                full = len(self.pending) >= self.retrain_batch
+            if full and self.background and (self._thread is None or not self._thread.is_alive()):
+                self._thread = threading.Thread(target=self.retrain)
+                self._thread.daemon = True
+                self._thread.start()
+        return means, stds
+
+    def retrain(self):
+        """Simulate the queued queries and refit."""
+        with self._train_lock:
+            with self._lock:
+                pending, self.pending = self.pending, []
+            if pending:
+                self.add(np.array(pending))
@@ -0,0 +1,213 @@
+"""Finite State Projection solver for low-copy checkpoint species.
+
+At small volumes Wee1(phos='p'), p21 and the MPF/p21 complex are present in
+single-digit copy numbers and their tail probabilities need enormous run_ssa
+ensembles.  FSP solves the chemical master equation of a user-chosen
+subnetwork directly: the copy numbers of the chosen species are enumerated on
+a box [0, bound_i], the generator is stored as a sparse matrix, and
+probability that would leave the box is collected in a sink, so that
+1 - sum(p) is a rigorous bound on the truncation error.  When the sink grows
+faster than the allowed budget the box is enlarged along the species with the
+most probability on its upper face and the step is repeated.  Time stepping
+uses a Krylov (Arnoldi) approximation of exp(tA) v.
+
+Species outside the subnetwork form the environment.  They are held either at
+fixed copy numbers or, with environment='ode', at the deterministic solution
+of the full model, piecewise constant over each output interval.  As in
+G2_M_langevin, propensities are Omega * v(n / Omega) with Omega = N_A * volume.
+
+    result = fsp(net, t, 1.0e-21, ["Wee1(phos='p')", 'p21(b=None)'])
+    result['marginals']["p21(b=None)"][-1]     # P(p21 = n) at t[-1]
+    result['error'][-1]                         # truncation error bound
+"""
+from __future__ import division, print_function
+
+import numpy as np
+from scipy.linalg import expm
+from scipy.sparse import csc_matrix
+from scipy.sparse.linalg import norm as sparse_norm
+
+from G2_M_langevin import system_size
+
+
+def expv(t, a, v, m=30, tol=1e-10):
+    """exp(t*a).dot(v) for sparse a by Krylov subspace projection.
+
+    Arnoldi with m vectors and Expokit-style local error control over
+    substeps of [0, t]."""
+    n = len(v)
+    m = min(m, n - 1) if n > 1 else 1
+    w = np.asarray(v, dtype=float).copy()
+    anorm = sparse_norm(a, np.inf) or 1.0
+    t_done = 0.0
+    tau = t
+    while t_done < t:
+        beta = np.linalg.norm(w)
+        if beta == 0.0:
+            break
+        basis = np.zeros((n, m + 1))
+        h = np.zeros((m + 2, m + 2))
+        basis[:, 0] = w / beta
+        k = m
+        breakdown = False
+        for j in range(m):
+            p = a.dot(basis[:, j])
+            for i in range(j + 1):
+                h[i, j] = basis[:, i].dot(p)
+                p -= h[i, j] * basis[:, i]
+            s = np.linalg.norm(p)
+            if s < 1e-12 * anorm * beta:
+                breakdown, k = True, j + 1
+                break
+            h[j + 1, j] = s
+            basis[:, j + 1] = p / s
+        tau = min(tau, t - t_done)
+        if breakdown:
+            # invariant subspace: exact up to rounding over the whole interval
+            f = expm((t - t_done) * h[:k, :k])
+            w = beta * basis[:, :k].dot(f[:, 0])
+            break
+        avnorm = np.linalg.norm(a.dot(basis[:, m]))
+        h[m + 1, m] = 1.0
+        while True:
+            f = expm(tau * h)
+            phi1 = abs(beta * f[m, 0])
+            phi2 = abs(beta * f[m + 1, 0] * avnorm)
+            if phi1 > 10.0 * phi2:
+                err = phi2
+            elif phi1 > phi2:
+                err = phi1 * phi2 / (phi1 - phi2)
+            else:
+                err = phi1
+            if err <= 1.2 * tol * tau or tau < 1e-12 * t:
+                break
+            tau *= 0.9 * (tol * tau / err) ** (1.0 / m)
+        w = beta * basis.dot(f[:m + 1, 0])
+        t_done += tau
+        tau *= min(5.0, 0.9 * (tol * tau / max(err, 1e-300)) ** (1.0 / m))
+    return w
+
+
+class Projection(object):
+    """Box state space [0, bounds] of the subnetwork species and its generator."""
+
+    def __init__(self, network, species, bounds, omega):
+        self.network = network
+        self.species = list(species)
+        self.bounds = np.asarray(bounds, dtype=int)
+        self.omega = omega
+        self.shape = tuple(self.bounds + 1)
+        self.size = int(np.prod(self.shape))
+        self.states = np.array(np.unravel_index(np.arange(self.size), self.shape))
+        sub = network.stoich[self.species]
+        self.reactions = np.nonzero(np.any(sub != 0, axis=0))[0]
+        self.jumps = sub[:, self.reactions].astype(int)
+
+    def generator(self, environment, p):
+        """Sparse CME generator over the box; exits go to an implicit sink."""
+        net = self.network
+        y = np.tile(environment[:, None] / self.omega, (1, self.size))
+        y[self.species] = self.states / self.omega
+        pp = np.tile(p[:, None], (1, self.size))
+        props = self.omega * np.maximum(net.rates(y, pp)[self.reactions], 0.0)
+        rows, cols, vals = [], [], []
+        src = np.arange(self.size)
+        for k in range(len(self.reactions)):
+            a = props[k]
+            target = self.states + self.jumps[:, k][:, None]
+            feasible = np.all(target >= 0, axis=0)
+            a = np.where(feasible, a, 0.0)
+            inside = feasible & np.all(target <= self.bounds[:, None], axis=0)
+            idx = np.ravel_multi_index(np.where(inside, target, 0), self.shape)
+            rows.extend(idx[inside])
+            cols.extend(src[inside])
+            vals.extend(a[inside])
+            rows.extend(src)
+            cols.extend(src)
+            vals.extend(-a)
+        return csc_matrix((vals, (rows, cols)), shape=(self.size, self.size))
+
+    def embed(self, p, other):
+        """Copy a distribution over `other` (a smaller box) into this box."""
+        out = np.zeros(self.size)
+        idx = np.ravel_multi_index(other.states, self.shape)
+        out[idx] = p
+        return out
+
+    def marginals(self, p):
+        grid = p.reshape(self.shape)
+        out = []
+        for axis in range(len(self.species)):
+            others = tuple(a for a in range(len(self.species)) if a != axis)
+            out.append(grid.sum(axis=others))
+        return out
+
+    def face_mass(self, p):
+        """Probability on the upper face of the box along each species."""
+        grid = p.reshape(self.shape)
+        return np.array([np.take(grid, -1, axis=axis).sum() for axis in range(len(self.species))])
+
+
+def fsp(network, t, volume, species, p=None, bounds=None, tol=1e-6,
+        environment=None, max_states=2000000, krylov_dim=30):
+    """Distributions of the subnetwork species at the output times t.
+
+    species      -- names or indices of the enumerated species
+    bounds       -- initial per-species upper bounds (default: 2x the initial
+                    copy number + 10)
+    tol          -- total truncation error allowed up to t[-1]
+    environment  -- None (initial copy numbers), a dict {species: copies} or
+                    'ode' (deterministic trajectory of the full model)
+
+    Returns {'marginals': {name: [P(n) at each t]}, 'error': sink mass per t,
+    'bounds': final bounds, 'joint': list of joint distributions}."""
+    p = network.param_values if p is None else np.asarray(p, dtype=float)
+    omega = system_size(volume)
+    idx = [network.species.index(s) if not isinstance(s, (int, np.integer)) else int(s)
+           for s in species]
+    x0 = network.initial_state(p)
+    start = np.round(omega * x0[idx]).astype(int)
+    bounds = 2 * start + 10 if bounds is None else np.asarray(bounds, dtype=int)
+
+    if environment == 'ode':
+        env_traj = omega * network.odeint(t, p=p)
+    else:
+        env = omega * x0
+        if environment is not None:
+            for s, copies in environment.items():
+                env[int(s) if isinstance(s, (int, np.integer)) else network.species.index(s)] = copies
+        env_traj = np.tile(env, (len(t), 1))
+
+    proj = Projection(network, idx, np.maximum(bounds, start), omega)
+    prob = np.zeros(proj.size)
+    prob[np.ravel_multi_index(tuple(start), proj.shape)] = 1.0
+    names = [network.species[i] for i in idx]
+    marginals = dict((n, [m]) for n, m in zip(names, proj.marginals(prob)))
+    errors, joint = [0.0], [prob.reshape(proj.shape)]
+    span = t[-1] - t[0]
+
+    for k in range(1, len(t)):
+        dt = t[k] - t[k - 1]
+        budget = tol * (t[k] - t[0]) / span
+        while True:
+            a = proj.generator(env_traj[k - 1], p)
+            new = np.maximum(expv(dt, a, prob, m=krylov_dim, tol=tol * 1e-3), 0.0)
+            lost = max(1.0 - new.sum(), 0.0)
+            if lost <= budget:
+                break
+            # enlarge the box along the species with most mass on its face
+            grow = np.argmax(proj.face_mass(new))
+            bounds = proj.bounds.copy()
+            bounds[grow] = 2 * bounds[grow] + 1
+            bigger = Projection(network, idx, bounds, omega)
+            if bigger.size > max_states:
+                raise RuntimeError("FSP needs more than %d states at t=%g" % (max_states, t[k]))
+            prob = bigger.embed(prob, proj)
+            proj = bigger
+        prob = new
+        for n, m in zip(names, proj.marginals(prob)):
+            marginals[n].append(m)
+        errors.append(lost)
+        joint.append(prob.reshape(proj.shape))
+    return {'marginals': marginals, 'error': np.array(errors),
+            'bounds': proj.bounds, 'joint': joint}
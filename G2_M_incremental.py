@@ -0,0 +1,558 @@
+"""Incremental network generation for the model edit-simulate loop.
+
+Every edit of declare_rules() (splitting MPF into CycB % CDK1_nuc, adding
+Wee1_Phos, ...) normally means a full generate_equations() pass through BNG
+followed by sympifying, differentiating and lambdifying every rate law.
+NetworkBuilder expands the rules itself on species graphs (the molecule
+graphs and templates of G2_M_network_free) and keeps, per rule, the
+reactions it generated and the embeddings of its reactant patterns in every
+known species.  update() diffs a new RuleModel against that state:
+
+  unchanged rules   keep their reactions and are only applied to species
+                    that are new in this update
+  rate-only edits   keep the reactions, only the rate laws change
+  changed / added   re-expanded over the current species; their products
+                    seed the usual closure through all rules
+  removed rules     their reactions go, and species no longer reachable
+                    from the initial conditions are pruned
+  monomer edits     sites or states added or removed: a full rebuild, as
+                    every species graph changes
+
+Reactions follow BNG conventions: reactant patterns are matched in
+separate species, identical reactant patterns get the 1/m! symmetry factor
+and reactions with the same reactants and products are merged.
+Observables count pattern embeddings (match='molecules').
+
+The compiled artifacts are patched the same way: the numpy source of each
+reaction's rate and of its derivatives (with respect to its reactants and to
+the observables it uses) is generated once with sympy and cached, and the
+rate and Jacobian functions of a new Network are assembled from the cached
+pieces as G2_M_bundle-style precompiled source, so an edit only costs sympy
+work for the reactions it created.
+
+    network = regenerate('v2', cache='v2.g2mi')     # full build the first time
+    ... edit declare_rules() in G2_M_v2.py ...
+    network = regenerate('v2', cache='v2.g2mi')     # only the edited rules
+"""
+from __future__ import division, print_function
+
+import os
+import pickle
+import re
+
+import numpy as np
+
+from G2_M_network import Network
+from G2_M_network_free import Molecule, Template, rule_actions, split_condition
+
+_SLOT = re.compile(r'__Y(\d+)__')
+
+
+# ***Species graphs***
+
+def _copy(mol):
+    return Molecule(mol.monomer, dict(mol.states), dict(mol.bonds))
+
+
+def species_from_pattern(monomers, pattern):
+    """Molecule list of a fully specified pattern (bonds as (index, site))."""
+    mols, ends = [], {}
+    for i, (m, conds) in enumerate(pattern):
+        mols.append(_new_molecule(monomers, m, dict(conds)))
+        for site, cond in conds:
+            bond = split_condition(cond)[1]
+            if isinstance(bond, int):
+                ends.setdefault(bond, []).append((i, site))
+    for pair in ends.values():
+        if len(pair) == 2:
+            (a, sa), (b, sb) = pair
+            mols[a].bonds[sa] = (b, sb)
+            mols[b].bonds[sb] = (a, sa)
+    return mols
+
+
+def _new_molecule(monomers, monomer, conds):
+    sites, states = monomers[monomer]
+    mol = Molecule(monomer, {}, dict((s, None) for s in sites))
+    for s in sites:
+        if s in states:
+            mol.states[s] = states[s][0]
+    for site, cond in conds.items():
+        state = split_condition(cond)[0]
+        if state is not None:
+            mol.states[site] = state
+    return mol
+
+
+def _components(mols):
+    """Connected components of {id: Molecule}, as lists of ids."""
+    left, out = set(mols), []
+    while left:
+        start = min(left)
+        seen, stack = set([start]), [start]
+        while stack:
+            for partner in mols[stack.pop()].bonds.values():
+                if partner is not None and partner[0] not in seen:
+                    seen.add(partner[0])
+                    stack.append(partner[0])
+        left -= seen
+        out.append(sorted(seen))
+    return out
+
+
+def canonical(monomers, mols, ids):
+    """(name, molecule list) of the complex formed by ids.
+
+    Each site holds at most one bond, so a depth-first walk over the sites
+    in a fixed order visits the complex in a unique order from any start;
+    the name is the smallest over all starts, written like pysb species."""
+    best = None
+    for start in ids:
+        order, seen, stack = [], set([start]), [start]
+        while stack:
+            mid = stack.pop()
+            order.append(mid)
+            for site in reversed(monomers[mols[mid].monomer][0]):
+                partner = mols[mid].bonds.get(site)
+                if partner is not None and partner[0] not in seen:
+                    seen.add(partner[0])
+                    stack.append(partner[0])
+        position = dict((mid, k) for k, mid in enumerate(order))
+        labels, parts = {}, []
+        for mid in order:
+            mol = mols[mid]
+            fields = []
+            for site in monomers[mol.monomer][0]:
+                state, partner = mol.states.get(site), mol.bonds.get(site)
+                bond = None
+                if partner is not None:
+                    edge = tuple(sorted([(position[mid], site), (position[partner[0]], partner[1])]))
+                    bond = labels.setdefault(edge, len(labels) + 1)
+                if state is None:
+                    fields.append('%s=%s' % (site, bond))
+                elif bond is None:
+                    fields.append("%s='%s'" % (site, state))
+                else:
+                    fields.append("%s=('%s', %d)" % (site, state, bond))
+            parts.append('%s(%s)' % (mol.monomer, ', '.join(fields)))
+        name = ' % '.join(parts)
+        if best is None or name < best[0]:
+            graph = []
+            for mid in order:
+                mol = mols[mid]
+                bonds = dict((s, None if b is None else (position[b[0]], b[1]))
+                             for s, b in mol.bonds.items())
+                graph.append(Molecule(mol.monomer, dict(mol.states), bonds))
+            best = (name, graph)
+    return best
+
+
+def apply_rule(monomers, actions, reactants, embeddings):
+    """Product species names and graphs of one rule application.
+
+    reactants are species graphs, embeddings the matched molecule indices of
+    each reactant pattern in them."""
+    mols, chosen, offset = {}, [], 0
+    for graph, ids in zip(reactants, embeddings):
+        for k, mol in enumerate(graph):
+            copy = _copy(mol)
+            copy.bonds = dict((s, None if b is None else (b[0] + offset, b[1]))
+                              for s, b in mol.bonds.items())
+            mols[k + offset] = copy
+        chosen.append(tuple(i + offset for i in ids))
+        offset += len(graph)
+    created = {}
+
+    def resolve(ref):
+        return chosen[ref[1]][ref[2]] if ref[0] == 'r' else created[ref[1]]
+
+    def delete(mid):
+        for partner in mols.pop(mid).bonds.values():
+            if partner is not None and partner[0] in mols:
+                mols[partner[0]].bonds[partner[1]] = None
+
+    for action in actions:
+        kind = action[0]
+        if kind == 'delete_complex':
+            root = chosen[action[1]][0]
+            for component in _components(mols):
+                if root in component:
+                    for mid in component:
+                        delete(mid)
+        elif kind == 'delete':
+            delete(chosen[action[1]][action[2]])
+        elif kind == 'create':
+            created[action[1]] = offset
+            mols[offset] = _new_molecule(monomers, action[2], action[3])
+            offset += 1
+        elif kind == 'state':
+            mols[resolve(action[1])].states[action[2]] = action[3]
+        elif kind == 'unbind':
+            mid = resolve(action[1])
+            partner = mols[mid].bonds[action[2]]
+            if partner is not None:
+                mols[partner[0]].bonds[partner[1]] = None
+                mols[mid].bonds[action[2]] = None
+        elif kind == 'bind':
+            a, b = resolve(action[1]), resolve(action[3])
+            mols[a].bonds[action[2]] = (b, action[4])
+            mols[b].bonds[action[4]] = (a, action[2])
+    return [canonical(monomers, mols, ids) for ids in _components(mols)]
+
+
+def embeddings(template, graph):
+    """Every embedding of a template in a species graph."""
+    found = []
+    for anchor in range(len(graph)):
+        if graph[anchor].monomer == template.anchor:
+            ids = template.match(graph, anchor)
+            if ids is not None:
+                found.append(ids)
+    return found
+
+
+# ***Builder***
+
+def _signature(rule):
+    name, lhs, rhs, rate = rule
+    return (tuple(lhs), tuple(rhs)), str(rate)
+
+
+def _monomer_signature(monomers):
+    return sorted((name, tuple(sites), sorted((site, tuple(v)) for site, v in states.items()))
+                  for name, (sites, states) in monomers.items())
+
+
+class NetworkBuilder(object):
+    """Rule expansion state that can be updated rule by rule.
+
+    max_species bounds the closure (polymerising rules never close)."""
+
+    def __init__(self, max_species=10000):
+        self.max_species = max_species
+        self.model = None
+        self.sources = {}           # (rule, rate, reactants) -> compiled pieces
+        self.stats = {}
+        self._clear()
+
+    def _clear(self):
+        """Forget every species and rule; the compiled pieces stay cached."""
+        self.species = []           # names, in order of discovery
+        self.graphs = {}            # name -> molecule list
+        self.rules = {}             # rule name -> (lhs, rhs, rate)
+        self.signatures = {}
+        self.templates = {}         # rule name -> [Template per reactant pattern]
+        self.actions = {}
+        self.matches = {}           # rule name -> per pattern [(species, ids)]
+        self.reactions = {}         # rule name -> {(reactants, products): factor}
+
+    # ***Expansion***
+
+    def _add_species(self, name, graph, queue):
+        if name in self.graphs:
+            return
+        if len(self.species) >= self.max_species:
+            raise RuntimeError("more than %d species; the rules may polymerise" % self.max_species)
+        self.species.append(name)
+        self.graphs[name] = graph
+        queue.append(name)
+
+    def _record(self, rule, reactants, embedding, queue):
+        products = apply_rule(self.model.monomers, self.actions[rule],
+                              [self.graphs[s] for s in reactants], embedding)
+        for name, graph in products:
+            self._add_species(name, graph, queue)
+        r, p = tuple(sorted(reactants)), tuple(sorted(name for name, _ in products))
+        if r == p:
+            return
+        # ordered combinations of identical patterns are merged below, so
+        # each carries 1/m! of the rule rate as in BNG
+        lhs = self.rules[rule][0]
+        factor = 1.0
+        for pattern in set(lhs):
+            factor /= np.prod(np.arange(1, lhs.count(pattern) + 1))
+        table = self.reactions[rule]
+        table[r, p] = table.get((r, p), 0.0) + factor
+        self.stats['applications'] += 1
+
+    def _expand(self, rule, new, queue):
+        """Apply rule to combinations that use species `new` in some slot.
+
+        Slots before the first slot holding `new` take earlier species only,
+        so every combination is generated once.  new=None expands over all
+        known species (a new or edited rule)."""
+        slots = self.matches[rule]
+        if not slots:
+            if new is None:
+                self._record(rule, (), (), queue)
+            return
+        if new is None:
+            combos = [[]]
+            for slot in slots:
+                combos = [c + [m] for c in combos for m in slot]
+            for combo in combos:
+                self._record(rule, [m[0] for m in combo], [m[1] for m in combo], queue)
+            return
+        rank = dict((s, i) for i, s in enumerate(self.species))
+        limit = rank[new]
+        for k in range(len(slots)):
+            choices = []
+            for j, slot in enumerate(slots):
+                if j < k:
+                    choices.append([m for m in slot if rank[m[0]] < limit])
+                elif j == k:
+                    choices.append([m for m in slot if m[0] == new])
+                else:
+                    choices.append([m for m in slot if rank[m[0]] <= limit])
+            combos = [[]]
+            for choice in choices:
+                combos = [c + [m] for c in combos for m in choice]
+            for combo in combos:
+                self._record(rule, [m[0] for m in combo], [m[1] for m in combo], queue)
+
+    def _match_species(self, rule, names):
+        for slot, template in zip(self.matches[rule], self.templates[rule]):
+            for s in names:
+                slot.extend((s, ids) for ids in embeddings(template, self.graphs[s]))
+
+    def _close(self, queue):
+        """Apply every rule to newly found species until no new ones appear."""
+        while queue:
+            name = queue.pop(0)
+            for rule in self.rules:
+                self._match_species(rule, [name])
+            for rule in self.rules:
+                self._expand(rule, name, queue)
+
+    def _prune(self):
+        """Drop species (and their reactions) not reachable from the seeds."""
+        reachable = set(self._seeds())
+        changed = True
+        while changed:
+            changed = False
+            for table in self.reactions.values():
+                for r, p in table:
+                    if all(s in reachable for s in r) and not reachable.issuperset(p):
+                        reachable.update(p)
+                        changed = True
+        dropped = [s for s in self.species if s not in reachable]
+        if not dropped:
+            return 0
+        self.species = [s for s in self.species if s in reachable]
+        for s in dropped:
+            del self.graphs[s]
+        for rule in self.rules:
+            self.matches[rule] = [[m for m in slot if m[0] in reachable]
+                                  for slot in self.matches[rule]]
+            self.reactions[rule] = dict(((r, p), f) for (r, p), f in self.reactions[rule].items()
+                                        if reachable.issuperset(r) and reachable.issuperset(p))
+        return len(dropped)
+
+    def _seeds(self):
+        names = [canonical(self.model.monomers, dict(enumerate(g)), range(len(g)))[0]
+                 for g in (species_from_pattern(self.model.monomers, pt)
+                           for pt, _ in self.model.initials)]
+        for rule, (lhs, _, _) in self.rules.items():
+            if not lhs:
+                names.extend(p for _, ps in self.reactions[rule] for p in ps)
+        return names
+
+    def update(self, model):
+        """Bring the network in line with a (possibly edited) RuleModel."""
+        self.stats = {'applications': 0, 'added': [], 'changed': [], 'rate_only': [],
+                      'removed': [], 'kept': [], 'new_species': 0, 'pruned': 0,
+                      'rebuilt': False}
+        # every species graph (and embedding) spells out all sites of its
+        # monomers, so a changed monomer invalidates them all
+        if self.model is not None and (_monomer_signature(self.model.monomers) !=
+                                       _monomer_signature(model.monomers)):
+            self._clear()
+            self.stats['rebuilt'] = True
+        self.model = model
+        incoming = dict((r[0], r) for r in model.rules)
+        for name in list(self.rules):
+            if name not in incoming:
+                self.stats['removed'].append(name)
+                for table in (self.rules, self.signatures, self.templates, self.actions,
+                              self.matches, self.reactions):
+                    del table[name]
+        queue = []
+        known = len(self.species)
+        for pattern, _ in model.initials:
+            graph = species_from_pattern(model.monomers, pattern)
+            name, graph = canonical(model.monomers, dict(enumerate(graph)), range(len(graph)))
+            self._add_species(name, graph, queue)
+        # species already known are matched against the new rules only
+        existing = self.species[:known]
+        fresh = []
+        for name, rule in incoming.items():
+            structure, rate = _signature(rule)
+            old = self.signatures.get(name)
+            self.rules[name] = rule[1:]
+            self.signatures[name] = (structure, rate)
+            if old is not None and old[0] == structure:
+                self.stats['rate_only' if old[1] != rate else 'kept'].append(name)
+                continue
+            self.stats['changed' if old is not None else 'added'].append(name)
+            self.templates[name] = [Template(pt) for pt in rule[1]]
+            self.actions[name] = rule_actions(rule[1], rule[2])
+            self.matches[name] = [[] for _ in rule[1]]
+            self.reactions[name] = {}
+            self._match_species(name, existing)
+            fresh.append(name)
+        for name in fresh:
+            self._expand(name, None, queue)
+        self._close(queue)
+        self.stats['pruned'] = self._prune()
+        self.stats['new_species'] = len(self.species) - known + self.stats['pruned']
+        return self
+
+    # ***Network assembly***
+
+    def _pieces(self, rule, reactants, factor, previous):
+        """Numpy and sympy-string pieces of one reaction's rate law.
+
+        Pieces from the previous assembly are reused; only new reactions
+        and edited rate laws go through sympy."""
+        import sympy
+        rate = self.rules[rule][2]
+        key = (rule, str(rate), reactants, factor)
+        if key in previous:
+            self.sources[key] = previous[key]
+        else:
+            try:
+                from sympy.printing.numpy import NumPyPrinter
+            except ImportError:
+                from sympy.printing.pycode import NumPyPrinter
+            distinct = sorted(set(reactants))
+            slots = [sympy.Symbol('__Y%d__' % k) for k in range(len(distinct))]
+            expr = sympy.sympify(rate) * factor
+            for s in reactants:
+                expr = expr * slots[distinct.index(s)]
+            local = dict((s, sympy.Symbol('_v_' + str(s))) for s in expr.free_symbols
+                         if s not in slots)
+            printer = NumPyPrinter()
+            observables = [str(s) for s in expr.free_symbols
+                           if str(s) in self.model.obs_names]
+            self.sources[key] = {
+                'distinct': distinct,
+                'text': str(expr),
+                'numpy': printer.doprint(expr.xreplace(local)),
+                'dslot': [printer.doprint(sympy.diff(expr, y).xreplace(local)) for y in slots],
+                'dobs': dict((o, printer.doprint(sympy.diff(expr, sympy.Symbol(o)).xreplace(local)))
+                             for o in observables),
+                'names': sorted(str(s) for s in expr.free_symbols if s not in slots),
+            }
+        return self.sources[key]
+
+    def observable_coefficients(self):
+        """{observable: {species index: embeddings}} over the current species."""
+        out = []
+        for name, patterns in self.model.observables:
+            coef = {}
+            for pattern in patterns:
+                template = Template(pattern)
+                for i, s in enumerate(self.species):
+                    n = len(embeddings(template, self.graphs[s]))
+                    if n:
+                        coef[i] = coef.get(i, 0) + n
+            out.append((name, coef))
+        return out
+
+    def network(self):
+        """A Network of the current species and reactions, with precompiled source."""
+        model = self.model
+        index = dict((s, i) for i, s in enumerate(self.species))
+        observables = self.observable_coefficients()
+        obs_coef = dict(observables)
+        reactions = [(rule, r, p, f) for rule in sorted(self.reactions)
+                     for (r, p), f in sorted(self.reactions[rule].items())]
+        stoich = np.zeros((len(self.species), len(reactions)))
+        reactants, rates, rules, numpy_lines, deps, jac = [], [], [], [], [], {}
+        used = set()
+        previous, self.sources = self.sources, {}
+        for j, (rule, r, p, factor) in enumerate(reactions):
+            for s in r:
+                stoich[index[s], j] -= 1
+            for s in p:
+                stoich[index[s], j] += 1
+            reactants.append([index[s] for s in r])
+            rules.append(rule)
+            pieces = self._pieces(rule, r, factor, previous)
+            slot_index = [index[s] for s in pieces['distinct']]
+
+            def fill_y(text, form):
+                return _SLOT.sub(lambda m: form % slot_index[int(m.group(1))], text)
+
+            text = pieces['text']
+            for o in pieces['dobs']:
+                sum_text = ' + '.join('%r*y_%d' % (c, i) for i, c in sorted(obs_coef[o].items()))
+                text = re.sub(r'\b%s\b' % o, '(%s)' % (sum_text or '0'), text)
+            rates.append(fill_y(text, 'y_%d'))
+            numpy_lines.append(fill_y(pieces['numpy'], 'y[%d]'))
+            used.update(pieces['names'])
+            # d rate / d y_i through the reactants and through the observables
+            grads = {}
+            for i, d in zip(slot_index, pieces['dslot']):
+                grads.setdefault(i, []).append(fill_y(d, 'y[%d]'))
+            for o, d in pieces['dobs'].items():
+                for i, c in obs_coef[o].items():
+                    grads.setdefault(i, []).append('%r*(%s)' % (c, fill_y(d, 'y[%d]')))
+            deps.append(sorted(grads))
+            for i in np.nonzero(stoich[:, j])[0]:
+                for k, terms in grads.items():
+                    jac.setdefault((int(i), k), []).extend(
+                        '%r*(%s)' % (float(stoich[i, j]), t) for t in terms if t != '0')
+        jac = sorted((ij, terms) for ij, terms in jac.items() if terms)
+        prologue = []
+        for name in sorted(used):
+            if name in model.obs_names:
+                terms = ' + '.join('%r*y[%d]' % (c, i) for i, c in sorted(obs_coef[name].items()))
+                prologue.append('    _v_%s = %s' % (name, terms or '0.0*y[0]'))
+            else:
+                prologue.append('    _v_%s = p[%d]' % (name, model.param_names.index(name)))
+
+        def source(lines):
+            return ('from __future__ import division\n\n\ndef f(y, p):\n%s\n    return [\n%s\n    ]\n'
+                    % ('\n'.join(prologue), '\n'.join('        %s,' % x for x in lines)))
+
+        precompiled = {'rates': source(numpy_lines),
+                       'jac': source([' + '.join(terms) for _, terms in jac]),
+                       'deps': deps,
+                       'jac_index': ([ij[0] for ij, _ in jac], [ij[1] for ij, _ in jac])}
+        initials = []
+        for pattern, param in model.initials:
+            graph = species_from_pattern(model.monomers, pattern)
+            initials.append((index[canonical(model.monomers, dict(enumerate(graph)),
+                                             range(len(graph)))[0]], param))
+        return Network(self.species, list(zip(model.param_names, model.param_values.tolist())),
+                       stoich, reactants, rates, observables, initials, rules=rules,
+                       name=model.name, precompiled=precompiled)
+
+    # ***Cache***
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(self, f, 2)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+
+def regenerate(variant, cache=None, max_species=10000):
+    """Network of a variant, expanding only what changed since the cached build.
+
+    Needs pysb for the rules but not BNG."""
+    from G2_M_network import load_variant
+    from G2_M_network_free import RuleModel
+    model = RuleModel.from_model(load_variant(variant, generate=False))
+    if cache is not None and os.path.exists(cache):
+        builder = NetworkBuilder.load(cache)
+    else:
+        builder = NetworkBuilder(max_species)
+    network = builder.update(model).network()
+    if cache is not None:
+        builder.save(cache)
+    return network
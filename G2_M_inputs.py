@@ -0,0 +1,217 @@
+"""Time-varying inputs: measured damage and signal profiles driving the model.
+
+In the model files damage is the constant DDS_0.  It is not a dose: it only
+sets the initial amounts of Signal() and SignalDamp() and, through
+kdamp_DDS0 = k_damp*DDS_0, the damping rate, so changing it during a run does
+not change the damage the cell sees.  Measured damage or ATM activity curves
+enter here as Input objects (tabulated values with step, linear or
+cubic-spline interpolation, held constant outside the table) and drive
+either
+
+  a parameter   the input value replaces the parameter, e.g. 'Deg_0' or
+                'k_deg' inside sig_deg, 'G2_M_k1' of Signal_Create_ATM_ATR
+  a rule        the input multiplies the rates of every reaction of the
+                rule, e.g. 'Signal_Create_p53' scaled by relative ATM activity
+
+A damage time course is therefore imposed through the rules fed by
+Signal() (scaling Signal_Create_I, Signal_Create_ATM_ATR and
+Signal_Create_p53 together by the relative damage) or through the
+parameters of sig_deg; expressions such as sig_deg are not inputs
+themselves.  To overwrite the amount of Signal() at a time point, step the
+model with G2_M_cosim.CoSimulation and a 'Signal()' species input.
+Parameters that appear in no rate law (initial amounts only) are rejected.
+
+Parameter inputs go straight into the parameter vector of the compiled
+functions.  Rule inputs add one parameter Input_<rule> (1 when undriven)
+to the rate laws of a derived Network, compiled once.  Either way the RHS
+and analytic Jacobian are the compiled ones of a fixed network, so
+integrating many profiles never recompiles.  The integrator is restarted at
+every breakpoint of the inputs (the knots of step and linear tables, the
+table ends of splines), so kinks and jumps are not smeared over.
+
+    atm = Input(t_meas, atm_meas, kind='spline')
+    # damage repaired at t = 600: the Signal() rules switch off
+    damage = Input([0, 600, 601], [1.0, 1.0, 0.0], kind='step')
+    model = DrivenModel(net, {'Signal_Create_ATM_ATR': atm, 'Signal_Create_I': damage,
+                              'Signal_Create_p53': damage})
+    y = model.solve(np.linspace(0, 4000, 401))
+    # one table per row: many profiles on the same compiled network
+    batch = DrivenModel(net, {'Deg_0': Input(t_meas, deg_profiles)})
+    ys = batch.solve_batch(np.linspace(0, 4000, 401), pool=worker_pool(batch.network, 8))
+"""
+from __future__ import division, print_function
+
+import numpy as np
+from scipy.integrate import solve_ivp
+from scipy.interpolate import CubicSpline
+
+import G2_M_ssa
+from G2_M_network import Network
+
+KINDS = ('step', 'linear', 'spline')
+
+
+class Input(object):
+    """Tabulated input u(t); values are 1-D or one row per profile."""
+
+    def __init__(self, t, values, kind='linear'):
+        if kind not in KINDS:
+            raise ValueError("unknown kind %r (one of %s)" % (kind, ', '.join(KINDS)))
+        self.t = np.asarray(t, dtype=float)
+        self.values = np.asarray(values, dtype=float)
+        if self.values.shape[-1] != len(self.t) or np.any(np.diff(self.t) <= 0):
+            raise ValueError("values must match strictly increasing knots")
+        if kind != 'step' and len(self.t) < 2:
+            raise ValueError("%s interpolation needs at least two knots" % kind)
+        self.kind = kind
+        self._spline = CubicSpline(self.t, self.values, axis=-1) if kind == 'spline' else None
+
+    @property
+    def n_profiles(self):
+        """Number of profiles, or None for a single 1-D table."""
+        return self.values.shape[0] if self.values.ndim == 2 else None
+
+    def profile(self, k):
+        """The single-profile Input of row k."""
+        return Input(self.t, self.values[k], self.kind) if self.values.ndim == 2 else self
+
+    def breakpoints(self):
+        """Times at which the input or its derivative may jump."""
+        return self.t if self.kind != 'spline' else self.t[[0, -1]]
+
+    def __call__(self, t):
+        tt = min(max(float(t), self.t[0]), self.t[-1])
+        if self.kind == 'step':
+            return self.values[..., max(np.searchsorted(self.t, tt, 'right') - 1, 0)]
+        if self.kind == 'spline':
+            return self._spline(tt)
+        k = min(max(np.searchsorted(self.t, tt, 'right') - 1, 0), len(self.t) - 2)
+        w = (tt - self.t[k]) / (self.t[k + 1] - self.t[k])
+        return self.values[..., k] * (1.0 - w) + self.values[..., k + 1] * w
+
+
+def rule_network(network, rules):
+    """Network whose reactions of the given rules carry a factor Input_<rule>."""
+    import sympy
+    # newer pysb records a tuple of rule names per reaction
+    origins = [rule if isinstance(rule, (tuple, list)) else (rule,) for rule in network.rules]
+    missing = [r for r in rules if not any(r in o for o in origins)]
+    if missing:
+        raise ValueError("no reactions for rules %s" % ', '.join(missing))
+    factors = dict((r, sympy.Symbol('Input_%s' % r)) for r in rules)
+    rates = []
+    for e, origin in zip(network.rate_exprs, origins):
+        for r in origin:
+            if r in factors:
+                e = e * factors[r]
+        rates.append(e)
+    return Network(network.species,
+                   list(zip(network.param_names, network.param_values.tolist())) +
+                   [('Input_%s' % r, 1.0) for r in rules],
+                   network.stoich, network.reactants, rates,
+                   [(name, dict((i, c) for i, c in enumerate(row) if c != 0))
+                    for name, row in zip(network.obs_names, network.obs_matrix)],
+                   network.initials, rules=network.rules, name='%s_driven' % network.name)
+
+
+class DrivenModel(object):
+    """A Network with some parameters or rule rates driven by Inputs.
+
+    network  -- the Network that is integrated (derived if rules are driven)
+    full     -- the original Network
+    inputs   -- {parameter or rule name: Input}
+    """
+
+    def __init__(self, network, inputs):
+        self.full = network
+        self.inputs = dict(inputs)
+        rules = sorted(name for name in self.inputs if name not in network.param_names)
+        parameters = [name for name in self.inputs if name in network.param_names]
+        used = set(str(x) for e in network.rate_exprs for x in e.free_symbols) if parameters else ()
+        inert = sorted(name for name in parameters if name not in used)
+        if inert:
+            raise ValueError("parameters %s only set initial amounts; drive the rules or rate "
+                             "parameters instead" % ', '.join(inert))
+        self.network = rule_network(network, rules) if rules else network
+        self.targets = [(self.network.param_index(name if name in network.param_names
+                                                  else 'Input_%s' % name), self.inputs[name])
+                        for name in sorted(self.inputs)]
+        counts = set(u.n_profiles for _, u in self.targets) - set([None])
+        if len(counts) > 1:
+            raise ValueError("inputs have different numbers of profiles: %s" % sorted(counts))
+        self.n_profiles = counts.pop() if counts else None
+
+    def parameter_vector(self, p=None):
+        """Parameters of self.network from a parameter vector of the full network."""
+        p = self.full.param_values if p is None else np.asarray(p, dtype=float)
+        extra = len(self.network.param_values) - len(p)
+        return np.concatenate([p, np.ones(extra)]) if extra else p.copy()
+
+    def breakpoints(self, t0, t1):
+        return _breakpoints(self.targets, t0, t1)
+
+    def solve(self, t, p=None, profile=None, y0=None, method='LSODA', rtol=1e-6, atol=1e-10):
+        """Integrate one profile (row `profile` of batched inputs); (len(t), n_species)."""
+        if self.n_profiles is not None and profile is None:
+            raise ValueError("inputs hold %d profiles; pass profile= or use solve_batch"
+                             % self.n_profiles)
+        return _solve(self.network, self._targets(profile), np.asarray(t, dtype=float),
+                      self.parameter_vector(p), y0, method, rtol, atol)
+
+    def _targets(self, profile):
+        return [(i, u.profile(profile) if profile is not None else u) for i, u in self.targets]
+
+    def solve_batch(self, t, p=None, pool=None, **kwargs):
+        """solve() for every profile; (n_profiles, len(t), n_species).
+
+        pool is an optional G2_M_ssa.worker_pool(model.network), whose
+        workers hold the compiled network."""
+        if self.n_profiles is None:
+            return self.solve(t, p, **kwargs)[None]
+        if pool is None:
+            return np.array([self.solve(t, p, k, **kwargs) for k in range(self.n_profiles)])
+        q = self.parameter_vector(p)
+        tasks = [(self._targets(k), np.asarray(t, dtype=float), q, kwargs)
+                 for k in range(self.n_profiles)]
+        return np.array(pool.map(_solve_chunk, tasks))
+
+
+def _breakpoints(targets, t0, t1):
+    points = np.unique(np.concatenate([u.breakpoints() for _, u in targets] + [[t0, t1]]))
+    return points[(points >= t0) & (points <= t1)]
+
+
+def _solve(network, targets, t, p, y0=None, method='LSODA', rtol=1e-6, atol=1e-10):
+    """Piecewise integration between the breakpoints of the inputs."""
+    p = p.copy()
+
+    def at(time):
+        for i, u in targets:
+            p[i] = u(time)
+        return p
+
+    def rhs(time, y):
+        return network.rhs(y, at(time))
+
+    def jac(time, y):
+        return network.jacobian(y, at(time))
+
+    y = network.initial_state(at(t[0])) if y0 is None else np.asarray(y0, dtype=float)
+    out = np.empty((len(t), network.n_species))
+    out[0] = y
+    edges = _breakpoints(targets, t[0], t[-1])
+    for a, b in zip(edges[:-1], edges[1:]):
+        inside = (t > a) & (t <= b)
+        points = np.union1d(t[inside], [b])
+        sol = solve_ivp(rhs, (a, b), y, method=method, t_eval=points, rtol=rtol, atol=atol,
+                        jac=jac if method not in ('RK45', 'RK23', 'DOP853') else None)
+        if not sol.success:
+            raise RuntimeError("%s failed on [%g, %g]: %s" % (method, a, b, sol.message))
+        out[inside] = sol.y.T[np.isin(points, t[inside])]
+        y = sol.y[:, -1]
+    return out
+
+
+def _solve_chunk(args):
+    targets, t, p, kwargs = args
+    return _solve(G2_M_ssa.worker_network(), targets, t, p, **kwargs)
@@ -0,0 +1,133 @@
+"""Chemical Langevin and linear noise approximations for intermediate volumes.
+
+G2_M_v2_conc2num.py rescales every rate constant with set_volume(1.0e-20)
+and then has to choose between odesolve (no noise) and run_ssa (exact, but
+slow at thousands of copies).  In between, both approximations here work
+from the network's stoichiometry and rate laws directly: with the system size
+Omega = N_A * volume, a reaction with macroscopic rate v(x) in concentration
+units has propensity Omega * v(n / Omega) in copy numbers.  That holds for
+the Hill and Michaelis-Menten style expressions of declare_functions() as
+well as for mass action, so no per-parameter rescaling is needed.
+
+    stats = simulate(net, t, 1.0e-20, method='lna', p=net.parameter_array(DDS_0=0.005))
+    stats['OBS_MPF']['mean'], stats['OBS_MPF']['var']     # copy numbers
+
+method='cle' integrates an ensemble of chemical Langevin paths instead and
+'ode' returns the deterministic mean with zero variance.
+"""
+from __future__ import division, print_function
+
+import numpy as np
+from scipy import constants
+from scipy.integrate import solve_ivp
+
+METHODS = ('ode', 'lna', 'cle')
+
+
+def system_size(volume):
+    """Omega: molecules per concentration unit for the given volume (litres)."""
+    return constants.N_A * volume
+
+
+def observable_rows(network, observables):
+    """Names and sparse projection rows of the requested observables."""
+    projection = network.projection(observables)
+    return projection.names, projection.matrix
+
+
+def lna(network, t, volume, p=None, observables=None, rtol=1e-6, atol=1e-12):
+    """Linear noise approximation: macroscopic mean plus covariance ODE.
+
+    dSigma/dt = J Sigma + Sigma J^T + S diag(v) S^T / Omega in concentration
+    units, integrated together with the rate equations.  Returns
+    {observable: {'mean', 'var'}} in copy numbers."""
+    p = network.param_values if p is None else np.asarray(p, dtype=float)
+    omega = system_size(volume)
+    n = network.n_species
+    stoich = network.stoich
+
+    def rhs(_t, z):
+        x = z[:n]
+        sigma = z[n:].reshape(n, n)
+        jac = network.jacobian(x, p)
+        v = np.maximum(network.rates(x, p), 0.0)
+        diffusion = (stoich * v).dot(stoich.T) / omega
+        dsigma = jac.dot(sigma) + sigma.dot(jac.T) + diffusion
+        return np.concatenate([network.rhs(x, p), dsigma.ravel()])
+
+    def jac(_t, z):
+        # block-diagonal approximation: the solver only needs it for Newton steps
+        j = network.jacobian(z[:n], p)
+        eye = np.eye(n)
+        out = np.zeros((n + n * n, n + n * n))
+        out[:n, :n] = j
+        out[n:, n:] = np.kron(j, eye) + np.kron(eye, j)
+        return out
+
+    z0 = np.concatenate([network.initial_state(p), np.zeros(n * n)])
+    sol = solve_ivp(rhs, (t[0], t[-1]), z0, method='LSODA', t_eval=t, jac=jac,
+                    rtol=rtol, atol=atol)
+    if not sol.success:
+        raise RuntimeError("LNA integration failed: %s" % sol.message)
+    names, rows = observable_rows(network, observables)
+    x = sol.y[:n]
+    sigma = sol.y[n:].reshape(n, n, -1)
+    mean = omega * rows.dot(x)
+    dense = rows.toarray()
+    var = omega ** 2 * np.einsum('ki,ijt,kj->kt', dense, sigma, dense)
+    return dict((name, {'mean': mean[k], 'var': var[k]}) for k, name in enumerate(names))
+
+
+def cle(network, t, volume, p=None, n_paths=1000, dt=None, observables=None, seed=None):
+    """Ensemble of chemical Langevin paths, returned as copy-number observables.
+
+    Each path follows dx = S v(x) dt + S sqrt(v(x) / Omega) dW in concentration
+    units.  The drift is treated linearly implicitly (as in
+    G2_M_network.batch_step) so the step is not limited by the fast 14-3-3
+    and Chk1 reactions; negative excursions are clipped to zero.  Returns
+    {observable: {'mean', 'var', 'paths'}} with paths of shape
+    (len(t), n_paths)."""
+    p = network.param_values if p is None else np.asarray(p, dtype=float)
+    rng = np.random.RandomState(seed)
+    omega = system_size(volume)
+    dt = (t[1] - t[0]) if dt is None else dt
+    names, rows = observable_rows(network, observables)
+    pp = np.tile(p[:, None], (1, n_paths))
+    x = np.tile(network.initial_state(p)[:, None], (1, n_paths))
+    eye = np.eye(network.n_species)
+    out = np.zeros((rows.shape[0], len(t), n_paths))
+    out[:, 0] = rows.dot(x)
+    tc = t[0]
+    for k in range(1, len(t)):
+        while tc < t[k] - 1e-12 * dt:
+            h = min(dt, t[k] - tc)
+            v = np.maximum(network.rates(x, pp), 0.0)
+            noise = network.stoich.dot(np.sqrt(v * h / omega) *
+                                       rng.standard_normal(v.shape))
+            increment = h * network.stoich.dot(v) + noise
+            a = eye - h * network.jacobian(x, pp)
+            dx = np.linalg.solve(a, increment.T[..., None])[..., 0].T
+            x = np.maximum(x + dx, 0.0)
+            tc += h
+        out[:, k] = rows.dot(x)
+    out *= omega
+    return dict((name, {'mean': out[i].mean(axis=1), 'var': out[i].var(axis=1, ddof=1),
+                        'paths': out[i]})
+                for i, name in enumerate(names))
+
+
+def simulate(network, t, volume, method='lna', p=None, observables=('OBS_MPF', 'OBS_p53'), **kwargs):
+    """Noise statistics of the observables with the selected approximation."""
+    if method == 'lna':
+        return lna(network, t, volume, p, observables, **kwargs)
+    if method == 'cle':
+        return cle(network, t, volume, p, observables=observables, **kwargs)
+    if method == 'ode':
+        from G2_M_solvers import solve
+        omega = system_size(volume)
+        y = solve(network, t, p, **kwargs)
+        names, rows = observable_rows(network, observables)
+        mean = omega * rows.dot(y.T)
+        return dict((name, {'mean': mean[k], 'var': np.zeros(len(t))})
+                    for k, name in enumerate(names))
+    raise ValueError("method must be one of %s" % (METHODS,))
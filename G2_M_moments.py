@@ -0,0 +1,179 @@
+"""Moment-closure equations for the means and covariances of G2_M species.
+
+Variability studies of OBS_p53, OBS_Mdm2 and OBS_MPF only need the first two
+moments, which otherwise come from thousands of run_ssa trajectories.
+MomentEquations derives the mean and covariance ODEs from the network's
+stoichiometry and rate laws.  Rate laws that are not polynomial, such as the
+Hill term of create_Mdm2 or create_preMPF = k9/(1 + k31*OBS_p53), are
+expanded to second order about the mean:
+
+    E[v_r(X)]            ~ v_r(mu) + 1/2 sum_kl H_rkl C_kl
+    E[(X_j - mu_j) v_r]  ~ sum_k G_rk C_jk + 1/2 sum_kl H_rkl T_jkl
+
+where G and H are the gradient and Hessian of v_r and T holds the third
+central moments supplied by the closure: 'mean_field' (also drops the
+Hessian terms, i.e. the linear noise approximation), 'normal' (T = 0) or
+'lognormal'.  Gradients and Hessians are compiled with sympy.lambdify the
+same way as the network's rates and Jacobian.  Units follow G2_M_langevin:
+concentrations internally, copy numbers for Omega = N_A * volume in the
+results.
+
+    stats = moments(net, t, 1.0e-20, p=net.parameter_array(DDS_0=0.005), closure='normal')
+    stats['OBS_p53']['mean'], stats['OBS_p53']['var']
+"""
+from __future__ import division, print_function
+
+import numpy as np
+import sympy
+from scipy.integrate import solve_ivp
+
+from G2_M_langevin import system_size
+
+CLOSURES = ('mean_field', 'normal', 'lognormal')
+
+
+def third_central_moments(mu, cov, closure):
+    """T_jkl = E[(X_j - mu_j)(X_k - mu_k)(X_l - mu_l)] under the closure."""
+    n = len(mu)
+    if closure in ('mean_field', 'normal'):
+        return np.zeros((n, n, n))
+    # lognormal: M_jkl = M_jk M_kl M_jl / (mu_j mu_k mu_l) for raw moments M;
+    # species at zero mean have no lognormal fit and fall back to T = 0
+    positive = mu > 1e-12 * max(np.abs(mu).max(), 1e-300)
+    m = np.where(positive, mu, 1.0)
+    raw2 = cov + np.outer(mu, mu)
+    raw3 = (raw2[:, :, None] * raw2[None, :, :] * raw2[:, None, :] /
+            (m[:, None, None] * m[None, :, None] * m[None, None, :]))
+    third = (raw3
+             - mu[:, None, None] * raw2[None, :, :]
+             - mu[None, :, None] * raw2[:, None, :]
+             - mu[None, None, :] * raw2[:, :, None]
+             + 2.0 * mu[:, None, None] * mu[None, :, None] * mu[None, None, :])
+    mask = positive[:, None, None] & positive[None, :, None] & positive[None, None, :]
+    return np.where(mask, third, 0.0)
+
+
+class MomentEquations(object):
+    """Closed mean/covariance ODEs for a Network at a given volume."""
+
+    def __init__(self, network, volume, closure='normal'):
+        if closure not in CLOSURES:
+            raise ValueError("closure must be one of %s" % (CLOSURES,))
+        self.network = network
+        self.omega = system_size(volume)
+        self.closure = closure
+        n = network.n_species
+        index = dict((s, i) for i, s in enumerate(network.y_symbols))
+        grad, hess = [], []
+        for r, expr in enumerate(network.rate_exprs):
+            deps = sorted(index[s] for s in expr.free_symbols if s in index)
+            for a, k in enumerate(deps):
+                dk = sympy.diff(expr, network.y_symbols[k])
+                if dk == 0:
+                    continue
+                grad.append((r, k, dk))
+                for l in deps[a:]:
+                    dkl = sympy.diff(dk, network.y_symbols[l])
+                    if dkl != 0:
+                        hess.append((r, k, l, dkl))
+        self._grad = grad
+        self._hess = hess
+        args = [network.y_symbols, network.p_symbols]
+        self._grad_fn = sympy.lambdify(args, [g[2] for g in grad], modules='numpy')
+        self._hess_fn = sympy.lambdify(args, [h[3] for h in hess], modules='numpy')
+        self.n = n
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_grad_fn'] = state['_hess_fn'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        args = [self.network.y_symbols, self.network.p_symbols]
+        self._grad_fn = sympy.lambdify(args, [g[2] for g in self._grad], modules='numpy')
+        self._hess_fn = sympy.lambdify(args, [h[3] for h in self._hess], modules='numpy')
+
+    def _derivatives(self, mu, p):
+        nr = self.network.n_reactions
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gv = np.array(self._grad_fn(mu, p), dtype=float)
+            hv = np.array(self._hess_fn(mu, p), dtype=float)
+        # derivatives of the Hill terms are 0/0 at zero concentration
+        gv[~np.isfinite(gv)] = 0.0
+        hv[~np.isfinite(hv)] = 0.0
+        g = np.zeros((nr, self.n))
+        if len(self._grad):
+            g[[e[0] for e in self._grad], [e[1] for e in self._grad]] = gv
+        h = np.zeros((nr, self.n, self.n))
+        if len(self._hess):
+            r, k, l = ([e[i] for e in self._hess] for i in range(3))
+            h[r, k, l] = hv
+            h[r, l, k] = hv
+        return g, h
+
+    def split(self, z):
+        n = self.n
+        return z[:n], z[n:].reshape(n, n)
+
+    def rhs(self, _t, z, p):
+        net = self.network
+        mu, cov = self.split(z)
+        g, h = self._derivatives(mu, p)
+        v = net.rates(mu, p)
+        s = net.stoich
+        jac = s.dot(g)
+        # written as J C + C J^T so that the Kronecker Jacobian below matches
+        dcov = jac.dot(cov) + cov.dot(jac.T)
+        if self.closure == 'mean_field':
+            ev = v
+        else:
+            ev = v + 0.5 * np.einsum('rkl,kl->r', h, cov)
+            if self.closure != 'normal':
+                skew = 0.5 * np.einsum('rkl,jkl->jr', h,
+                                       third_central_moments(mu, cov, self.closure))
+                dcov += s.dot(skew.T) + skew.dot(s.T)
+        dmu = s.dot(ev)
+        dcov += (s * np.maximum(ev, 0.0)).dot(s.T) / self.omega
+        return np.concatenate([dmu, dcov.ravel()])
+
+    def jacobian(self, _t, z, p):
+        """Block-diagonal approximation used for the implicit solver's Newton steps."""
+        mu, _ = self.split(z)
+        j = self.network.jacobian(mu, p)
+        eye = np.eye(self.n)
+        out = np.zeros((self.n * (self.n + 1),) * 2)
+        out[:self.n, :self.n] = j
+        out[self.n:, self.n:] = np.kron(j, eye) + np.kron(eye, j)
+        return out
+
+    def solve(self, t, p=None, rtol=1e-6, atol=1e-12):
+        """Integrate from the deterministic initial state (zero covariance).
+
+        Returns (mean, cov) with shapes (len(t), n) and (len(t), n, n) in
+        concentration units."""
+        p = self.network.param_values if p is None else np.asarray(p, dtype=float)
+        z0 = np.concatenate([self.network.initial_state(p), np.zeros(self.n * self.n)])
+        sol = solve_ivp(self.rhs, (t[0], t[-1]), z0, method='LSODA', t_eval=t,
+                        jac=self.jacobian, args=(p,), rtol=rtol, atol=atol)
+        if not sol.success:
+            raise RuntimeError("Moment integration failed: %s" % sol.message)
+        mean = sol.y[:self.n].T
+        cov = sol.y[self.n:].T.reshape(len(t), self.n, self.n)
+        return mean, 0.5 * (cov + cov.transpose(0, 2, 1))
+
+
+def moments(network, t, volume, p=None, closure='normal',
+            observables=('OBS_p53', 'OBS_Mdm2', 'OBS_MPF'), equations=None):
+    """Mean and variance of observables in copy numbers from one moment solve.
+
+    Pass equations (a MomentEquations) to reuse the compiled derivatives
+    across a parameter screen."""
+    eq = MomentEquations(network, volume, closure) if equations is None else equations
+    mean, cov = eq.solve(t, p)
+    result = {}
+    for name in observables:
+        row = network.obs_matrix[network.obs_index(name)]
+        result[name] = {'mean': eq.omega * mean.dot(row),
+                        'var': eq.omega ** 2 * np.einsum('i,tij,j->t', row, cov, row)}
+    return result
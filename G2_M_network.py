@@ -0,0 +1,468 @@
+"""Numerical view of a generated G2_M reaction network.
+
+The model files build the network with pysb/BNG; everything downstream of
+generate_equations() only needs the species, the stoichiometry, the rate laws
+and the observables.  Network keeps those as numpy arrays and sympy
+expressions and compiles vectorised rate/RHS/Jacobian functions from them, so
+one set of rate laws can be evaluated for a single cell or for a batch of
+cells (columns) with per-cell parameter values.
+
+    from G2_M_network import load_variant, Network
+    net = Network.from_model(load_variant('v1'))
+    p = net.parameter_array(DDS_0=0.005)
+    y = net.odeint(linspace(0, 4000, 4000), p=p)
+
+Observables are a sparse species-to-observable matrix; projection() selects
+just the observables and species a caller needs, and odeint(...,
+observables=[...]) or lazy_observables(y) avoid computing the others.
+"""
+from __future__ import division
+
+import importlib
+
+import numpy as np
+
+# Model variants in this repository, by short name
+VARIANTS = {
+    'OLD': 'G2_M_OLD',
+    'v1': 'G2_M_v1',
+    'v2': 'G2_M_v2',
+    'ssa_params': 'G2_M_v2_ssa_params',
+}
+
+_loaded = {}
+
+
+def load_variant(name, generate=True):
+    """Import a model variant and run its declare_*() functions.
+
+    Every variant calls Model() at import time, so the pysb SelfExporter is
+    pointed back at the variant's own model before declaring components.
+    Models are cached per process because the declare functions can only run
+    once per Model.  generate=False skips BNG network generation for callers
+    that work on the rules directly."""
+    from pysb.bng import generate_equations
+    if name in _loaded:
+        model = _loaded[name]
+        if generate and not model.reactions:
+            generate_equations(model)
+        return model
+    from pysb.core import SelfExporter
+    module = importlib.import_module(VARIANTS.get(name, name))
+    if getattr(module, 'model', None) is None:
+        raise ValueError("Variant %r does not define a Model" % name)
+    SelfExporter.default_model = module.model
+    SelfExporter.target_globals = vars(module)
+    SelfExporter.target_module = module
+    module.declare_monomers()
+    module.declare_parameters()
+    module.declare_initial_conditions()
+    module.declare_observables()
+    module.declare_functions()
+    module.declare_rules()
+    if generate:
+        generate_equations(module.model)
+    _loaded[name] = module.model
+    return module.model
+
+
+def species_symbol(i):
+    import sympy
+    return sympy.Symbol('y_%d' % i)
+
+
+def _broadcast(values, shape):
+    """Stack lambdify output (scalars mixed with arrays) into one array."""
+    return np.array([np.broadcast_to(np.asarray(v, dtype=float), shape) for v in values])
+
+
+class Projection(object):
+    """Selected observables and species of a Network as one sparse map.
+
+    matrix has one row per name (observables first, then species) and is
+    applied to states with species along the first axis in a single sparse
+    product, so unrequested observables are never computed."""
+
+    def __init__(self, matrix, names):
+        self.matrix = matrix
+        self.names = list(names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __call__(self, y):
+        y = np.asarray(y, dtype=float)
+        out = self.matrix.dot(y.reshape(y.shape[0], -1))
+        return np.asarray(out).reshape((len(self.names),) + y.shape[1:])
+
+    def record(self, y):
+        """Record array with one field per name for a (time, species) trajectory."""
+        return np.rec.fromarrays(list(self(np.asarray(y).T)), names=self.names)
+
+
+class LazyObservables(object):
+    """Observables and species of a stored (time, species) trajectory.
+
+    Indexing by name (y['OBS_MPF'], as with odesolve output) computes that
+    observable on first access only."""
+
+    def __init__(self, network, y):
+        self.network = network
+        self.y = np.asarray(y)
+        self._values = {}
+
+    def keys(self):
+        return list(self.network.obs_names)
+
+    def __contains__(self, name):
+        return name in self.network.obs_names or name in self.network.species
+
+    def __getitem__(self, name):
+        if name not in self._values:
+            if name in self.network.obs_names:
+                projection = self.network.projection([name])
+            else:
+                projection = self.network.projection([], [name])
+            self._values[name] = projection(self.y.T)[0]
+        return self._values[name]
+
+
+class Network(object):
+    """Species, reactions, rate laws and observables of a reaction network.
+
+    species      -- species names, index i is state variable y_i
+    parameters   -- list of (name, default value)
+    stoich       -- (n_species, n_reactions) net stoichiometry
+    reactants    -- per reaction, list of reactant species indices (with repeats)
+    rate_exprs   -- per reaction, sympy rate law in y_i and parameter symbols
+                    (strings are sympified on first use)
+    observables  -- list of (name, {species index: coefficient})
+    initials     -- list of (species index, parameter name)
+    rules        -- per reaction, name of the rule that generated it
+    precompiled  -- generated numpy source of the compiled functions and
+                    their index data (see G2_M_bundle); sympy is only
+                    imported for what is not in here
+    """
+
+    def __init__(self, species, parameters, stoich, reactants, rate_exprs,
+                 observables, initials, rules=None, name=None, precompiled=None):
+        self.name = name
+        self.species = list(species)
+        self.param_names = [p[0] for p in parameters]
+        self.param_values = np.array([p[1] for p in parameters], dtype=float)
+        self.stoich = np.asarray(stoich, dtype=float)
+        self.reactants = [list(r) for r in reactants]
+        self._rate_exprs = list(rate_exprs)
+        self.obs_names = [o[0] for o in observables]
+        self.obs_matrix = np.zeros((len(observables), len(self.species)))
+        for k, (_, coefficients) in enumerate(observables):
+            for i, c in coefficients.items():
+                self.obs_matrix[k, i] = c
+        self.initials = list(initials)
+        self.rules = list(rules) if rules is not None else [None] * len(self._rate_exprs)
+        self.precompiled = dict(precompiled or {})
+        self._compiled = {}
+
+    @classmethod
+    def from_model(cls, model):
+        """Build a Network from a pysb model with generated equations."""
+        if not model.reactions:
+            from pysb.bng import generate_equations
+            generate_equations(model)
+        n = len(model.species)
+        observables = []
+        for obs in model.observables:
+            observables.append((obs.name, dict(zip(obs.species, obs.coefficients))))
+        obs_exprs = dict((name, sum(c * species_symbol(i) for i, c in coef.items()))
+                         for name, coef in observables)
+        expr_exprs = dict((e.name, e.expr) for e in model.expressions)
+        param_names = set(p.name for p in model.parameters)
+        import sympy
+
+        def expand(expr):
+            subs = {}
+            for sym in expr.free_symbols:
+                name = str(sym)
+                if name.startswith('__s'):
+                    subs[sym] = species_symbol(int(name[3:]))
+                elif name in expr_exprs:
+                    subs[sym] = expand(sympify_expr(expr_exprs[name]))
+                elif name in obs_exprs:
+                    subs[sym] = obs_exprs[name]
+                elif name in param_names:
+                    subs[sym] = sympy.Symbol(name)
+            return expr.xreplace(subs)
+
+        stoich = np.zeros((n, len(model.reactions)))
+        reactants, rates, rules = [], [], []
+        for j, rxn in enumerate(model.reactions):
+            for i in rxn['reactants']:
+                stoich[i, j] -= 1
+            for i in rxn['products']:
+                stoich[i, j] += 1
+            reactants.append(list(rxn['reactants']))
+            rates.append(expand(sympify_expr(rxn['rate'])))
+            rules.append(rxn['rule'])
+        initials = [(model.get_species_index(cp), param.name)
+                    for cp, param in model.initial_conditions]
+        return cls([str(s) for s in model.species],
+                   [(p.name, p.value) for p in model.parameters],
+                   stoich, reactants, rates, observables, initials,
+                   rules=rules, name=model.name)
+
+    def __getstate__(self):
+        # lambdified functions do not pickle; workers recompile on demand
+        state = self.__dict__.copy()
+        state['_compiled'] = {}
+        return state
+
+    @property
+    def n_species(self):
+        return len(self.species)
+
+    @property
+    def n_reactions(self):
+        return len(self._rate_exprs)
+
+    # ***Symbolic view (imports sympy)***
+
+    @property
+    def y_symbols(self):
+        if 'y_symbols' not in self._compiled:
+            self._compiled['y_symbols'] = [species_symbol(i) for i in range(self.n_species)]
+        return self._compiled['y_symbols']
+
+    @property
+    def p_symbols(self):
+        if 'p_symbols' not in self._compiled:
+            import sympy
+            self._compiled['p_symbols'] = [sympy.Symbol(n) for n in self.param_names]
+        return self._compiled['p_symbols']
+
+    @property
+    def rate_exprs(self):
+        if any(isinstance(e, str) for e in self._rate_exprs):
+            import sympy
+            names = dict((str(s), s) for s in self.y_symbols + self.p_symbols)
+            self._rate_exprs = [sympy.sympify(e, locals=names) if isinstance(e, str) else e
+                                for e in self._rate_exprs]
+        return self._rate_exprs
+
+    # ***Parameters and initial state***
+
+    def param_index(self, name):
+        return self.param_names.index(name)
+
+    def obs_index(self, name):
+        return self.obs_names.index(name)
+
+    def parameter_array(self, n=None, **values):
+        """Default parameter vector with overrides, tiled to n columns if given."""
+        p = self.param_values.copy()
+        for name, value in values.items():
+            p[self.param_index(name)] = value
+        if n is not None:
+            p = np.tile(p[:, None], (1, n))
+        return p
+
+    def initial_state(self, p=None):
+        """Initial species vector (or columns) from the initial-condition parameters."""
+        p = self.param_values if p is None else np.asarray(p, dtype=float)
+        y0 = np.zeros((self.n_species,) + p.shape[1:])
+        for i, name in self.initials:
+            y0[i] = p[self.param_index(name)]
+        return y0
+
+    # ***Compiled functions***
+
+    def _lambdify(self, key, exprs):
+        """Compiled function f(y, p) for key; exprs() supplies the expressions.
+
+        Precompiled source is executed instead of calling sympy when present."""
+        if key not in self._compiled:
+            if key in self.precompiled:
+                namespace = {'numpy': np}
+                exec(compile(self.precompiled[key], '<%s %s>' % (self.name, key), 'exec'),
+                     namespace)
+                self._compiled[key] = namespace['f']
+            else:
+                import sympy
+                self._compiled[key] = sympy.lambdify([self.y_symbols, self.p_symbols],
+                                                     exprs(), modules='numpy')
+        return self._compiled[key]
+
+    def _rate_dependencies(self):
+        """Species indices each rate law depends on."""
+        if 'deps' in self.precompiled:
+            return self.precompiled['deps']
+        if 'deps' not in self._compiled:
+            index = dict((s, i) for i, s in enumerate(self.y_symbols))
+            self._compiled['deps'] = [sorted(index[s] for s in e.free_symbols if s in index)
+                                      for e in self.rate_exprs]
+        return self._compiled['deps']
+
+    def jacobian_sparsity(self):
+        """Structural pattern of d(rhs)/dy from the reaction network alone.
+
+        Entry (i, j) is set when some reaction changes species i and has a
+        rate that depends on species j, so the pattern costs O(reactions)
+        and needs no differentiation."""
+        from scipy.sparse import csc_matrix
+        if 'sparsity' not in self._compiled:
+            stoich = self.stoich_csc()
+            rows, cols = [], []
+            for r, deps in enumerate(self._rate_dependencies()):
+                affected = stoich.indices[stoich.indptr[r]:stoich.indptr[r + 1]]
+                for j in deps:
+                    rows.extend(affected)
+                    cols.extend([j] * len(affected))
+            pattern = csc_matrix((np.ones(len(rows), dtype=bool), (rows, cols)),
+                                 shape=(self.n_species, self.n_species))
+            pattern.sum_duplicates()
+            self._compiled['sparsity'] = pattern
+        return self._compiled['sparsity']
+
+    def stoich_csc(self):
+        from scipy.sparse import csc_matrix
+        if 'stoich' not in self._compiled:
+            self._compiled['stoich'] = csc_matrix(self.stoich)
+        return self._compiled['stoich']
+
+    def jacobian_entries(self):
+        """Structurally non-zero d(rhs_i)/d(y_j) as a list of (i, j, expr)."""
+        if 'jac_entries' not in self._compiled:
+            import sympy
+            stoich = self.stoich_csc()
+            entries = {}
+            for r, deps in enumerate(self._rate_dependencies()):
+                lo, hi = stoich.indptr[r], stoich.indptr[r + 1]
+                for j in deps:
+                    d = sympy.diff(self.rate_exprs[r], self.y_symbols[j])
+                    for i, nu in zip(stoich.indices[lo:hi], stoich.data[lo:hi]):
+                        entries[i, j] = entries.get((i, j), 0) + nu * d
+            self._compiled['jac_entries'] = [(i, j, d) for (i, j), d in sorted(entries.items())
+                                             if d != 0]
+        return self._compiled['jac_entries']
+
+    def _jacobian_index(self):
+        """Row and column indices of jacobian_entries()."""
+        if 'jac_index' in self.precompiled:
+            return self.precompiled['jac_index']
+        if 'jac_index' not in self._compiled:
+            entries = self.jacobian_entries()
+            self._compiled['jac_index'] = ([e[0] for e in entries], [e[1] for e in entries])
+        return self._compiled['jac_index']
+
+    def rates(self, y, p=None):
+        """Reaction rates for state y; columns of y and p are independent cells."""
+        p = self.param_values if p is None else p
+        y = np.asarray(y, dtype=float)
+        return _broadcast(self._lambdify('rates', lambda: self.rate_exprs)(y, p), y.shape[1:])
+
+    def rhs(self, y, p=None):
+        return self.stoich_csc().dot(self.rates(y, p))
+
+    def _jacobian_values(self, y, p):
+        p = self.param_values if p is None else p
+        y = np.asarray(y, dtype=float)
+        rows, cols = self._jacobian_index()
+        jac = self._lambdify('jac', lambda: [e[2] for e in self.jacobian_entries()])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = _broadcast(jac(y, p), y.shape[1:])
+        # d/dy of the Hill term comes out as y**n/y, which is 0/0 at y = 0
+        values[~np.isfinite(values)] = 0.0
+        return rows, cols, values
+
+    def jacobian(self, y, p=None):
+        """Jacobian of the RHS, shape (n, n) or (batch, n, n) for column batches."""
+        rows, cols, values = self._jacobian_values(y, p)
+        jac = np.zeros(np.shape(y)[1:] + (self.n_species, self.n_species))
+        jac[..., rows, cols] = np.moveaxis(values, 0, -1)
+        return jac
+
+    def sparse_jacobian(self, y, p=None):
+        """Jacobian of the RHS at a single state as a scipy CSC matrix."""
+        from scipy.sparse import csc_matrix
+        rows, cols, values = self._jacobian_values(y, p)
+        return csc_matrix((values, (rows, cols)), shape=(self.n_species, self.n_species))
+
+    def batch_sparse_jacobian(self, y, p=None):
+        """Block-diagonal CSC Jacobian of a column batch y (n_species, batch).
+
+        Rows and columns follow y.ravel(): species i of cell b is entry
+        i * batch + b."""
+        from scipy.sparse import csc_matrix
+        y = np.asarray(y, dtype=float)
+        m = y.shape[1]
+        rows, cols, values = self._jacobian_values(y, p)
+        offset = np.arange(m)
+        rows = (np.asarray(rows, dtype=int)[:, None] * m + offset).ravel()
+        cols = (np.asarray(cols, dtype=int)[:, None] * m + offset).ravel()
+        size = self.n_species * m
+        return csc_matrix((values.ravel(), (rows, cols)), shape=(size, size))
+
+    def projection(self, observables=None, species=()):
+        """Projection onto the named observables (all by default) and species.
+
+        Species are given by name or index and come out after the
+        observables, as their own rows."""
+        from scipy.sparse import csr_matrix, vstack
+        names = self.obs_names if observables is None else list(observables)
+        key = ('projection', tuple(names), tuple(species))
+        if key not in self._compiled:
+            if 'obs_csr' not in self._compiled:
+                self._compiled['obs_csr'] = csr_matrix(self.obs_matrix)
+            index = [s if isinstance(s, (int, np.integer)) else self.species.index(s)
+                     for s in species]
+            blocks = [self._compiled['obs_csr'][[self.obs_index(n) for n in names]]]
+            if index:
+                blocks.append(csr_matrix((np.ones(len(index)), (np.arange(len(index)), index)),
+                                         shape=(len(index), self.n_species)))
+            labels = names + [self.species[i] for i in index]
+            self._compiled[key] = Projection(vstack(blocks, format='csr'), labels)
+        return self._compiled[key]
+
+    def observe(self, y, names=None):
+        """Observable values for states y (species along the first axis)."""
+        return self.projection(names)(y)
+
+    def lazy_observables(self, y):
+        """Per-observable lazy view of a (time, species) trajectory."""
+        return LazyObservables(self, y)
+
+    # ***Integration***
+
+    def odeint(self, t, y0=None, p=None, rtol=1e-6, atol=1e-12, observables=None,
+               species=None, **kwargs):
+        """Integrate one trajectory; returns (len(t), n_species) species values.
+
+        With observables and/or species, returns only those as a record
+        array (fields by name, like odesolve)."""
+        from scipy.integrate import odeint
+        p = self.param_values if p is None else np.asarray(p, dtype=float)
+        y0 = self.initial_state(p) if y0 is None else y0
+        y = odeint(lambda y, _t: self.rhs(y, p), y0, t,
+                   Dfun=lambda y, _t: self.jacobian(y, p),
+                   rtol=rtol, atol=atol, **kwargs)
+        if observables is None and species is None:
+            return y
+        return self.projection(observables or [], species or ()).record(y)
+
+
+def sympify_expr(expr):
+    """Expression and rate objects may be pysb components or plain strings."""
+    import sympy
+    return expr if isinstance(expr, sympy.Basic) else sympy.sympify(expr)
+
+
+def batch_step(network, y, p, dt):
+    """One linearly implicit (Rosenbrock-Euler) step for a batch of cells.
+
+    y is (n_species, batch) and p is (n_params, batch).  Each cell solves its
+    own (I - dt*J) system, which keeps the step stable for the fast 14-3-3 and
+    Chk1 reactions at step sizes set by the slow dynamics."""
+    f = network.rhs(y, p)
+    jac = network.jacobian(y, p)
+    a = np.eye(network.n_species) - dt * jac
+    dy = np.linalg.solve(a, (dt * f).T[..., None])[..., 0].T
+    return np.maximum(y + dy, 0.0)
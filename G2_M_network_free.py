@@ -0,0 +1,519 @@
+"""Network-free stochastic simulation directly on the rules.
+
+G2_M_v2 splits MPF into CycB(c) % CDK1_nuc(phos, b, c) complexes that bind
+p21(b), and the commented-out Cdc25(state1=['A', 'C']) isoforms would add
+more sites.  Every extra site multiplies the species BNG has to enumerate.
+Here molecules are explicit agents with site states and bonds, and the rules
+are applied to the molecule graph without ever generating species:
+
+  patterns   every reactant and observable ComplexPattern becomes a
+             template; its embeddings in the current molecule graph are kept
+             in an index (match sets with O(1) sampling and removal)
+  firing     Gillespie selection over rules with propensity
+             rate * (number of embeddings per reactant), scaled to copy
+             numbers by Omega = N_A * volume as in G2_M_langevin; reactants
+             that turn out to share a complex give a null event
+  updates    after a rule fires only the complexes it touched are
+             re-matched, so the cost per event does not grow with the number
+             of possible species
+
+Rates that are Expressions (create_preMPF, create_Mdm2, ...) are compiled
+with sympy.lambdify over the parameters and the observable concentrations.
+
+    rules = RuleModel.from_model(load_variant('v2', generate=False))
+    sim = NetworkFreeSimulator(rules, 1.0e-21, seed=0)
+    counts = sim.run(np.linspace(0, 4000, 401))      # {observable: copies}
+
+Observables count pattern embeddings (pysb match='molecules').
+"""
+from __future__ import division, print_function
+
+import numpy as np
+import sympy
+
+from G2_M_langevin import system_size
+from G2_M_network import sympify_expr
+
+
+class _Wildcard(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+ANY = _Wildcard('ANY')    # bonded to anything
+WILD = _Wildcard('WILD')  # bonded or not
+
+
+def _wildcard(value):
+    """Map pysb.ANY / pysb.WILD (class or instance) onto the local sentinels."""
+    name = getattr(value, '__name__', None) or type(value).__name__
+    if 'ANY' in name:
+        return ANY
+    if 'WILD' in name:
+        return WILD
+    raise ValueError("Unsupported site condition %r" % (value,))
+
+
+def _condition(value):
+    if value is None or isinstance(value, (str, int)):
+        return value
+    if isinstance(value, tuple):
+        bond = value[1] if value[1] is None or isinstance(value[1], int) else _wildcard(value[1])
+        return (value[0], bond)
+    return _wildcard(value)
+
+
+def split_condition(cond):
+    """(state or None, bond constraint) of a site condition.
+
+    A bare state means unbound, as in BNG; the bond constraint is None
+    (free), an int bond label, ANY or WILD."""
+    if isinstance(cond, tuple):
+        return cond
+    if isinstance(cond, str):
+        return cond, None
+    if cond is None or isinstance(cond, int):
+        return None, cond
+    return None, cond
+
+
+def pattern_from_pysb(cp):
+    """ComplexPattern -> tuple of (monomer name, ((site, condition), ...))."""
+    return tuple((mp.monomer.name,
+                  tuple(sorted((s, _condition(c)) for s, c in mp.site_conditions.items())))
+                 for mp in cp.monomer_patterns)
+
+
+class RuleModel(object):
+    """Rules, patterns and rate laws of a pysb model, without species.
+
+    monomers     -- {name: (sites, {site: allowed states})}
+    parameters   -- list of (name, value)
+    observables  -- list of (name, [pattern, ...])
+    initials     -- list of (pattern, parameter name)
+    rules        -- list of (name, [reactant patterns], [product patterns],
+                    sympy rate in parameter and observable symbols);
+                    reversible rules appear as two entries
+    """
+
+    def __init__(self, monomers, parameters, observables, initials, rules, name=None):
+        self.name = name
+        self.monomers = dict(monomers)
+        self.param_names = [p[0] for p in parameters]
+        self.param_values = np.array([p[1] for p in parameters], dtype=float)
+        self.observables = list(observables)
+        self.obs_names = [o[0] for o in observables]
+        self.initials = list(initials)
+        self.rules = list(rules)
+
+    @classmethod
+    def from_model(cls, model):
+        """Build from a pysb model; generate_equations() is not needed."""
+        monomers = dict((m.name, (list(m.sites), dict(m.site_states))) for m in model.monomers)
+        obs_names = set(o.name for o in model.observables)
+        param_names = set(p.name for p in model.parameters)
+        expr_exprs = dict((e.name, e.expr) for e in model.expressions)
+
+        def expand(expr):
+            subs = {}
+            for sym in expr.free_symbols:
+                name = str(sym)
+                if name in expr_exprs:
+                    subs[sym] = expand(sympify_expr(expr_exprs[name]))
+                elif name in obs_names or name in param_names:
+                    subs[sym] = sympy.Symbol(name)
+            return expr.xreplace(subs)
+
+        def rate(component):
+            return expand(sympify_expr(component.name))
+
+        rules = []
+        for r in model.rules:
+            lhs = [pattern_from_pysb(cp) for cp in r.reactant_pattern.complex_patterns]
+            rhs = [pattern_from_pysb(cp) for cp in r.product_pattern.complex_patterns]
+            rules.append((r.name, lhs, rhs, rate(r.rate_forward)))
+            if r.is_reversible:
+                rules.append((r.name + '_reverse', rhs, lhs, rate(r.rate_reverse)))
+        observables = [(o.name, [pattern_from_pysb(cp) for cp in o.reaction_pattern.complex_patterns])
+                       for o in model.observables]
+        if hasattr(model, 'initials'):
+            initials = [(pattern_from_pysb(ic.pattern), ic.value.name) for ic in model.initials]
+        else:
+            initials = [(pattern_from_pysb(cp), p.name) for cp, p in model.initial_conditions]
+        return cls(monomers, [(p.name, p.value) for p in model.parameters],
+                   observables, initials, rules, name=model.name)
+
+
+# ***Molecule graph***
+
+class Molecule(object):
+    __slots__ = ('monomer', 'states', 'bonds')
+
+    def __init__(self, monomer, states, bonds):
+        self.monomer = monomer
+        self.states = states
+        self.bonds = bonds
+
+
+class _MatchSet(object):
+    """Embeddings of one template: O(1) add, remove and uniform sampling."""
+
+    def __init__(self):
+        self.keys = []
+        self.values = []
+        self.position = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, ids):
+        if key not in self.position:
+            self.position[key] = len(self.keys)
+            self.keys.append(key)
+            self.values.append(ids)
+
+    def remove(self, key):
+        i = self.position.pop(key, None)
+        if i is None:
+            return
+        last_key, last_value = self.keys.pop(), self.values.pop()
+        if i < len(self.keys):
+            self.keys[i], self.values[i] = last_key, last_value
+            self.position[last_key] = i
+
+    def sample(self, rng):
+        return self.values[rng.randint(len(self.values))]
+
+
+class Template(object):
+    """A connected pattern with a precomputed traversal plan from its first molecule."""
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.anchor = pattern[0][0]
+        self.conds = [dict(c) for _, c in pattern]
+        ends = {}
+        for i, conds in enumerate(self.conds):
+            for site, cond in conds.items():
+                bond = split_condition(cond)[1]
+                if isinstance(bond, int):
+                    ends.setdefault(bond, []).append((i, site))
+        # breadth-first over the bonds; each bond is followed (or, when it
+        # closes a ring, checked) exactly once
+        self.plan = []
+        seen, frontier, done = set([0]), [0], set()
+        while frontier:
+            i = frontier.pop(0)
+            for label, pair in sorted(ends.items()):
+                if len(pair) != 2 or label in done:
+                    continue
+                (a, sa), (b, sb) = pair
+                if i not in (a, b):
+                    continue
+                (x, sx), (y, sy) = pair if a == i else pair[::-1]
+                done.add(label)
+                self.plan.append((x, sx, y, sy))
+                if y not in seen:
+                    seen.add(y)
+                    frontier.append(y)
+        if len(seen) != len(pattern):
+            raise ValueError("Pattern %r is not connected" % (pattern,))
+
+    def compatible(self, mol, i):
+        if mol.monomer != self.pattern[i][0]:
+            return False
+        for site, cond in self.conds[i].items():
+            state, bond = split_condition(cond)
+            if state is not None and mol.states.get(site) != state:
+                return False
+            partner = mol.bonds.get(site)
+            if bond is None and partner is not None:
+                return False
+            if (bond is ANY or isinstance(bond, int)) and partner is None:
+                return False
+        return True
+
+    def match(self, mols, anchor):
+        """Molecule ids of the embedding rooted at anchor, or None."""
+        if not self.compatible(mols[anchor], 0):
+            return None
+        ids = [None] * len(self.pattern)
+        ids[0] = anchor
+        for i, si, j, sj in self.plan:
+            partner = mols[ids[i]].bonds.get(si)
+            if partner is None or partner[1] != sj:
+                return None
+            if ids[j] is None:
+                if partner[0] in ids or not self.compatible(mols[partner[0]], j):
+                    return None
+                ids[j] = partner[0]
+            elif ids[j] != partner[0]:
+                return None
+        return tuple(ids)
+
+
+def rule_actions(lhs, rhs):
+    """Graph edits that turn the matched reactants into the products.
+
+    References are ('r', reactant pattern, molecule) or ('n', product
+    molecule) for created molecules."""
+    reac = [(c, i, m, dict(k)) for c, pt in enumerate(lhs) for i, (m, k) in enumerate(pt)]
+    prod = [(c, i, m, dict(k)) for c, pt in enumerate(rhs) for i, (m, k) in enumerate(pt)]
+    mapping, used = {}, set()
+    for pi, (_, _, m, _) in enumerate(prod):
+        for ri, (_, _, rm, _) in enumerate(reac):
+            if ri not in used and rm == m:
+                mapping[pi] = ri
+                used.add(ri)
+                break
+    actions = []
+    for ri, (c, i, m, conds) in enumerate(reac):
+        if ri in used:
+            continue
+        whole = all(rj not in used for rj, r in enumerate(reac) if r[0] == c)
+        actions.append(('delete_complex', c, 0) if whole else ('delete', c, i))
+    actions = list(dict.fromkeys(actions))
+    labels = {}
+    for pi, (c, i, m, conds) in enumerate(prod):
+        ref = ('r',) + reac[mapping[pi]][:2] if pi in mapping else ('n', pi)
+        if pi not in mapping:
+            actions.append(('create', pi, m, conds))
+        rconds = reac[mapping[pi]][3] if pi in mapping else {}
+        for site, cond in conds.items():
+            state, bond = split_condition(cond)
+            rstate, rbond = split_condition(rconds.get(site, WILD))
+            if state is not None and (pi not in mapping or state != rstate):
+                actions.append(('state', ref, site, state))
+            if pi in mapping and bond is None and (rbond is ANY or isinstance(rbond, int)):
+                actions.append(('unbind', ref, site))
+            if isinstance(bond, int):
+                labels.setdefault((c, bond), []).append((ref, site, rbond))
+    for (c, _), ends in sorted(labels.items()):
+        if len(ends) != 2:
+            continue
+        (ra, sa, ba), (rb, sb, bb) = ends
+        if (ra[0] == 'r' and rb[0] == 'r' and ra[1] == rb[1] and
+                isinstance(ba, int) and ba == bb):
+            continue   # bond already present in the reactants
+        actions.append(('bind', ra, sa, rb, sb))
+    # creation first so that new molecules exist for state/bond edits
+    order = {'delete_complex': 0, 'delete': 0, 'unbind': 1, 'create': 2, 'state': 3, 'bind': 4}
+    return sorted(actions, key=lambda a: order[a[0]])
+
+
+# ***Simulator***
+
+class NetworkFreeSimulator(object):
+    """Agent-based Gillespie simulation of a RuleModel at a given volume."""
+
+    def __init__(self, rules, volume, p=None, seed=None):
+        self.model = rules
+        self.omega = system_size(volume)
+        self.rng = np.random.RandomState(seed)
+        self.p = rules.param_values.copy()
+        for name, value in (p or {}).items():
+            self.p[rules.param_names.index(name)] = value
+
+        self.templates, index = [], {}
+
+        def template(pattern):
+            if pattern not in index:
+                index[pattern] = len(self.templates)
+                self.templates.append(Template(pattern))
+            return index[pattern]
+
+        self.obs_templates = [[template(pt) for pt in pats] for _, pats in rules.observables]
+        self.rules = []
+        for name, lhs, rhs, rate in rules.rules:
+            self.rules.append({'name': name, 'reactants': [template(pt) for pt in lhs],
+                               'order': len(lhs), 'actions': rule_actions(lhs, rhs)})
+        args = [[sympy.Symbol(n) for n in rules.param_names],
+                [sympy.Symbol(n) for n in rules.obs_names]]
+        self._rate_fn = sympy.lambdify(args, [r[3] for r in rules.rules], modules='numpy')
+
+        self.mols = {}
+        self.next_id = 0
+        self.matches = [_MatchSet() for _ in self.templates]
+        self.involved = {}
+        for pattern, param in rules.initials:
+            copies = int(round(self.omega * self.p[rules.param_names.index(param)]))
+            for _ in range(copies):
+                self._instantiate(pattern)
+        self._rematch(set(self.mols))
+        self.t = 0.0
+
+    # ***Molecule graph edits***
+
+    def _new_molecule(self, monomer, conds):
+        sites, states = self.model.monomers[monomer]
+        mol = Molecule(monomer, {}, dict((s, None) for s in sites))
+        for s in sites:
+            if s in states:
+                mol.states[s] = states[s][0]
+        for site, cond in conds.items():
+            state = split_condition(cond)[0]
+            if state is not None:
+                mol.states[site] = state
+        mid = self.next_id
+        self.next_id += 1
+        self.mols[mid] = mol
+        return mid
+
+    def _bind(self, a, sa, b, sb):
+        self.mols[a].bonds[sa] = (b, sb)
+        self.mols[b].bonds[sb] = (a, sa)
+
+    def _instantiate(self, pattern):
+        ids = [self._new_molecule(m, dict(c)) for m, c in pattern]
+        ends = {}
+        for i, (_, conds) in enumerate(pattern):
+            for site, cond in conds:
+                bond = split_condition(cond)[1]
+                if isinstance(bond, int):
+                    ends.setdefault(bond, []).append((ids[i], site))
+        for pair in ends.values():
+            if len(pair) == 2:
+                self._bind(pair[0][0], pair[0][1], pair[1][0], pair[1][1])
+        return ids
+
+    def complex_of(self, mid):
+        seen, stack = set([mid]), [mid]
+        while stack:
+            for partner in self.mols[stack.pop()].bonds.values():
+                if partner is not None and partner[0] not in seen:
+                    seen.add(partner[0])
+                    stack.append(partner[0])
+        return seen
+
+    def _forget(self, mid):
+        for k, key in self.involved.pop(mid, ()):
+            self.matches[k].remove(key)
+            for other in key:
+                if other != mid and other in self.involved:
+                    self.involved[other].discard((k, key))
+
+    def _delete(self, mid):
+        mol = self.mols.pop(mid)
+        for partner in mol.bonds.values():
+            if partner is not None and partner[0] in self.mols:
+                self.mols[partner[0]].bonds[partner[1]] = None
+        self._forget(mid)
+
+    def _rematch(self, mids):
+        """Recompute every embedding that involves the given molecules."""
+        for mid in mids:
+            self._forget(mid)
+        for k, tmpl in enumerate(self.templates):
+            for mid in mids:
+                if self.mols[mid].monomer != tmpl.anchor:
+                    continue
+                ids = tmpl.match(self.mols, mid)
+                if ids is not None:
+                    key = tuple(sorted(ids))
+                    self.matches[k].add(key, ids)
+                    for x in ids:
+                        self.involved.setdefault(x, set()).add((k, key))
+
+    def _fire(self, rule, chosen):
+        touched, created = set(), {}
+
+        def resolve(ref):
+            return chosen[ref[1]][ref[2]] if ref[0] == 'r' else created[ref[1]]
+
+        for action in rule['actions']:
+            kind = action[0]
+            if kind == 'delete_complex':
+                for mid in self.complex_of(chosen[action[1]][0]):
+                    touched.update(p[0] for p in self.mols[mid].bonds.values() if p is not None)
+                    self._delete(mid)
+            elif kind == 'delete':
+                mid = chosen[action[1]][action[2]]
+                touched.update(p[0] for p in self.mols[mid].bonds.values() if p is not None)
+                self._delete(mid)
+            elif kind == 'create':
+                created[action[1]] = self._new_molecule(action[2], action[3])
+                touched.add(created[action[1]])
+            elif kind == 'state':
+                mid = resolve(action[1])
+                self.mols[mid].states[action[2]] = action[3]
+                touched.add(mid)
+            elif kind == 'unbind':
+                mid = resolve(action[1])
+                partner = self.mols[mid].bonds[action[2]]
+                if partner is not None:
+                    self.mols[partner[0]].bonds[partner[1]] = None
+                    self.mols[mid].bonds[action[2]] = None
+                    touched.update([mid, partner[0]])
+            elif kind == 'bind':
+                a, b = resolve(action[1]), resolve(action[3])
+                self._bind(a, action[2], b, action[4])
+                touched.update([a, b])
+        affected = set()
+        for mid in touched:
+            if mid in self.mols and mid not in affected:
+                affected |= self.complex_of(mid)
+        self._rematch(affected)
+
+    # ***Simulation***
+
+    def counts(self):
+        return np.array([len(m) for m in self.matches], dtype=float)
+
+    def observables(self, counts=None):
+        counts = self.counts() if counts is None else counts
+        return np.array([counts[ks].sum() if ks else 0.0 for ks in self.obs_templates])
+
+    def propensities(self):
+        counts = self.counts()
+        obs = self.observables(counts) / self.omega
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rates = np.array(self._rate_fn(self.p, obs), dtype=float)
+        rates = np.where(np.isfinite(rates), np.maximum(rates, 0.0), 0.0)
+        a = np.zeros(len(self.rules))
+        for r, rule in enumerate(self.rules):
+            # n^m / m! for m copies of one template; selections that land on
+            # the same complex are rejected as null events, which makes the
+            # effective rate per distinct pair exact
+            combos = 1.0
+            for k in set(rule['reactants']):
+                mult = rule['reactants'].count(k)
+                combos *= counts[k] ** mult / np.prod(np.arange(1, mult + 1))
+            a[r] = rates[r] * self.omega ** (1 - rule['order']) * combos
+        return a
+
+    def step(self, t_max):
+        """Fire one rule (or a null event) unless the next event is after t_max."""
+        a = self.propensities()
+        a0 = a.sum()
+        if a0 <= 0.0:
+            self.t = t_max
+            return False
+        dt = self.rng.exponential(1.0 / a0)
+        if self.t + dt > t_max:
+            self.t = t_max
+            return False
+        self.t += dt
+        r = np.searchsorted(np.cumsum(a), self.rng.uniform() * a0, side='right')
+        rule = self.rules[min(r, len(self.rules) - 1)]
+        chosen = [self.matches[k].sample(self.rng) for k in rule['reactants']]
+        if rule['order'] > 1:
+            # reactants must be distinct complexes; otherwise a null event
+            seen = set()
+            for ids in chosen:
+                cx = self.complex_of(ids[0])
+                if seen & cx:
+                    return True
+                seen |= cx
+        self._fire(rule, chosen)
+        return True
+
+    def run(self, t):
+        """Simulate to each output time; returns {observable: copy numbers}."""
+        out = np.zeros((len(self.model.obs_names), len(t)))
+        for k, tk in enumerate(t):
+            while self.t < tk:
+                self.step(tk)
+            out[:, k] = self.observables()
+        return dict(zip(self.model.obs_names, out))
@@ -0,0 +1,202 @@
+"""Streaming oscillation analytics for the p53/Mdm2 loop.
+
+Under damage p53 and Mdm2 oscillate through Create_Mdm2_Hill,
+Mdm2_Degrade_p53 and create_intermediate.  OscillationTracker consumes one
+sample per output time for a whole batch of trajectories and keeps only a
+fixed set of per-trajectory accumulators, so memory does not grow with the
+length of the run:
+
+  peaks/troughs  hysteresis detection (a peak is confirmed once the signal
+                 has fallen by the prominence), which also works on SSA copy
+                 numbers; peak times are refined by a parabola through the
+                 neighbouring samples
+  period         running mean and variance of the peak-to-peak intervals
+  damping        running least-squares fit of log(peak - trough) against
+                 the cycle number
+  phase          position in the current cycle
+
+stream() drives trackers from batched ODE steps (G2_M_network.batch_step) or
+from the G2_M_ssa engine without storing trajectories.
+
+    trackers = stream(net, np.linspace(0, 4000, 4001), net.parameter_array(256, DDS_0=0.005))
+    trackers['OBS_p53'].summary()['period']           # one value per trajectory
+"""
+from __future__ import division, print_function
+
+import numpy as np
+
+from G2_M_langevin import system_size
+from G2_M_network import batch_step
+from G2_M_ssa import advance
+
+
+class OscillationTracker(object):
+    """Constant-memory peak, period, damping and phase extraction.
+
+    prominence  -- absolute drop (rise) that confirms a peak (trough)
+    relative    -- prominence as a fraction of the candidate extremum; the
+                   larger of the two is used
+    """
+
+    def __init__(self, batch, prominence=0.0, relative=0.05):
+        self.batch = batch
+        self.prominence = prominence
+        self.relative = relative
+        self.started = False
+        nan = np.full(batch, np.nan)
+        self.rising = np.ones(batch, dtype=bool)
+        self.ext_t, self.ext_v = nan.copy(), nan.copy()
+        self.before_t, self.before_v = nan.copy(), nan.copy()
+        self.after_t, self.after_v = nan.copy(), nan.copy()
+        self.need_after = np.zeros(batch, dtype=bool)
+        self.prev_t, self.prev_v = nan.copy(), nan.copy()
+        self.last_trough = nan.copy()
+        self.n_peaks = np.zeros(batch, dtype=int)
+        self.first_peak_t, self.last_peak_t = nan.copy(), nan.copy()
+        self.last_peak_v, self.last_amplitude = nan.copy(), nan.copy()
+        # Welford accumulators of the period
+        self.n_periods = np.zeros(batch, dtype=int)
+        self.period_mean = np.zeros(batch)
+        self.period_m2 = np.zeros(batch)
+        # least-squares sums for log amplitude against cycle number
+        self.n_amp = np.zeros(batch)
+        self.sk = np.zeros(batch)
+        self.skk = np.zeros(batch)
+        self.sa = np.zeros(batch)
+        self.ska = np.zeros(batch)
+        self.t = np.nan
+
+    def _candidate(self, mask, t, v):
+        self.ext_t[mask], self.ext_v[mask] = t, v[mask]
+        self.before_t[mask], self.before_v[mask] = self.prev_t[mask], self.prev_v[mask]
+        self.after_t[mask] = self.after_v[mask] = np.nan
+        self.need_after[mask] = True
+
+    def _refined_time(self, mask):
+        """Vertex of the parabola through the candidate and its neighbours."""
+        t0, t1, t2 = self.before_t[mask], self.ext_t[mask], self.after_t[mask]
+        v0, v1, v2 = self.before_v[mask], self.ext_v[mask], self.after_v[mask]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            num = (t1 - t0) ** 2 * (v1 - v2) - (t1 - t2) ** 2 * (v1 - v0)
+            den = (t1 - t0) * (v1 - v2) - (t1 - t2) * (v1 - v0)
+            vertex = t1 - 0.5 * num / den
+        ok = np.isfinite(vertex) & (vertex >= t0) & (vertex <= t2)
+        return np.where(ok, vertex, t1)
+
+    def _peak(self, mask):
+        tp = self._refined_time(mask)
+        vp = self.ext_v[mask]
+        idx = np.nonzero(mask)[0]
+        has_prev = self.n_peaks[idx] > 0
+        if has_prev.any():
+            j = idx[has_prev]
+            period = tp[has_prev] - self.last_peak_t[j]
+            self.n_periods[j] += 1
+            delta = period - self.period_mean[j]
+            self.period_mean[j] += delta / self.n_periods[j]
+            self.period_m2[j] += delta * (period - self.period_mean[j])
+        amp = vp - self.last_trough[idx]
+        has_amp = np.isfinite(amp) & (amp > 0)
+        if has_amp.any():
+            j = idx[has_amp]
+            k, a = self.n_amp[j], np.log(amp[has_amp])
+            self.sk[j] += k
+            self.skk[j] += k * k
+            self.sa[j] += a
+            self.ska[j] += k * a
+            self.n_amp[j] += 1
+            self.last_amplitude[j] = amp[has_amp]
+        first = self.n_peaks[idx] == 0
+        self.first_peak_t[idx[first]] = tp[first]
+        self.last_peak_t[idx] = tp
+        self.last_peak_v[idx] = vp
+        self.n_peaks[idx] += 1
+
+    def update(self, t, values):
+        """Feed one sample (batch,) taken at time t."""
+        v = np.asarray(values, dtype=float)
+        self.t = t
+        if not self.started:
+            self.started = True
+            self.ext_t[:], self.ext_v[:] = t, v
+            self.prev_t[:], self.prev_v[:] = t, v
+            return
+        fill = self.need_after
+        self.after_t[fill], self.after_v[fill] = t, v[fill]
+        self.need_after[:] = False
+        band = np.maximum(self.prominence, self.relative * np.abs(self.ext_v))
+
+        up = self.rising
+        self._candidate(up & (v > self.ext_v), t, v)
+        peak = up & (v < self.ext_v - band)
+        if peak.any():
+            self._peak(peak)
+            self.rising[peak] = False
+            self._candidate(peak, t, v)
+
+        down = ~up
+        self._candidate(down & (v < self.ext_v), t, v)
+        trough = down & (v > self.ext_v + band)
+        if trough.any():
+            self.last_trough[trough] = self.ext_v[trough]
+            self.rising[trough] = True
+            self._candidate(trough, t, v)
+        self.prev_t[:], self.prev_v[:] = t, v
+
+    def summary(self):
+        """Per-trajectory oscillation measures (NaN where not defined)."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            period = np.where(self.n_periods > 0, self.period_mean, np.nan)
+            period_std = np.where(self.n_periods > 1,
+                                  np.sqrt(self.period_m2 / (self.n_periods - 1)), np.nan)
+            den = self.n_amp * self.skk - self.sk ** 2
+            slope = np.where((self.n_amp > 1) & (den > 0),
+                             (self.n_amp * self.ska - self.sk * self.sa) / den, np.nan)
+            phase = 2.0 * np.pi * np.mod((self.t - self.last_peak_t) / period, 1.0)
+        return {'n_peaks': self.n_peaks.copy(),
+                'first_peak_time': self.first_peak_t.copy(),
+                'last_peak_time': self.last_peak_t.copy(),
+                'period': period, 'period_std': period_std,
+                'amplitude': self.last_amplitude.copy(),
+                'decay_per_cycle': np.exp(slope),
+                'damping_rate': -slope / period,
+                'phase': phase}
+
+
+def stream(network, t, p=None, observables=('OBS_p53', 'OBS_Mdm2'), method='ode',
+           volume=None, n=None, substeps=10, seed=None, **tracker_args):
+    """Integrate a batch and feed every output time to one tracker per observable.
+
+    p        -- parameter columns, or one vector tiled to n trajectories
+    method   -- 'ode' (batch_step with substeps per output interval, values
+                in concentration units) or 'ssa' (copy numbers at volume)
+
+    Returns {observable: OscillationTracker}."""
+    p = network.param_values if p is None else np.asarray(p, dtype=float)
+    if p.ndim == 1:
+        p = np.tile(p[:, None], (1, n or 1))
+    batch = p.shape[1]
+    rows = network.obs_matrix[[network.obs_index(o) for o in observables]]
+    trackers = dict((o, OscillationTracker(batch, **tracker_args)) for o in observables)
+    y = network.initial_state(p)
+    if method == 'ssa':
+        rng = np.random.RandomState(seed)
+        omega = system_size(volume)
+        y = np.round(omega * y)
+    elif method != 'ode':
+        raise ValueError("method must be 'ode' or 'ssa'")
+
+    def feed(tk):
+        for name, row in zip(observables, rows):
+            trackers[name].update(tk, row.dot(y))
+
+    feed(t[0])
+    for k in range(1, len(t)):
+        if method == 'ode':
+            h = (t[k] - t[k - 1]) / substeps
+            for _ in range(substeps):
+                y = batch_step(network, y, p, h)
+        else:
+            y, _ = advance(network, y, p, omega, t[k - 1], t[k], rng)
+        feed(t[k])
+    return trackers
@@ -0,0 +1,221 @@
+"""Cell-population simulation of the G2/M checkpoint.
+
+Every cell runs the G2_M dynamics of one model variant with its own parameter
+values.  Cell state is kept column-wise in preallocated arrays (species x
+cells, parameters x cells) and all cells are advanced together with
+G2_M_network.batch_step, in chunks of batch_size to bound memory.  A cell
+divides when its MPF observable crosses mpf_threshold; the molecules are
+partitioned between the two daughters, which inherit the parameter values of
+their mother.  A cell is re-armed for the next division only after its MPF
+level has dropped below rearm_threshold, so one activation gives one division.
+
+    from G2_M_network import Network, load_variant
+    pop = Population(Network.from_model(load_variant('v1')), 10000, damage=0.005)
+    history = pop.run(4000.0, dt=1.0)
+    print(pop.arrest_fraction(min_age=2000.0))
+"""
+from __future__ import division, print_function
+
+import numpy as np
+
+from G2_M_langevin import system_size
+from G2_M_network import batch_step
+
+
+class Population(object):
+    """Array-backed population of cells running one Network.
+
+    heterogeneity  -- log-normal sigma of the per-cell rate parameters and of
+                      the initial state (the latter makes G2/M entry
+                      asynchronous)
+    vary           -- names of the parameters to randomise (default: all
+                      parameters that are not initial conditions)
+    partition      -- 'beta' splits concentrations with Beta-distributed
+                      volume fractions of coefficient of variation
+                      partition_cv; 'binomial' splits the copy numbers of
+                      a cell of the given volume (litres) binomially at
+                      division, the dynamics stay deterministic
+    reset_species  -- species set to zero in both daughters (default: the
+                      species of the MPF observable, i.e. MPF is destroyed
+                      at mitosis)
+    max_cells      -- when reached, daughters replace randomly chosen cells
+                      (constant-number Monte Carlo); `expansion` keeps the
+                      factor by which the true population outgrew the
+                      sample, including an initial n_cells > max_cells
+    """
+
+    def __init__(self, network, n_cells, damage=None, heterogeneity=0.1,
+                 vary=None, mpf_observable='OBS_MPF', mpf_threshold=0.1,
+                 rearm_threshold=None, partition='beta', partition_cv=0.05,
+                 inheritance_noise=0.0, reset_species=None, max_cells=None,
+                 volume=None, batch_size=4096, seed=None):
+        self.network = network
+        self.rng = np.random.RandomState(seed)
+        self.mpf_row = network.obs_matrix[network.obs_index(mpf_observable)]
+        self.mpf_threshold = mpf_threshold
+        self.rearm_threshold = (mpf_threshold / 2.0 if rearm_threshold is None
+                                else rearm_threshold)
+        if partition not in ('beta', 'binomial'):
+            raise ValueError("partition must be 'beta' or 'binomial'")
+        if partition == 'binomial' and volume is None:
+            raise ValueError("partition='binomial' needs the volume that sets the copy numbers")
+        self.partition = partition
+        self.omega = None if volume is None else system_size(volume)
+        self.partition_cv = partition_cv
+        self.inheritance_noise = inheritance_noise
+        if reset_species is None:
+            reset_species = np.nonzero(self.mpf_row)[0]
+        self.reset_species = np.asarray(reset_species, dtype=int)
+        self.max_cells = max_cells
+        self.batch_size = batch_size
+        self.t = 0.0
+
+        initial_params = set(name for _, name in network.initials)
+        if vary is None:
+            vary = [n for n in network.param_names if n not in initial_params]
+        self.vary = np.array([network.param_index(n) for n in vary], dtype=int)
+
+        capacity = n_cells if max_cells is None else min(n_cells, max_cells)
+        self.expansion = n_cells / capacity
+        self.n = capacity
+        values = {} if damage is None else {'DDS_0': damage}
+        self.p = network.parameter_array(n=capacity, **values)
+        self.p[self.vary] *= self.rng.lognormal(0.0, heterogeneity, (len(self.vary), capacity))
+        self.y = network.initial_state(self.p)
+        self.y *= self.rng.lognormal(0.0, heterogeneity, self.y.shape)
+        self.birth = np.zeros(capacity)
+        self.generation = np.zeros(capacity, dtype=int)
+        self.armed = self.mpf() < self.rearm_threshold
+        self.divisions = []   # (time, cell, age, generation) per division
+
+    # ***State access***
+
+    def mpf(self):
+        return self.mpf_row.dot(self.y[:, :self.n])
+
+    def age(self):
+        return self.t - self.birth[:self.n]
+
+    def arrest_fraction(self, min_age):
+        """Fraction of cells that have not divided for at least min_age."""
+        return np.mean(self.age() >= min_age)
+
+    def observe(self, names=None):
+        return self.network.observe(self.y[:, :self.n], names)
+
+    # ***Dynamics***
+
+    def _grow(self, n_needed):
+        capacity = self.y.shape[1]
+        if n_needed <= capacity:
+            return
+        capacity = max(n_needed, 2 * capacity)
+        if self.max_cells is not None:
+            capacity = min(capacity, self.max_cells)
+        for name in ('y', 'p'):
+            old = getattr(self, name)
+            new = np.zeros((old.shape[0], capacity))
+            new[:, :old.shape[1]] = old
+            setattr(self, name, new)
+        for name in ('birth', 'generation', 'armed'):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def _split(self, y):
+        """Partition species columns y between two daughters."""
+        if self.partition == 'binomial':
+            # molecules of the mother, split one by one; back to concentrations
+            first = self.rng.binomial(np.round(y * self.omega).astype(np.int64), 0.5) / self.omega
+            first = np.minimum(first, y)
+            return first, y - first
+        # Beta(a, a) has mean 1/2 and cv 1/sqrt(2a + 1)
+        a = 0.5 * (1.0 / self.partition_cv ** 2 - 1.0)
+        f = self.rng.beta(a, a, y.shape[1])
+        return 2.0 * f * y, 2.0 * (1.0 - f) * y
+
+    def divide(self, cells):
+        """Divide the given cells; daughters go in place and at the end."""
+        cells = np.asarray(cells, dtype=int)
+        if len(cells) == 0:
+            return
+        for c in cells:
+            self.divisions.append((self.t, c, self.t - self.birth[c], self.generation[c]))
+        first, second = self._split(self.y[:, cells])
+        first[self.reset_species] = 0.0
+        second[self.reset_species] = 0.0
+        p = self.p[:, cells]
+        if self.inheritance_noise > 0:
+            p = p.copy()
+            p[self.vary] *= self.rng.lognormal(0.0, self.inheritance_noise, (len(self.vary), len(cells)))
+
+        self.y[:, cells] = first
+        self.birth[cells] = self.t
+        self.generation[cells] += 1
+        self.armed[cells] = False
+
+        n_new = len(cells)
+        if self.max_cells is not None and self.n + n_new > self.max_cells:
+            free = self.max_cells - self.n
+            self.expansion *= (self.n + n_new) / self.max_cells
+            self._grow(self.max_cells)
+            # replace distinct cells other than the mothers; if over half the
+            # cells divide at once, a random subset of the daughters is kept
+            others = np.setdiff1d(np.arange(self.n), cells)
+            replaced = self.rng.choice(others, min(n_new - free, len(others)), replace=False)
+            slots = np.concatenate([np.arange(self.n, self.max_cells), replaced]).astype(int)
+            if len(slots) < n_new:
+                keep = np.sort(self.rng.choice(n_new, len(slots), replace=False))
+                cells, second, p = cells[keep], second[:, keep], p[:, keep]
+            self.n = self.max_cells
+        else:
+            self._grow(self.n + n_new)
+            slots = np.arange(self.n, self.n + n_new)
+            self.n += n_new
+        self.y[:, slots] = second
+        self.p[:, slots] = p
+        self.birth[slots] = self.t
+        self.generation[slots] = self.generation[cells]
+        self.armed[slots] = False
+
+    def step(self, dt):
+        """Advance every cell by dt, then apply divisions."""
+        for start in range(0, self.n, self.batch_size):
+            cols = slice(start, min(start + self.batch_size, self.n))
+            self.y[:, cols] = batch_step(self.network, self.y[:, cols], self.p[:, cols], dt)
+        self.t += dt
+        mpf = self.mpf()
+        armed = self.armed[:self.n]
+        dividing = np.nonzero(armed & (mpf >= self.mpf_threshold))[0]
+        armed |= mpf < self.rearm_threshold
+        self.divide(dividing)
+
+    def run(self, t_end, dt=1.0, record_every=10, observables=('OBS_MPF', 'OBS_p53')):
+        """Step to t_end and return a summary history of the population."""
+        history = {'time': [], 'cells': [], 'divisions': [], 'mean_age': []}
+        for name in observables:
+            history[name] = []
+        n_steps = int(round((t_end - self.t) / dt))
+        for k in range(n_steps):
+            self.step(dt)
+            if (k + 1) % record_every == 0 or k == n_steps - 1:
+                history['time'].append(self.t)
+                history['cells'].append(self.n * self.expansion)
+                history['divisions'].append(len(self.divisions))
+                history['mean_age'].append(self.age().mean())
+                values = self.observe(list(observables))
+                for name, row in zip(observables, values):
+                    history[name].append(row.mean())
+        return dict((k, np.array(v)) for k, v in history.items())
+
+
+if __name__ == '__main__':
+    from G2_M_network import Network, load_variant
+
+    net = Network.from_model(load_variant('v1'))
+    for damage in [0.0, 0.005]:
+        pop = Population(net, 1000, damage=damage, max_cells=20000, seed=0)
+        pop.run(4000.0, dt=1.0)
+        print("DNA damage = %g: %d divisions, G2 arrest fraction %.3f" % (
+            damage, len(pop.divisions), pop.arrest_fraction(2000.0)))
@@ -0,0 +1,238 @@
+"""Profile likelihood and practical identifiability of G2_M rate constants.
+
+Many G2_M_k* rates are set to round values (1.0, 0.01) and are probably not
+identifiable from MPF/p53 time courses.  For every fitted parameter the
+profile likelihood fixes that parameter on a path away from the optimum and
+re-optimises all the others:
+
+  objective   Gaussian negative log-likelihood of time-course data of
+              observables, parameters on a log10 scale inside bounds,
+              minimised with scipy.optimize.least_squares
+  profiles    both directions of every parameter run as separate tasks on a
+              worker pool (see G2_M_ssa.worker_pool); each step starts its
+              optimisation from the optimum of the previous step, and the
+              step size adapts to the change of the likelihood
+  cache       every accepted step is written to cache_dir, so an interrupted
+              analysis continues where it stopped instead of restarting
+  result      pointwise 95% confidence interval (profile above the optimum
+              by chi2(1)/2 = 1.92) and a verdict per parameter:
+              'identifiable', 'practically non-identifiable' (open on one
+              side) or 'structurally non-identifiable' (flat)
+
+    data = {'t': t_obs, 'OBS_MPF': mpf_obs, 'OBS_p53': p53_obs}
+    obj = Objective(net, data, ['G2_M_k9', 'G2_M_k10', 'G2_M_k31'], sigma={'OBS_MPF': 0.01})
+    result = profile_all(obj, processes=8, cache_dir='profiles/v1')
+    result['G2_M_k10']['status'], result['G2_M_k10']['interval']
+"""
+from __future__ import division, print_function
+
+import hashlib
+import os
+import pickle
+
+import numpy as np
+from scipy.optimize import least_squares
+from scipy.stats import chi2
+
+import G2_M_ssa
+from G2_M_solvers import solve
+
+THRESHOLD = chi2.ppf(0.95, 1) / 2.0
+
+
+class Objective(object):
+    """Negative log-likelihood of time-course data as a function of log10 parameters.
+
+    data    -- {'t': times, observable: values, ...}
+    names   -- fitted parameters
+    bounds  -- {name: (low, high)}, default two decades either side of the
+               model value
+    sigma   -- {observable: standard deviation (scalar or per point)};
+               default 5% of the observable's range in the data
+    fixed   -- overrides applied to all runs (e.g. DDS_0)
+    """
+
+    def __init__(self, network, data, names, bounds=None, sigma=None, fixed=None,
+                 rtol=1e-6, atol=1e-10):
+        self.network = network
+        self.names = list(names)
+        self.rows = [network.param_index(n) for n in self.names]
+        self.t = np.asarray(data['t'], dtype=float)
+        self.observables = sorted(k for k in data if k != 't')
+        self.values = np.array([np.asarray(data[k], dtype=float) for k in self.observables])
+        sigma = sigma or {}
+        self.sigma = np.array([np.broadcast_to(
+            np.asarray(sigma.get(k, 0.05 * (np.ptp(v) or np.abs(v).max() or 1.0)), dtype=float),
+            v.shape) for k, v in zip(self.observables, self.values)])
+        self.base = network.parameter_array(**(fixed or {}))
+        bounds = bounds or {}
+        center = np.log10(np.maximum(self.base[self.rows], 1e-300))
+        self.lower = np.array([np.log10(bounds[n][0]) if n in bounds else c - 2.0
+                               for n, c in zip(self.names, center)])
+        self.upper = np.array([np.log10(bounds[n][1]) if n in bounds else c + 2.0
+                               for n, c in zip(self.names, center)])
+        self.rtol, self.atol = rtol, atol
+        # solver grid starts at 0 where the initial conditions apply
+        self.grid = self.t if self.t[0] == 0.0 else np.concatenate([[0.0], self.t])
+
+    def __getstate__(self):
+        # workers reattach the network they already hold
+        state = self.__dict__.copy()
+        state['network'] = None
+        return state
+
+    def signature(self):
+        """Digest of the fitting problem, to tell caches apart."""
+        return hashlib.sha1(pickle.dumps((self.names, self.t.tolist(), self.values.tolist(),
+                                          self.sigma.tolist(), self.base.tolist(),
+                                          self.lower.tolist(), self.upper.tolist()), 2)).hexdigest()
+
+    def parameters(self, theta):
+        p = self.base.copy()
+        p[self.rows] = 10.0 ** np.asarray(theta)
+        return p
+
+    def residuals(self, theta):
+        try:
+            y = solve(self.network, self.grid, self.parameters(theta), rtol=self.rtol, atol=self.atol)
+        except (RuntimeError, np.linalg.LinAlgError):
+            return np.full(self.values.size, 1e3)
+        y = y[len(self.grid) - len(self.t):]
+        model = self.network.projection(self.observables)(y.T)
+        return ((model - self.values) / self.sigma).ravel()
+
+    def nll(self, theta):
+        r = self.residuals(theta)
+        return 0.5 * float(r.dot(r))
+
+
+def fit(objective, theta0, fixed=None):
+    """Minimise the objective from theta0; fixed is an index held at theta0.
+
+    Returns (theta, nll)."""
+    theta0 = np.clip(np.asarray(theta0, dtype=float), objective.lower, objective.upper)
+    free = np.array([k != fixed for k in range(len(theta0))])
+    if not free.any():
+        return theta0, objective.nll(theta0)
+
+    def residuals(x):
+        theta = theta0.copy()
+        theta[free] = x
+        return objective.residuals(theta)
+
+    res = least_squares(residuals, theta0[free], bounds=(objective.lower[free], objective.upper[free]),
+                        x_scale=1.0, diff_step=1e-4, xtol=1e-8, ftol=1e-8)
+    theta = theta0.copy()
+    theta[free] = res.x
+    return theta, 0.5 * float(res.fun.dot(res.fun))
+
+
+# ***Profiles***
+
+def _load(path):
+    if path is not None and os.path.exists(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    return None
+
+
+def _save(path, value):
+    if path is not None:
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, 2)
+        os.rename(tmp, path)
+
+
+def _profile_branch(args):
+    objective, k, direction, theta_hat, nll_hat, settings, path = args
+    if objective.network is None:
+        objective.network = G2_M_ssa.worker_network()
+    step, min_step, max_step, max_steps, stop = settings
+    points = _load(path) or [(float(theta_hat[k]), nll_hat, np.array(theta_hat))]
+    limit = objective.upper[k] if direction > 0 else objective.lower[k]
+    while len(points) <= max_steps:
+        x, nll, theta = points[-1]
+        if nll - nll_hat > stop or x == limit:
+            break
+        x_new = min(x + step, limit) if direction > 0 else max(x - step, limit)
+        start = theta.copy()
+        start[k] = x_new
+        theta_new, nll_new = fit(objective, start, fixed=k)
+        rise = nll_new - nll
+        if rise > 0.5 * THRESHOLD and step > min_step:
+            step = max(step / 2.0, min_step)
+            continue
+        points.append((float(x_new), nll_new, theta_new))
+        _save(path, points)
+        if rise < 0.1 * THRESHOLD:
+            step = min(step * 2.0, max_step)
+    return k, direction, points
+
+
+def _interval(profile, nll_hat):
+    """Crossing of nll_hat + THRESHOLD on one side, or None if it stays below."""
+    xs = [p[0] for p in profile]
+    dn = [p[1] - nll_hat for p in profile]
+    for i in range(1, len(xs)):
+        if dn[i] >= THRESHOLD:
+            a, b = dn[i - 1], dn[i]
+            return float(xs[i - 1] + (THRESHOLD - a) / (b - a) * (xs[i] - xs[i - 1]) if b > a else xs[i])
+    return None
+
+
+def profile_all(objective, theta0=None, processes=None, cache_dir=None, step=0.1,
+                min_step=0.005, max_step=0.5, max_steps=60, stop=2.0 * THRESHOLD):
+    """Profiles of every fitted parameter, both directions in parallel.
+
+    theta0 (log10) defaults to the model values.  Steps are in log10 units.
+    Returns {name: {'estimate', 'interval', 'status', 'profile'}} with
+    values in linear units and profile = [(log10 value, nll), ...]."""
+    theta0 = np.log10(objective.base[objective.rows]) if theta0 is None else np.asarray(theta0)
+    optimum_path = None
+    if cache_dir is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        optimum_path = os.path.join(cache_dir, 'optimum.pkl')
+    cached = _load(optimum_path)
+    if cached is not None and cached['signature'] != objective.signature():
+        raise ValueError("%s holds profiles of a different problem" % cache_dir)
+    if cached is None:
+        theta_hat, nll_hat = fit(objective, theta0)
+        _save(optimum_path, {'signature': objective.signature(), 'theta': theta_hat, 'nll': nll_hat})
+    else:
+        theta_hat, nll_hat = cached['theta'], cached['nll']
+
+    settings = (step, min_step, max_step, max_steps, stop)
+    tasks = []
+    for k, name in enumerate(objective.names):
+        for direction in (-1, 1):
+            path = None if cache_dir is None else os.path.join(
+                cache_dir, '%s.%s.pkl' % (name, 'down' if direction < 0 else 'up'))
+            tasks.append((objective, k, direction, theta_hat, nll_hat, settings, path))
+    pool = G2_M_ssa.worker_pool(objective.network, processes)
+    try:
+        branches = pool.map(_profile_branch, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    result = {}
+    for k, name in enumerate(objective.names):
+        down = [b[2] for b in branches if b[0] == k and b[1] < 0][0]
+        up = [b[2] for b in branches if b[0] == k and b[1] > 0][0]
+        lo = _interval(down, nll_hat)
+        hi = _interval(up, nll_hat)
+        rise = max(p[1] for p in down + up) - nll_hat
+        if lo is not None and hi is not None:
+            status = 'identifiable'
+        elif rise < 0.01 * THRESHOLD:
+            status = 'structurally non-identifiable'
+        else:
+            status = 'practically non-identifiable'
+        profile = sorted((p[0], p[1]) for p in down[1:] + up)
+        result[name] = {'estimate': float(10.0 ** theta_hat[k]),
+                        'interval': (None if lo is None else 10.0 ** lo,
+                                     None if hi is None else 10.0 ** hi),
+                        'status': status, 'profile': profile}
+    return result
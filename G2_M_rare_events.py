@@ -0,0 +1,128 @@
+"""Weighted-ensemble sampling of rare checkpoint escapes.
+
+Spontaneous MPF activation under DNA damage (DDS_0 > 0), or spurious arrest
+without damage, happens in a tiny fraction of run_ssa trajectories.  The
+weighted ensemble (Huber & Kim) keeps a fixed number of weighted walkers in
+each bin of a progress coordinate, here an observable such as OBS_MPF in copy
+numbers.  After every interval tau the walkers are advanced with the
+G2_M_ssa engine, walkers that reached the target are removed and their
+weight recorded, and each bin is resampled: heavy walkers are split, light
+ones merged with survival probability proportional to weight.  Resampling
+preserves the total weight in every bin, so the escape probabilities and
+first-passage-time distributions are unbiased for any binning; the binning
+only changes the variance.
+
+    result = weighted_ensemble(net, 1.0e-21, t_end=4000.0, tau=20.0,
+                               p=net.parameter_array(DDS_0=0.005), target=50)
+    result['probability']            # P(OBS_MPF >= 50 copies before t_end)
+    histogram(result, bins=40)       # weighted first-passage-time density
+"""
+from __future__ import division, print_function
+
+import numpy as np
+
+from G2_M_langevin import system_size
+from G2_M_ssa import advance, parallel_advance, worker_pool
+
+
+def resample(weights, states, count, rng):
+    """Split/merge the walkers of one bin to `count` walkers of equal total weight.
+
+    states has one column per walker.  Returns (weights, states)."""
+    weights = list(weights)
+    cols = list(range(len(weights)))
+    while len(cols) > count:
+        # merge the two lightest walkers; the survivor is chosen by weight
+        order = np.argsort(weights)
+        i, j = order[0], order[1]
+        total = weights[i] + weights[j]
+        keep, drop = (i, j) if rng.uniform() * total < weights[i] else (j, i)
+        weights[keep] = total
+        del weights[drop]
+        del cols[drop]
+    while len(cols) < count:
+        i = int(np.argmax(weights))
+        weights[i] /= 2.0
+        weights.append(weights[i])
+        cols.append(cols[i])
+    return np.array(weights), states[:, cols]
+
+
+def weighted_ensemble(network, volume, t_end, tau, target, p=None,
+                      progress='OBS_MPF', edges=None, n_bins=10,
+                      walkers_per_bin=20, processes=1, seed=None):
+    """Probability and first-passage times of progress reaching target.
+
+    target       -- level of the progress observable in copy numbers; the
+                    direction (escape upward or collapse downward) follows
+                    from the initial value
+    edges        -- bin edges of the progress coordinate (default: n_bins
+                    equal bins between the initial value and the target)
+    processes    -- worker processes for the SSA propagation (1 = serial)
+
+    Returns {'probability': total weight that reached target by t_end,
+    'times', 'weights': first-passage events, 'survival': (t, S(t)),
+    'walkers': number of live walkers per interval}."""
+    p = network.param_values if p is None else np.asarray(p, dtype=float)
+    rng = np.random.RandomState(seed)
+    omega = system_size(volume)
+    row = network.obs_matrix[network.obs_index(progress)]
+    start = np.round(omega * network.initial_state(p))
+    sign = 1.0 if target >= row.dot(start) else -1.0
+    stop = (sign * row, sign * target)
+    if edges is None:
+        edges = np.linspace(row.dot(start), target, n_bins + 1)[1:-1]
+    edges = np.sort(edges)
+
+    states = np.tile(start[:, None], (1, walkers_per_bin))
+    weights = np.full(walkers_per_bin, 1.0 / walkers_per_bin)
+    times, event_weights = [], []
+    grid, survival, live = [0.0], [1.0], [walkers_per_bin]
+    pool = worker_pool(network, processes) if processes != 1 else None
+    try:
+        t0 = 0.0
+        while t0 < t_end and len(weights):
+            t1 = min(t0 + tau, t_end)
+            pp = np.tile(p[:, None], (1, states.shape[1]))
+            if pool is None:
+                states, crossed = advance(network, states, pp, omega, t0, t1, rng, stop)
+            else:
+                states, crossed = parallel_advance(pool, states, pp, omega, t0, t1, rng, stop)
+            hit = ~np.isnan(crossed)
+            times.extend(crossed[hit])
+            event_weights.extend(weights[hit])
+            states, weights = states[:, ~hit], weights[~hit]
+
+            bins = np.searchsorted(edges, row.dot(states))
+            new_w, new_s = [], []
+            for b in np.unique(bins):
+                mask = bins == b
+                w, s = resample(weights[mask], states[:, mask], walkers_per_bin, rng)
+                new_w.append(w)
+                new_s.append(s)
+            if new_w:
+                weights, states = np.concatenate(new_w), np.hstack(new_s)
+            t0 = t1
+            grid.append(t0)
+            survival.append(weights.sum())
+            live.append(len(weights))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    times = np.array(times)
+    event_weights = np.array(event_weights)
+    order = np.argsort(times)
+    return {'probability': float(event_weights.sum()),
+            'times': times[order], 'weights': event_weights[order],
+            'survival': (np.array(grid), np.array(survival)),
+            'walkers': np.array(live)}
+
+
+def histogram(result, bins=50, t_end=None):
+    """Weighted first-passage-time density (per unit time, not normalised
+    to one: it integrates to the escape probability)."""
+    t_end = result['survival'][0][-1] if t_end is None else t_end
+    density, edges = np.histogram(result['times'], bins=bins, range=(0.0, t_end),
+                                  weights=result['weights'])
+    return density / np.diff(edges), edges
@@ -0,0 +1,296 @@
+"""Time-scale separation and quasi-steady-state reduction of G2_M networks.
+
+The rate constants span eight orders of magnitude (k33 = 1e-8 up to k8 = 100),
+so several species relax orders of magnitude faster than the MPF switch and
+the p53/Mdm2 loop: the 14-3-3 bound Cdc25 pool, phosphorylated Chk1 and the
+ATM/ATR kinase.  reduce() finds those species from the Jacobian along a
+reference trajectory, replaces them by their quasi-steady-state (or rapid
+equilibrium) expressions in the slow species and returns a ReducedModel whose
+network has only the slow species.
+
+By singular perturbation (Tikhonov) the reduced trajectories are within
+O(epsilon) of the full ones after the initial fast transient, where epsilon
+is the ratio of the slowest eliminated to the fastest retained relaxation
+time (ReducedModel.epsilon).  This is an order-of-magnitude a-priori
+estimate, not a rigorous bound: its constant depends on the model.
+validate() is the empirical check: it integrates full and reduced models
+side by side on the caller's parameter sets and reports the worst error
+observed there and the speed-up.
+
+The reduced run starts on the slow manifold: the slow species are chosen so
+that, with the fast species at their quasi-steady values, every conserved
+moiety has the total of the full initial state, so an initial amount of an
+eliminated species (e.g. a preloaded Cdc25 14-3-3 pool) is not lost
+(initial_state()).
+
+    red = reduce(net, t, tau_fast=1.0)
+    print(red.fast_names, red.epsilon)
+    print(validate(red, t, [net.parameter_array(DDS_0=d) for d in (0, 0.005)]))
+"""
+from __future__ import division, print_function
+
+import time
+
+import numpy as np
+import sympy
+
+from G2_M_network import Network, species_symbol
+
+
+def timescales(network, trajectory, p=None):
+    """Slowest relaxation time 1/|J_ii| of every species along a trajectory.
+
+    trajectory is (n_times, n_species).  Species whose rates do not depend on
+    themselves get an infinite timescale."""
+    tau = np.zeros(network.n_species)
+    for y in trajectory:
+        diag = np.abs(np.diagonal(network.jacobian(y, p)))
+        with np.errstate(divide='ignore'):
+            tau = np.maximum(tau, 1.0 / diag)
+    return tau
+
+
+def fast_reactions(network, trajectory, tau_fast, p=None):
+    """Indices of reactions that relax some reactant faster than tau_fast."""
+    fast = set()
+    for y in trajectory:
+        rates = network.rates(y, p)
+        for r, reactants in enumerate(network.reactants):
+            for i in set(reactants):
+                if y[i] > 0 and abs(rates[r] / y[i]) * reactants.count(i) > 1.0 / tau_fast:
+                    fast.add(r)
+    return sorted(fast)
+
+
+class ReducedModel(object):
+    """Slow-species network plus the expressions of the eliminated species.
+
+    network      -- Network over the slow species only
+    full         -- the original Network
+    slow, fast   -- species indices of the original network
+    fast_exprs   -- quasi-steady-state value of each fast species, in terms of
+                    the slow species of the reduced network and parameters
+    tau          -- relaxation time of every species of the full network on
+                    the reference trajectory (see timescales)
+    """
+
+    def __init__(self, full, network, slow, fast, fast_exprs, method, tau=None):
+        self.full = full
+        self.network = network
+        self.slow = list(slow)
+        self.fast = list(fast)
+        self.fast_exprs = list(fast_exprs)
+        self.method = method
+        self.tau = None if tau is None else np.asarray(tau, dtype=float)
+        self._fast_fn = None
+        self._law = None
+
+    @property
+    def fast_names(self):
+        return [self.full.species[i] for i in self.fast]
+
+    @property
+    def epsilon(self):
+        """Slowest eliminated over fastest retained timescale; the reduced
+        model is accurate to O(epsilon) when it is small."""
+        if self.tau is None or not self.fast:
+            return 0.0 if self.tau is not None else None
+        return float(self.tau[self.fast].max() / self.tau[self.slow].min())
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_fast_fn'] = None
+        return state
+
+    def full_state(self, y, p=None):
+        """Reconstruct full species values from reduced states (species first)."""
+        p = self.full.param_values if p is None else p
+        if self._fast_fn is None:
+            self._fast_fn = sympy.lambdify([self.network.y_symbols, self.network.p_symbols],
+                                           self.fast_exprs, modules='numpy')
+        y = np.asarray(y, dtype=float)
+        out = np.zeros((self.full.n_species,) + y.shape[1:])
+        out[self.slow] = y
+        values = self._fast_fn(y, p)
+        for k, i in enumerate(self.fast):
+            out[i] = values[k]
+        return out
+
+    @property
+    def law(self):
+        """Conservation laws of the full network, one row per moiety."""
+        if self._law is None:
+            from G2_M_conservation import conservation_laws
+            self._law = conservation_laws(self.full.stoich)[1]
+        return self._law
+
+    def initial_state(self, p=None):
+        """Slow-species initial state on the slow manifold of the full one.
+
+        The slow species the fast expressions depend on are shifted (by the
+        smallest change, Gauss-Newton) until the full state rebuilt from
+        them has the moiety totals of the full initial state, so mass
+        preloaded into fast species is kept."""
+        p = self.full.param_values if p is None else np.asarray(p, dtype=float)
+        y0 = self.full.initial_state(p)
+        s = y0[self.slow].copy()
+        law = self.law
+        if not self.fast or not len(law):
+            return s
+        # only the slow species the fast ones equilibrate with are shifted
+        used = set().union(*[e.free_symbols for e in self.fast_exprs])
+        free = [k for k, sym in enumerate(self.network.y_symbols) if sym in used]
+        free = np.array(free or range(len(self.slow)))
+        totals = law.dot(y0)
+        for _ in range(50):
+            current = law.dot(self.full_state(s, p))
+            residual = totals - current
+            if np.all(np.abs(residual) <= 1e-12 * np.maximum(np.abs(totals), 1e-12)):
+                break
+            h = 1e-7 * np.maximum(np.abs(s[free]), 1e-6)
+            shifted = np.tile(s[:, None], (1, len(free)))
+            shifted[free, np.arange(len(free))] += h
+            jac = (law.dot(self.full_state(shifted, p)) - current[:, None]) / h
+            s[free] += np.linalg.lstsq(jac, residual, rcond=None)[0]
+        return s
+
+    def odeint(self, t, p=None, **kwargs):
+        """Integrate the reduced model; returns full (len(t), n_species) values."""
+        p = self.full.param_values if p is None else np.asarray(p, dtype=float)
+        y0 = self.initial_state(p)
+        y = self.network.odeint(t, y0=y0, p=p, **kwargs)
+        return self.full_state(y.T, p).T
+
+
+def _solve_fast(eqs, fast_syms, reference):
+    """Closed-form solution of eqs = 0 for fast_syms, or None.
+
+    Among several roots the one closest to the reference values (which come
+    from the full trajectory) and non-negative there is chosen."""
+    try:
+        solutions = sympy.solve(eqs, fast_syms, dict=True)
+    except (NotImplementedError, ValueError):
+        return None
+    best, best_dist = None, np.inf
+    for sol in solutions:
+        if any(s not in sol for s in fast_syms):
+            continue
+        try:
+            values = [complex(sol[s].xreplace(reference[0])) for s in fast_syms]
+        except (TypeError, ValueError):
+            continue
+        if any(abs(v.imag) > 1e-12 or v.real < -1e-12 for v in values):
+            continue
+        dist = sum(abs(v.real - reference[1][s]) for v, s in zip(values, fast_syms))
+        if dist < best_dist:
+            best, best_dist = sol, dist
+    return best
+
+
+def reduce(network, t, tau_fast=1.0, p=None, method='qssa', keep=()):
+    """Eliminate species faster than tau_fast from the network.
+
+    method is 'qssa' (all rates of a fast species balance) or 'equilibrium'
+    (only the fast reactions balance).  Species are added to the fast set from
+    the fastest down, and a species is kept dynamic if adding it leaves the
+    fast subsystem without a usable closed-form solution, e.g. the second
+    member of a conserved Chk1 pair.  Species named in keep (names or
+    indices) are never eliminated."""
+    if method not in ('qssa', 'equilibrium'):
+        raise ValueError("method must be 'qssa' or 'equilibrium'")
+    p = network.param_values if p is None else np.asarray(p, dtype=float)
+    trajectory = network.odeint(t, p=p)
+    tau = timescales(network, trajectory, p)
+    keep = set(int(k) if isinstance(k, (int, np.integer)) else network.species.index(k)
+               for k in keep)
+    candidates = [i for i in np.argsort(tau) if tau[i] < tau_fast and i not in keep]
+
+    if method == 'equilibrium':
+        reactions = fast_reactions(network, trajectory, tau_fast, p)
+    else:
+        reactions = range(network.n_reactions)
+    # reference point for picking roots: end of the trajectory
+    ref_state = trajectory[-1]
+    ref_subs = dict(zip(network.p_symbols, p))
+    ref_fast = dict((network.y_symbols[i], ref_state[i]) for i in range(network.n_species))
+
+    fast, solution = [], {}
+    for i in candidates:
+        trial = fast + [i]
+        syms = [network.y_symbols[k] for k in trial]
+        eqs = [sum(network.stoich[k, r] * network.rate_exprs[r] for r in reactions
+                   if network.stoich[k, r] != 0) for k in trial]
+        if any(e == 0 for e in eqs):
+            continue
+        subs = dict(ref_subs)
+        subs.update((network.y_symbols[k], ref_state[k])
+                    for k in range(network.n_species) if k not in trial)
+        sol = _solve_fast(eqs, syms, (subs, ref_fast))
+        if sol is not None:
+            fast, solution = trial, sol
+
+    slow = [i for i in range(network.n_species) if i not in fast]
+    new_index = dict((old, k) for k, old in enumerate(slow))
+    rename = dict((network.y_symbols[old], species_symbol(k)) for old, k in new_index.items())
+    fast_exprs = [solution[network.y_symbols[i]].xreplace(rename) for i in fast]
+    # one simultaneous xreplace: renamed slow symbols may clash with old fast ones
+    subs = dict(rename)
+    subs.update((network.y_symbols[i], e) for i, e in zip(fast, fast_exprs))
+
+    rate_exprs = [e.xreplace(subs) for e in network.rate_exprs]
+    keep_rxn = [r for r in range(network.n_reactions)
+                if np.any(network.stoich[slow, r] != 0)]
+    observables = [(name, dict((new_index[i], c) for i, c in enumerate(row) if c and i in new_index))
+                   for name, row in zip(network.obs_names, network.obs_matrix)]
+    reduced = Network([network.species[i] for i in slow],
+                      list(zip(network.param_names, p)),
+                      network.stoich[slow][:, keep_rxn],
+                      [[new_index[i] for i in network.reactants[r] if i in new_index]
+                       for r in keep_rxn],
+                      [rate_exprs[r] for r in keep_rxn],
+                      observables,
+                      [(new_index[i], name) for i, name in network.initials if i in new_index],
+                      rules=[network.rules[r] for r in keep_rxn],
+                      name='%s_reduced' % network.name)
+    return ReducedModel(network, reduced, slow, fast, fast_exprs, method, tau)
+
+
+def validate(reduced, t, parameter_sets, observables=None):
+    """Compare reduced and full model on several parameter vectors.
+
+    An empirical check: returns the worst absolute and relative (to the
+    observable's range) error per observable observed over the given
+    parameter sets, the wall-clock speed-up, and the a-priori epsilon of
+    the reduction for comparison.  Nothing is guaranteed between the
+    parameter sets.  'initial_moiety_error' is the largest relative
+    difference between the conserved totals of the reduced and the full
+    initial state; it is round-off unless initial mass was lost."""
+    full = reduced.full
+    names = full.obs_names if observables is None else list(observables)
+    abs_err = dict((n, 0.0) for n in names)
+    rel_err = dict((n, 0.0) for n in names)
+    t_full = t_red = 0.0
+    moiety_err = 0.0
+    law = reduced.law
+    for p in parameter_sets:
+        start = time.time()
+        y_full = full.odeint(t, p=p)
+        t_full += time.time() - start
+        start = time.time()
+        y_red = reduced.odeint(t, p=p)
+        t_red += time.time() - start
+        if len(law):
+            totals = law.dot(y_full[0])
+            lost = np.abs(law.dot(y_red[0]) - totals) / np.maximum(np.abs(totals), 1e-300)
+            moiety_err = max(moiety_err, np.max(lost))
+        o_full = full.observe(y_full.T, names)
+        o_red = full.observe(y_red.T, names)
+        for k, n in enumerate(names):
+            err = np.max(np.abs(o_full[k] - o_red[k]))
+            scale = np.ptp(o_full[k]) or np.max(np.abs(o_full[k])) or 1.0
+            abs_err[n] = max(abs_err[n], err)
+            rel_err[n] = max(rel_err[n], err / scale)
+    return {'abs_error': abs_err, 'rel_error': rel_err,
+            'speedup': t_full / t_red if t_red > 0 else np.inf,
+            'fast_species': reduced.fast_names, 'epsilon': reduced.epsilon,
+            'initial_moiety_error': moiety_err}
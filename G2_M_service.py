@@ -0,0 +1,480 @@
+"""Local simulation service: many clients, one warm pool of compiled models.
+
+A small asyncio server (Python 3) that accepts simulation jobs as
+newline-delimited JSON over TCP and runs them on a bounded
+ProcessPoolExecutor.  Every worker loads its networks once (from
+G2_M_bundle bundles when they exist, otherwise through pysb) and compiles
+the rate and Jacobian functions before the first job arrives, so a request
+costs the integration only.
+
+A job is {'variant', 'params' (overrides), 'damage', 'solver', 't_end',
+'n_points', 'observables', 'segments'}.  damage is a DDS_0 value or a
+schedule [[t, DDS_0], ...] of damage events.  In the models DDS_0 is not a
+rate: it sets the initial Signal() and SignalDamp() amounts and the damping
+rate kdamp_DDS0.  So at every breakpoint where the level changes, DDS_0 is
+set and the species initialised from it are overwritten with the new level,
+the state a run started at that damage would have (damage_state()).  The
+time grid is cut at the schedule breakpoints and into `segments` pieces;
+each piece is one pool task continuing from the previous state, and its
+observables are streamed back as soon as it finishes:
+
+  client -> server   {'op': 'submit', 'id': ..., 'job': {...}}
+                     {'op': 'cancel', 'id': ...}
+                     {'op': 'status'}
+  server -> client   accepted, busy, progress, partial, done, cancelled,
+                     error, status (all carry 'type' and the job 'id')
+
+Backpressure: at most max_queue jobs wait for a worker, further submissions
+are answered 'busy' with a retry hint; results are written with drain(), so
+a slow reader holds back its own jobs rather than filling server memory.
+Cancelling (or disconnecting) stops a job at the next segment boundary;
+a connection can only cancel the jobs it submitted.
+
+    python G2_M_service.py serve v1 OLD     # port 8765
+    python G2_M_service.py demo v1          # server and clients in one process
+
+    client = await ServiceClient.connect(port=8765)
+    await client.submit({'variant': 'v1', 'damage': [[0, 0.0], [500, 0.005]]}, 'a')
+    async for message in client.events('a'):
+        ...
+"""
+from __future__ import division, print_function
+
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import G2_M_bundle
+from G2_M_solvers import solve
+
+DEFAULT_PORT = 8765
+TERMINAL = ('done', 'cancelled', 'error')
+
+# ***Worker side***
+
+_worker_networks = {}
+_bundle_directory = G2_M_bundle.DEFAULT_DIRECTORY
+
+
+def _network(variant):
+    """Network of a variant, loaded and compiled once per process."""
+    if variant not in _worker_networks:
+        path = os.path.join(_bundle_directory, variant + G2_M_bundle.EXTENSION)
+        if os.path.exists(path):
+            network = G2_M_bundle.load(path)
+        else:
+            from G2_M_network import Network, load_variant
+            network = Network.from_model(load_variant(variant))
+        _worker_networks[variant] = _warm(network)
+    return _worker_networks[variant]
+
+
+def _warm(network):
+    """Compile the rate and Jacobian functions before the first job."""
+    y = network.initial_state()
+    network.rhs(y)
+    network.jacobian(y)
+    return network
+
+
+def _init_worker(networks, variants, directory):
+    global _bundle_directory
+    _bundle_directory = directory
+    for name, network in (networks or {}).items():
+        _worker_networks[name] = _warm(network)
+    for variant in variants:
+        _network(variant)
+
+
+def damage_state(network, y, level):
+    """Copy of y with the species initialised from DDS_0 set to level."""
+    y = np.array(y, dtype=float)
+    for i, name in network.initials:
+        if name == 'DDS_0':
+            y[i] = level
+    return y
+
+
+def _segment(args):
+    """Integrate one piece of a job; returns (observables over t, final state).
+
+    y0 is None for the first piece; damaged marks a piece that starts at a
+    change of the damage level."""
+    variant, params, damage, damaged, y0, t, solver, observables = args
+    network = _network(variant)
+    values = dict(params)
+    values['DDS_0'] = damage
+    p = network.parameter_array(**values)
+    if y0 is None:
+        y0 = network.initial_state(p)
+    elif damaged:
+        y0 = damage_state(network, y0, damage)
+    y = solve(network, np.asarray(t), p, y0=y0, **solver)
+    return network.projection(observables)(y.T).T, y[-1]
+
+
+def _ready():
+    return sorted(_worker_networks)
+
+
+def _observable_names(variant):
+    return list(_network(variant).obs_names)
+
+
+# ***Jobs***
+
+def damage_schedule(damage):
+    """[(t, DDS_0), ...] sorted by time, starting at t = 0."""
+    if damage is None:
+        damage = 0.0
+    if np.isscalar(damage):
+        return [(0.0, float(damage))]
+    schedule = sorted((float(t), float(d)) for t, d in damage)
+    if not schedule or schedule[0][0] > 0.0:
+        schedule.insert(0, (0.0, 0.0))
+    return schedule
+
+
+def plan(job):
+    """Cut a job's time grid into [(DDS_0, times), ...] pieces.
+
+    Pieces end at damage breakpoints and at `segments` equal fractions of
+    the run; consecutive pieces share their boundary time."""
+    t_end = float(job.get('t_end', 4000.0))
+    n_points = int(job.get('n_points', 1001))
+    segments = max(int(job.get('segments', 10)), 1)
+    if t_end <= 0 or n_points < 2:
+        raise ValueError("need t_end > 0 and n_points >= 2")
+    schedule = damage_schedule(job.get('damage'))
+    changes = [t for t, _ in schedule[1:] if t < t_end]
+    cuts = np.union1d(np.linspace(0.0, t_end, segments + 1), changes)
+    grid = np.union1d(np.linspace(0.0, t_end, n_points), cuts)
+    starts = np.array([t for t, _ in schedule])
+    pieces = []
+    for a, b in zip(cuts[:-1], cuts[1:]):
+        level = schedule[np.searchsorted(starts, a, side='right') - 1][1]
+        pieces.append((level, grid[(grid >= a) & (grid <= b)]))
+    return pieces
+
+
+class Job(object):
+    """A submitted job and the connection its messages go to."""
+
+    def __init__(self, id, spec, writer):
+        self.id = id
+        self.spec = spec
+        self.writer = writer
+        self.cancelled = False
+        self.future = None
+        self.submitted = time.time()
+
+
+class Busy(RuntimeError):
+    """The service queue is full."""
+
+
+# ***Server***
+
+class SimulationService(object):
+    """asyncio front end over a process pool of warm G2_M networks.
+
+    networks   -- {name: Network} shipped to the workers as they start
+    variants   -- variants the workers load (bundle or pysb) before serving
+    workers    -- pool size; also the number of jobs running at once
+    max_queue  -- jobs allowed to wait for a worker before 'busy'
+    """
+
+    def __init__(self, networks=None, variants=(), workers=None, max_queue=32,
+                 host='127.0.0.1', port=DEFAULT_PORT, directory=G2_M_bundle.DEFAULT_DIRECTORY):
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                                            initargs=(networks, tuple(variants), directory))
+        self.max_queue = max_queue
+        self.host, self.port = host, port
+        self.jobs = {}
+        self.connections = set()
+        self.completed = 0
+        self.server = None
+
+    async def start(self):
+        self.queue = asyncio.Queue(self.max_queue)
+        self.server = await asyncio.start_server(self._connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.dispatchers = [asyncio.ensure_future(self._dispatch()) for _ in range(self.workers)]
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.executor, _ready)
+                               for _ in range(self.workers)])
+        return self
+
+    async def close(self):
+        for task in self.dispatchers:
+            task.cancel()
+        self.server.close()
+        for writer in list(self.connections):
+            writer.close()
+        await self.server.wait_closed()
+        while self.connections:
+            await asyncio.sleep(0.01)
+        self.executor.shutdown(wait=True)
+
+    async def serve_forever(self):
+        await self.start()
+        print("G2_M service on %s:%d with %d workers" % (self.host, self.port, self.workers))
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def _send(self, writer, message):
+        if writer.is_closing():
+            return
+        writer.write((json.dumps(message) + '\n').encode())
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def _connection(self, reader, writer):
+        mine = set()
+        self.connections.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    message = json.loads(line.decode())
+                    op = message['op']
+                except (ValueError, KeyError, TypeError):
+                    await self._send(writer, {'type': 'error', 'id': None, 'error': 'malformed message'})
+                    continue
+                if op == 'submit':
+                    job_id = message.get('id')
+                    if job_id is None or job_id in self.jobs:
+                        await self._send(writer, {'type': 'error', 'id': job_id,
+                                                  'error': 'missing or duplicate job id'})
+                        continue
+                    job = Job(job_id, message.get('job', {}), writer)
+                    try:
+                        self.queue.put_nowait(job)
+                    except asyncio.QueueFull:
+                        await self._send(writer, {'type': 'busy', 'id': job_id,
+                                                  'queued': self.queue.qsize(), 'retry_after': 1.0})
+                        continue
+                    self.jobs[job_id] = job
+                    mine.add(job_id)
+                    await self._send(writer, {'type': 'accepted', 'id': job_id,
+                                              'queued': self.queue.qsize()})
+                elif op == 'cancel':
+                    job_id = message.get('id')
+                    if job_id in self.jobs and job_id not in mine:
+                        await self._send(writer, {'type': 'error', 'id': job_id,
+                                                  'error': 'job was submitted by another connection'})
+                    else:
+                        self.cancel(job_id)
+                elif op == 'status':
+                    await self._send(writer, dict(self.status(), type='status', id=message.get('id')))
+                else:
+                    await self._send(writer, {'type': 'error', 'id': message.get('id'),
+                                              'error': 'unknown op %r' % op})
+        except ConnectionError:
+            pass
+        finally:
+            for job_id in mine:
+                self.cancel(job_id)
+            self.connections.discard(writer)
+            writer.close()
+
+    def cancel(self, job_id):
+        """Stop a job at its next segment boundary (or before it starts)."""
+        job = self.jobs.get(job_id)
+        if job is not None:
+            job.cancelled = True
+            if job.future is not None:
+                job.future.cancel()
+
+    def status(self):
+        return {'workers': self.workers, 'queued': self.queue.qsize(),
+                'max_queue': self.max_queue, 'active': len(self.jobs) - self.queue.qsize(),
+                'completed': self.completed}
+
+    async def _dispatch(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await self._send(job.writer, {'type': 'error', 'id': job.id,
+                                              'error': '%s: %s' % (type(e).__name__, e)})
+            finally:
+                self.jobs.pop(job.id, None)
+                self.completed += 1
+
+    async def _run(self, job):
+        loop = asyncio.get_running_loop()
+        spec = job.spec
+        variant = spec.get('variant', 'v1')
+        params = spec.get('params', {})
+        solver = spec.get('solver', {})
+        pieces = plan(spec)
+        observables = spec.get('observables')
+        if observables is None:
+            observables = await loop.run_in_executor(self.executor, _observable_names, variant)
+        t_end = pieces[-1][1][-1]
+        started = time.time()
+        y = None
+        for k, (level, t) in enumerate(pieces):
+            if job.cancelled:
+                await self._send(job.writer, {'type': 'cancelled', 'id': job.id, 't': float(t[0])})
+                return
+            damaged = k > 0 and level != pieces[k - 1][0]
+            job.future = loop.run_in_executor(
+                self.executor, _segment, (variant, params, level, damaged, y, t, solver,
+                                          observables))
+            try:
+                values, y = await job.future
+            except asyncio.CancelledError:
+                if not job.cancelled:
+                    raise
+                await self._send(job.writer, {'type': 'cancelled', 'id': job.id, 't': float(t[0])})
+                return
+            keep = slice(0 if k == 0 else 1, None)
+            await self._send(job.writer, {
+                'type': 'partial', 'id': job.id, 'segment': k, 'damage': level,
+                't': t[keep].tolist(),
+                'observables': dict((o, values[keep, i].tolist()) for i, o in enumerate(observables))})
+            await self._send(job.writer, {'type': 'progress', 'id': job.id,
+                                          'fraction': float(t[-1] / t_end),
+                                          'elapsed': time.time() - started})
+        await self._send(job.writer, {'type': 'done', 'id': job.id, 'final_state': y.tolist(),
+                                      'elapsed': time.time() - started,
+                                      'waited': started - job.submitted})
+
+
+# ***Client***
+
+class ServiceClient(object):
+    """Connection to a SimulationService; messages are routed per job id."""
+
+    def __init__(self, reader, writer):
+        self.reader, self.writer = reader, writer
+        self.inboxes = {}
+        self.listener = asyncio.ensure_future(self._listen())
+
+    @classmethod
+    async def connect(cls, host='127.0.0.1', port=DEFAULT_PORT):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    def _inbox(self, job_id):
+        if job_id not in self.inboxes:
+            self.inboxes[job_id] = asyncio.Queue()
+        return self.inboxes[job_id]
+
+    async def _listen(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                for inbox in self.inboxes.values():
+                    inbox.put_nowait({'type': 'error', 'error': 'connection closed'})
+                return
+            message = json.loads(line.decode())
+            self._inbox(message.get('id')).put_nowait(message)
+
+    async def _write(self, message):
+        self.writer.write((json.dumps(message) + '\n').encode())
+        await self.writer.drain()
+
+    async def submit(self, job, job_id, retries=0):
+        """Queue a job; retries with the server's hint while it is busy."""
+        inbox = self._inbox(job_id)
+        for attempt in range(retries + 1):
+            await self._write({'op': 'submit', 'id': job_id, 'job': job})
+            reply = await inbox.get()
+            if reply['type'] == 'accepted':
+                return reply
+            if reply['type'] != 'busy':
+                raise RuntimeError(reply.get('error', reply))
+            if attempt < retries:
+                await asyncio.sleep(reply.get('retry_after', 1.0))
+        raise Busy("job %s rejected: %d jobs queued" % (job_id, reply['queued']))
+
+    async def cancel(self, job_id):
+        await self._write({'op': 'cancel', 'id': job_id})
+
+    async def status(self):
+        await self._write({'op': 'status', 'id': '__status__'})
+        return await self._inbox('__status__').get()
+
+    async def events(self, job_id):
+        """Messages of one job up to and including the terminal one."""
+        inbox = self._inbox(job_id)
+        while True:
+            message = await inbox.get()
+            yield message
+            if message['type'] in TERMINAL:
+                del self.inboxes[job_id]
+                return
+
+    async def result(self, job_id, on_progress=None):
+        """Collect a job's partial results into arrays."""
+        t, values, last = [], {}, None
+        async for message in self.events(job_id):
+            if message['type'] == 'partial':
+                t.extend(message['t'])
+                for name, v in message['observables'].items():
+                    values.setdefault(name, []).extend(v)
+            elif message['type'] == 'progress' and on_progress is not None:
+                on_progress(message)
+            last = message
+        out = dict((name, np.array(v)) for name, v in values.items())
+        out.update(t=np.array(t), status=last['type'], message=last)
+        return out
+
+    async def close(self):
+        self.listener.cancel()
+        self.writer.close()
+
+
+# ***Demo***
+
+async def demo(networks=None, variants=('v1',), workers=2):
+    """Serve locally and exercise streaming, concurrency, busy and cancel."""
+    variant = variants[0] if variants else sorted(networks)[0]
+    service = await SimulationService(networks, variants, workers=workers,
+                                      max_queue=4, port=0).start()
+    client = await ServiceClient.connect(port=service.port)
+    try:
+        job = {'variant': variant, 't_end': 2000.0, 'n_points': 201, 'segments': 4,
+               'damage': [[0.0, 0.0], [500.0, 0.005]], 'observables': ['OBS_MPF']}
+        ids = ['job%d' % i for i in range(8)]
+        accepted = []
+        for job_id in ids:
+            try:
+                await client.submit(dict(job, params={}), job_id)
+                accepted.append(job_id)
+            except Busy as e:
+                print("busy:", e)
+        await client.cancel(accepted[-1])
+        results = await asyncio.gather(*[client.result(i) for i in accepted])
+        for job_id, r in zip(accepted, results):
+            mpf = r.get('OBS_MPF', np.zeros(1))
+            print("%-6s %-9s points=%4d  max MPF=%.4g" % (job_id, r['status'], len(r['t']),
+                                                         mpf.max() if len(mpf) else np.nan))
+        print(await client.status())
+    finally:
+        await client.close()
+        await service.close()
+
+
+if __name__ == '__main__':
+    command, names = (sys.argv[1:2] or ['serve'])[0], sys.argv[2:] or ['v1']
+    if command == 'demo':
+        asyncio.run(demo(variants=names))
+    else:
+        asyncio.run(SimulationService(variants=names).serve_forever())
@@ -0,0 +1,219 @@
+"""Stiffness-aware solver selection and tolerance autotuning.
+
+How stiff the G2_M equations are depends on the damage level and the rate
+parameters: the MPF switch and the 14-3-3 binding put eigenvalues near -100,
+while the p53/Mdm2 loop under damage adds weakly damped complex pairs.
+probe() samples the Jacobian spectrum along a cheap trajectory, autotune()
+tries the candidate methods it suggests (explicit Runge-Kutta, BDF, Radau,
+LSODA and a linearly implicit Rosenbrock method) over a ladder of tolerances
+against a tight reference and keeps the fastest configuration that meets the
+requested accuracy.  SolverRegistry stores the chosen configuration per
+scenario so later runs reuse it.
+
+    registry = SolverRegistry('solver_config.json')
+    y = solve_scenario(net, t, net.parameter_array(DDS_0=0.005), 'damage_0.005', registry)
+"""
+from __future__ import division, print_function
+
+import json
+import os
+import time
+
+import numpy as np
+from scipy.integrate import solve_ivp
+from scipy.sparse import identity
+
+from G2_M_sparse import factorize, jacobian_function
+
+EXPLICIT = ('RK45', 'DOP853')
+IMPLICIT = ('BDF', 'Radau', 'LSODA', 'Rosenbrock')
+
+
+class BudgetExceeded(Exception):
+    """Raised when a solver uses more RHS evaluations than allowed."""
+
+
+def probe(network, t, p=None, n_samples=8):
+    """Jacobian spectrum summary along a loose LSODA trajectory."""
+    p = network.param_values if p is None else np.asarray(p, dtype=float)
+    sol = solve_ivp(lambda _t, y: network.rhs(y, p), (t[0], t[-1]),
+                    network.initial_state(p), method='LSODA', rtol=1e-4, atol=1e-10,
+                    t_eval=np.linspace(t[0], t[-1], n_samples))
+    fastest, slowest, oscillation = 0.0, np.inf, 0.0
+    for y in sol.y.T:
+        eig = np.linalg.eigvals(network.jacobian(y, p))
+        # ignore rounding-level eigenvalues (conserved moieties give exact zeros)
+        tiny = 1e-12 * max(np.abs(eig).max(), 1e-300)
+        decay = np.abs(eig.real[eig.real < -tiny])
+        if len(decay):
+            fastest = max(fastest, decay.max())
+            slowest = min(slowest, decay.min())
+        # complex modes that decay slower than they rotate: p53/Mdm2 oscillation
+        rotating = eig[np.abs(eig.imag) > tiny]
+        if len(rotating):
+            oscillation = max(oscillation, np.max(np.abs(rotating.imag) /
+                                                  np.maximum(np.abs(rotating.real), tiny)))
+    span = t[-1] - t[0]
+    return {'fastest_rate': fastest,
+            'slowest_rate': slowest if np.isfinite(slowest) else 0.0,
+            'stiffness_ratio': fastest / slowest if slowest > 0 else np.inf,
+            'stiffness_index': fastest * span,
+            'oscillation': oscillation}
+
+
+def candidate_methods(spectrum):
+    """Methods worth trying for a probed spectrum, most promising first."""
+    if spectrum['stiffness_index'] < 1e3:
+        return ['RK45', 'DOP853', 'LSODA', 'BDF']
+    if spectrum['oscillation'] > 1.0:
+        # BDF above order 2 is not A-stable near the imaginary axis
+        return ['Rosenbrock', 'Radau', 'LSODA', 'BDF']
+    return ['BDF', 'Rosenbrock', 'LSODA', 'Radau']
+
+
+def rosenbrock(network, t, y0, p, rtol=1e-6, atol=1e-10, h0=None, max_rhs=None,
+               jacobian='dense'):
+    """Adaptive two-stage Rosenbrock method (ROS2, L-stable, order 2).
+
+    The embedded first-order solution gives the error estimate; steps are
+    clipped to land on the output times.  jacobian is one of
+    G2_M_sparse.JACOBIANS; the sparse kinds factorise with a sparse LU."""
+    gamma = 1.0 + 1.0 / np.sqrt(2.0)
+    n = network.n_species
+    jac = jacobian_function(network, p, jacobian)
+    eye = identity(n, format='csc') if jacobian != 'dense' else np.eye(n)
+    out = np.zeros((len(t), n))
+    y = np.asarray(y0, dtype=float).copy()
+    out[0] = y
+    tc = t[0]
+    h = h0 or (t[-1] - t[0]) * 1e-6
+    n_rhs = 0
+    for k in range(1, len(t)):
+        while tc < t[k]:
+            h = min(h, t[k] - tc)
+            f0 = network.rhs(y, p)
+            lu = factorize(eye - gamma * h * jac(tc, y))
+            k1 = lu(f0)
+            k2 = lu(network.rhs(y + h * k1, p) - 2.0 * k1)
+            n_rhs += 2
+            if max_rhs is not None and n_rhs > max_rhs:
+                raise BudgetExceeded()
+            y_new = y + 1.5 * h * k1 + 0.5 * h * k2
+            scale = atol + rtol * np.maximum(np.abs(y), np.abs(y_new))
+            err = np.sqrt(np.mean((0.5 * h * (k1 + k2) / scale) ** 2))
+            if err <= 1.0:
+                tc += h
+                y = y_new
+            h *= min(5.0, max(0.2, 0.9 / np.sqrt(max(err, 1e-10))))
+        out[k] = y
+    return out
+
+
+def solve(network, t, p=None, method='LSODA', rtol=1e-6, atol=1e-10, max_rhs=None,
+          jacobian='dense', y0=None):
+    """Integrate with the given method; returns (len(t), n_species) values.
+
+    jacobian selects a dense or sparse analytic Jacobian or coloured finite
+    differences ('dense', 'sparse', 'fd').  BDF and Radau use a sparse LU for
+    the sparse kinds; LSODA only takes dense Jacobians.  y0 defaults to the
+    model's initial state."""
+    p = network.param_values if p is None else np.asarray(p, dtype=float)
+    y0 = network.initial_state(p) if y0 is None else np.asarray(y0, dtype=float)
+    if method == 'Rosenbrock':
+        return rosenbrock(network, t, y0, p, rtol=rtol, atol=atol, max_rhs=max_rhs,
+                          jacobian=jacobian)
+    calls = [0]
+
+    def rhs(_t, y):
+        calls[0] += 1
+        if max_rhs is not None and calls[0] > max_rhs:
+            raise BudgetExceeded()
+        return network.rhs(y, p)
+
+    kwargs = {}
+    if method == 'LSODA' or (method not in EXPLICIT and jacobian == 'dense'):
+        kwargs['jac'] = jacobian_function(network, p, 'dense')
+    elif method not in EXPLICIT:
+        kwargs['jac'] = jacobian_function(network, p, jacobian)
+    sol = solve_ivp(rhs, (t[0], t[-1]), y0, method=method, t_eval=t,
+                    rtol=rtol, atol=atol, **kwargs)
+    if not sol.success:
+        raise RuntimeError("%s failed: %s" % (method, sol.message))
+    return sol.y.T
+
+
+def autotune(network, t, p=None, target=1e-3, observables=None, methods=None,
+             rtols=(1e-3, 1e-4, 1e-5, 1e-6, 1e-7, 1e-8), max_rhs=200000):
+    """Fastest (method, rtol, atol) whose observables stay within target.
+
+    The error is the largest deviation from a Radau rtol=1e-10 reference,
+    relative to each observable's range.  atol is set per species from the
+    reference magnitudes so that species near zero do not force tiny steps.
+    Returns a dict with the configuration, its runtime and error, and the
+    probed spectrum."""
+    p = network.param_values if p is None else np.asarray(p, dtype=float)
+    names = network.obs_names if observables is None else list(observables)
+    spectrum = probe(network, t, p)
+    methods = candidate_methods(spectrum) if methods is None else list(methods)
+
+    reference = solve(network, t, p, method='Radau', rtol=1e-10, atol=1e-14)
+    ref_obs = network.observe(reference.T, names)
+    ref_scale = np.maximum(np.ptp(ref_obs, axis=1), 1e-300)
+    species_scale = np.maximum(np.abs(reference).max(axis=0), 1e-12)
+
+    best, tried = None, []
+    for method in methods:
+        for rtol in rtols:
+            atol = rtol * 1e-3 * species_scale
+            start = time.time()
+            try:
+                y = solve(network, t, p, method, rtol=rtol, atol=atol, max_rhs=max_rhs)
+            except (BudgetExceeded, RuntimeError, np.linalg.LinAlgError):
+                tried.append({'method': method, 'rtol': rtol, 'failed': True})
+                break
+            runtime = time.time() - start
+            obs = network.observe(y.T, names)
+            error = float(np.max(np.abs(obs - ref_obs).max(axis=1) / ref_scale))
+            tried.append({'method': method, 'rtol': rtol, 'runtime': runtime, 'error': error})
+            if error <= target:
+                if best is None or runtime < best['runtime']:
+                    best = {'method': method, 'rtol': rtol, 'atol': atol.tolist(),
+                            'runtime': runtime, 'error': error}
+                break
+    if best is None:
+        raise RuntimeError("No solver configuration met target error %g" % target)
+    best['spectrum'] = spectrum
+    best['tried'] = tried
+    return best
+
+
+class SolverRegistry(object):
+    """Chosen solver configuration per scenario, persisted as JSON."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.configs = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.configs = json.load(f)
+
+    def __contains__(self, scenario):
+        return scenario in self.configs
+
+    def __getitem__(self, scenario):
+        return self.configs[scenario]
+
+    def record(self, scenario, config):
+        self.configs[scenario] = config
+        if self.path is not None:
+            with open(self.path, 'w') as f:
+                json.dump(self.configs, f, indent=1, sort_keys=True)
+
+
+def solve_scenario(network, t, p, scenario, registry, **autotune_args):
+    """Solve with the scenario's recorded configuration, tuning it first if new."""
+    if scenario not in registry:
+        registry.record(scenario, autotune(network, t, p, **autotune_args))
+    config = registry[scenario]
+    return solve(network, t, p, config['method'], rtol=config['rtol'],
+                 atol=np.asarray(config['atol']))
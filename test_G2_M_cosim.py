@@ -0,0 +1,91 @@
+"""Tests of the G2_M_cosim stepping API against an exact birth-death solution."""
+from __future__ import division, print_function
+
+import numpy as np
+import pytest
+import sympy
+
+from G2_M_cosim import CoSimulation
+from G2_M_network import Network, species_symbol
+
+METHODS = ['BDF', 'Radau', 'LSODA']
+
+
+def birth_death():
+    """X is made at k1 and degraded at k2 X."""
+    k1, k2 = sympy.symbols('k1 k2')
+    return Network(['X()'], [('X_0', 0.0), ('k1', 1.0), ('k2', 0.1)],
+                   np.array([[1.0, -1.0]]), [[], [0]], [k1, k2 * species_symbol(0)],
+                   [('OBS_X', {0: 1})], [(0, 'X_0')], rules=['make', 'degrade'], name='bd')
+
+
+def exact(x0, k1, k2, t):
+    return k1 / k2 + (x0 - k1 / k2) * np.exp(-k2 * t)
+
+
+def _sim(method, n_instances=3, **kwargs):
+    return CoSimulation(birth_death(), n_instances, inputs=['k1', 'X()'], method=method,
+                        rtol=1e-9, atol=1e-12, **kwargs)
+
+
+@pytest.mark.parametrize('method', METHODS)
+def test_macro_steps_follow_the_exact_solution(method):
+    sim = _sim(method)
+    for k in range(1, 11):
+        out = sim.do_step(2.5)
+        np.testing.assert_allclose(out['OBS_X'], exact(0.0, 1.0, 0.1, 2.5 * k), rtol=1e-6)
+    assert sim.time == 25.0
+
+
+@pytest.mark.parametrize('method', METHODS)
+def test_parameter_set_takes_effect_at_the_current_time(method):
+    sim = _sim(method)
+    for _ in range(4):
+        sim.do_step(5.0)
+    x20 = exact(0.0, 1.0, 0.1, 20.0)
+    sim.set('k1', [2.0, 3.0, 4.0])
+    for _ in range(4):
+        out = sim.do_step(5.0)
+    np.testing.assert_allclose(out['OBS_X'], exact(x20, np.array([2.0, 3.0, 4.0]), 0.1, 20.0),
+                               rtol=1e-6)
+
+
+@pytest.mark.parametrize('method', METHODS)
+def test_species_set_overwrites_the_state(method):
+    sim = _sim(method)
+    sim.do_step(10.0)
+    sim.set('X()', 20.0)
+    out = sim.do_step(10.0)
+    np.testing.assert_allclose(out['OBS_X'], exact(20.0, 1.0, 0.1, 10.0), rtol=1e-6)
+
+
+def test_unchanged_set_keeps_the_solver():
+    sim = _sim('BDF')
+    sim.do_step(10.0)
+    solver = sim._solver
+    sim.set('k1', 1.0)
+    sim.set('X()', sim.y[0].copy())
+    assert sim._solver is solver
+    sim.set('k1', 2.0)
+    assert sim._solver is None
+    sim.do_step(1.0)
+    assert sim._solver.t > 10.0
+
+
+def test_snapshot_and_restore_repeat_a_step():
+    sim = _sim('BDF')
+    sim.do_step(10.0)
+    snapshot = sim.snapshot()
+    first = sim.do_step(10.0)['OBS_X']
+    sim.restore(snapshot)
+    assert sim.time == 10.0
+    # the restored run restarts the solver, so it agrees to the tolerance
+    np.testing.assert_allclose(sim.do_step(10.0)['OBS_X'], first, rtol=1e-6)
+
+
+def test_parameter_columns_must_match_the_instances():
+    network = birth_death()
+    with pytest.raises(ValueError):
+        CoSimulation(network, 3, p=network.parameter_array(2))
+    sim = CoSimulation(network, 2, p=network.parameter_array(2, k1=2.0), outputs=['X()'])
+    np.testing.assert_allclose(sim.do_step(10.0)['X()'], exact(0.0, 2.0, 0.1, 10.0), rtol=1e-4)
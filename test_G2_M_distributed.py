@@ -0,0 +1,173 @@
+"""Local tests of G2_M_distributed: a FileBroker in a temporary directory."""
+from __future__ import division, print_function
+
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+import sympy
+
+import G2_M_bundle
+from G2_M_distributed import (Broker, FileBroker, Worker, distribute, gather, ssa_ensemble,
+                              ssa_task, start_local_workers)
+from G2_M_network import Network, species_symbol
+
+SQUARE = 'test_G2_M_distributed:square'
+
+
+def square(x):
+    return x * x
+
+
+def slow_square(x):
+    time.sleep(0.01)
+    return x * x
+
+
+def flaky(marker, x):
+    """Fails the first time it sees marker, then succeeds."""
+    if not os.path.exists(marker):
+        open(marker, 'w').close()
+        raise ValueError("first attempt")
+    return x
+
+
+def broken(x):
+    raise ValueError("always")
+
+
+def _drain(broker, **kwargs):
+    return Worker(broker, poll=0.01, **kwargs).run(idle_timeout=0.1)
+
+
+def test_broker_is_abstract():
+    with pytest.raises(TypeError):
+        Broker()
+
+
+def test_claim_and_complete(tmp_path):
+    broker = FileBroker(str(tmp_path))
+    job = broker.submit(SQUARE, [(k,) for k in range(5)])
+    claimed = broker.claim('w', lambda function: 3)
+    assert [function for _, function, _ in claimed] == [SQUARE] * 3
+    for item, _, (x,) in claimed:
+        broker.complete('w', item, x * x)
+    # a second result for an item is dropped
+    broker.complete('w', claimed[0][0], -1)
+    assert broker.progress(job) == {'total': 5, 'done': 3, 'failed': 0}
+    assert _drain(broker) == 2
+    assert gather(broker, job) == [0, 1, 4, 9, 16]
+
+
+def test_claim_takes_one_function(tmp_path):
+    broker = FileBroker(str(tmp_path))
+    broker.submit(SQUARE, [(1,), (2,)], job='a')
+    broker.submit('test_G2_M_distributed:slow_square', [(3,)], job='b')
+    assert [f for _, f, _ in broker.claim('w', lambda function: 10)] == [SQUARE] * 2
+
+
+def test_failed_item_is_retried(tmp_path):
+    broker = FileBroker(str(tmp_path / 'queue'))
+    marker = str(tmp_path / 'marker')
+    job = broker.submit('test_G2_M_distributed:flaky', [(marker, 7)])
+    _drain(broker)
+    assert gather(broker, job) == [7]
+
+
+def test_failed_after_max_attempts(tmp_path):
+    broker = FileBroker(str(tmp_path), max_attempts=2)
+    job = broker.submit('test_G2_M_distributed:broken', [(1,), (2,)])
+    _drain(broker)
+    assert broker.progress(job) == {'total': 2, 'done': 0, 'failed': 2}
+    with pytest.raises(RuntimeError, match='always'):
+        gather(broker, job)
+
+
+def test_stale_items_are_requeued(tmp_path):
+    broker = FileBroker(str(tmp_path), stale_after=0.2)
+    job = broker.submit(SQUARE, [(k,) for k in range(4)])
+    broker.heartbeat('dead')
+    assert len(broker.claim('dead', lambda function: 4)) == 4
+    assert broker.requeue_stale() == 0
+    time.sleep(0.3)
+    assert broker.requeue_stale() == 4
+    assert _drain(broker) == 4
+    assert gather(broker, job) == [0, 1, 4, 9]
+
+
+def test_late_result_replaces_the_failure(tmp_path):
+    broker = FileBroker(str(tmp_path), max_attempts=1, stale_after=0.0)
+    job = broker.submit(SQUARE, [(3,)])
+    [(item, _, _)] = broker.claim('slow', lambda function: 1)
+    assert broker.requeue_stale() == 1
+    assert broker.progress(job) == {'total': 1, 'done': 0, 'failed': 1}
+    broker.complete('slow', item, 9)
+    assert broker.progress(job) == {'total': 1, 'done': 1, 'failed': 0}
+    assert gather(broker, job) == [9]
+
+
+def test_chunk_size_adapts_to_item_cost(tmp_path):
+    broker = FileBroker(str(tmp_path))
+    function = 'test_G2_M_distributed:slow_square'
+    job = broker.submit(function, [(k,) for k in range(30)])
+    worker = Worker(broker, target_seconds=0.05, poll=0.01)
+    assert worker.chunk_size(function) == 1
+    sizes = []
+    size = worker.chunk_size
+
+    def recording(f):
+        sizes.append(size(f))
+        return sizes[-1]
+
+    worker.chunk_size = recording
+    worker.run(idle_timeout=0.1)
+    assert gather(broker, job) == [k * k for k in range(30)]
+    assert sizes[0] == 1
+    assert 2 <= max(sizes) <= 5
+
+
+def test_local_workers_share_a_job(tmp_path):
+    broker = FileBroker(str(tmp_path))
+    threads = [threading.Thread(target=_drain, args=(broker,), kwargs={'name': 'w%d' % k})
+               for k in range(2)]
+    job = broker.submit('test_G2_M_distributed:slow_square', [(k,) for k in range(40)])
+    for t in threads:
+        t.start()
+    assert gather(broker, job, timeout=30, poll=0.05) == [k * k for k in range(40)]
+    for t in threads:
+        t.join()
+
+
+def test_local_worker_processes(tmp_path):
+    workers = start_local_workers(str(tmp_path), 2, idle_timeout=1.0, poll=0.05)
+    results = distribute(FileBroker(str(tmp_path)), SQUARE, [(k,) for k in range(20)],
+                         timeout=60, poll=0.05)
+    assert results == [k * k for k in range(20)]
+    for w in workers:
+        w.join(10)
+
+
+def test_ssa_ensemble_sends_moments(tmp_path):
+    k1, k2 = sympy.symbols('k1 k2')
+    network = Network(['X()'], [('X_0', 0.0), ('k1', 1.0), ('k2', 0.1)],
+                      np.array([[1.0, -1.0]]), [[], [0]], [k1, k2 * species_symbol(0)],
+                      [('OBS_X', {0: 1})], [(0, 'X_0')], rules=['make', 'degrade'], name='bd')
+    bundle = str(tmp_path / ('bd' + G2_M_bundle.EXTENSION))
+    G2_M_bundle.bundle_network(network, bundle)
+    broker = FileBroker(str(tmp_path / 'queue'))
+    # one molecule per concentration unit
+    volume = 1.0 / 6.02214076e23
+    worker = Worker(broker, poll=0.01)
+    threading.Thread(target=worker.run, kwargs={'idle_timeout': 2.0}).start()
+    out = ssa_ensemble(broker, bundle, [0.0, 5.0, 50.0], volume, 250, cells_per_item=100,
+                       keep_paths=True, poll=0.05, timeout=60)
+    x = out['OBS_X']
+    assert x['paths'].shape == (3, 250)
+    np.testing.assert_allclose(x['mean'], x['paths'].mean(axis=1), rtol=1e-6)
+    np.testing.assert_allclose(x['var'], x['paths'].var(axis=1, ddof=1), rtol=1e-6, atol=1e-9)
+    # Poisson with mean 10 (1 - exp(-t / 10)) at every time
+    assert abs(x['mean'][-1] - 10.0 * (1 - np.exp(-5.0))) < 1.0
+    item = ssa_task(bundle, [0.0, 50.0], volume, {}, 20, 0, None)
+    assert sorted(item['OBS_X']) == ['n', 'sum', 'sumsq']
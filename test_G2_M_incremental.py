@@ -0,0 +1,67 @@
+"""Tests of G2_M_incremental: updates must match a full build."""
+from __future__ import division, print_function
+
+import numpy as np
+import sympy
+
+from G2_M_incremental import NetworkBuilder
+from G2_M_network_free import RuleModel
+
+S = sympy.Symbol
+
+
+def P(monomer, **conditions):
+    return (monomer, tuple(sorted(conditions.items())))
+
+
+MPFi = (P('MPF', b=None, state='i'),)
+MPFa = (P('MPF', b=None, state='a'),)
+P21 = (P('p21', b=None),)
+COMPLEX = (P('MPF', b=1, state='a'), P('p21', b=1))
+
+PARAMETERS = [('k9', 5e-4), ('k10', 0.1), ('k11', 0.1), ('km11', 1.0), ('k14', 0.01),
+              ('k13', 1.0), ('X4_0', 1e-2)]
+RULES = [('Create_preMPF', [], [MPFi], S('k9')),
+         ('Activate_MPF', [MPFi], [MPFa], S('k10')),
+         ('Complex_MPF_p21', [MPFa, P21], [COMPLEX], S('k11')),
+         ('Complex_MPF_p21_reverse', [COMPLEX], [MPFa, P21], S('km11')),
+         ('Create_p21', [], [P21], S('k14')),
+         ('Degrade_p21', [P21], [], S('k13'))]
+
+
+def model(monomers, rules=RULES):
+    return RuleModel(monomers, PARAMETERS, [('OBS_MPF', [(P('MPF', state='a'),)])],
+                     [(MPFi, 'X4_0')], rules, name='sub')
+
+
+def monomers(p21_sites=('b',)):
+    return {'MPF': (['b', 'state'], {'state': ['i', 'a']}), 'p21': (list(p21_sites), {})}
+
+
+def test_rate_edit_keeps_the_species():
+    builder = NetworkBuilder().update(model(monomers()))
+    before = list(builder.network().species)
+    edited = [(n, l, r, 2 * k if n == 'Activate_MPF' else k) for n, l, r, k in RULES]
+    builder.update(model(monomers(), edited))
+    assert builder.stats['rate_only'] == ['Activate_MPF'] and not builder.stats['rebuilt']
+    assert builder.network().species == before
+
+
+def test_added_site_rebuilds_the_species():
+    builder = NetworkBuilder().update(model(monomers()))
+    builder.network()
+    edited = monomers(('b', 'loc'))
+    edited['p21'][1]['loc'] = ['c', 'n']
+    # p21 is now made in the cytoplasm
+    made = (P('p21', b=None, loc='c'),)
+    rules = [(n, l, [made] if n == 'Create_p21' else r, k) for n, l, r, k in RULES]
+    network = builder.update(model(edited, rules)).network()
+    full = NetworkBuilder().update(model(edited, rules)).network()
+    assert builder.stats['rebuilt']
+    assert len(set(network.species)) == len(network.species)
+    assert sorted(network.species) == sorted(full.species)
+    assert not [s for s in network.species if s.startswith('p21(b=None)')]
+    y = np.linspace(0.1, 1.0, len(full.species))
+    by_name = dict(zip(network.species, network.rhs(y[[full.species.index(s)
+                                                       for s in network.species]])))
+    np.testing.assert_allclose([by_name[s] for s in full.species], full.rhs(y))
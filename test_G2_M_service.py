@@ -0,0 +1,170 @@
+"""Local client tests of G2_M_service: streaming, backpressure, cancellation."""
+from __future__ import division, print_function
+
+import asyncio
+
+import numpy as np
+import pytest
+import sympy
+
+from G2_M_network import Network, species_symbol
+from G2_M_service import Busy, ServiceClient, SimulationService
+
+
+def birth_death():
+    """X is made at k1 (1 + DDS_0) and degraded at k2 X."""
+    dds, k1, k2 = sympy.symbols('DDS_0 k1 k2')
+    return Network(['X()'], [('X_0', 0.0), ('DDS_0', 0.0), ('k1', 1.0), ('k2', 0.1)],
+                   np.array([[1.0, -1.0]]), [[], [0]],
+                   [k1 * (1 + dds), k2 * species_symbol(0)],
+                   [('OBS_X', {0: 1})], [(0, 'X_0')], rules=['make', 'degrade'], name='bd')
+
+
+def signal_network():
+    """DDS_0 only sets the initial Signal(), which decays at ks and makes X at k1."""
+    ks, k1, k2 = sympy.symbols('ks k1 k2')
+    signal, x = species_symbol(0), species_symbol(1)
+    return Network(['Signal()', 'X()'],
+                   [('DDS_0', 0.0), ('X_0', 0.0), ('ks', 0.1), ('k1', 1.0), ('k2', 0.1)],
+                   np.array([[-1.0, 0.0, 0.0], [0.0, 1.0, -1.0]]), [[0], [0], [1]],
+                   [ks * signal, k1 * signal, k2 * x],
+                   [('OBS_S', {0: 1}), ('OBS_X', {1: 1})], [(0, 'DDS_0'), (1, 'X_0')],
+                   rules=['decay', 'make', 'degrade'], name='signal')
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def _service(workers=1, max_queue=4):
+    return await SimulationService({'bd': birth_death(), 'signal': signal_network()},
+                                   workers=workers,
+                                   max_queue=max_queue, port=0).start()
+
+
+JOB = {'variant': 'bd', 't_end': 100.0, 'n_points': 101, 'observables': ['OBS_X']}
+
+
+def test_partial_results_stream_in_order():
+    async def scenario():
+        service = await _service()
+        client = await ServiceClient.connect(port=service.port)
+        try:
+            await client.submit(dict(JOB, segments=5, damage=[[0.0, 0.0], [50.0, 1.0]]), 'a')
+            return [m async for m in client.events('a')]
+        finally:
+            await client.close()
+            await service.close()
+
+    messages = run(scenario())
+    partial = [m for m in messages if m['type'] == 'partial']
+    progress = [m['fraction'] for m in messages if m['type'] == 'progress']
+    assert messages[-1]['type'] == 'done'
+    assert [m['segment'] for m in partial] == list(range(len(partial)))
+    t = np.concatenate([m['t'] for m in partial])
+    assert np.all(np.diff(t) > 0) and t[0] == 0.0 and t[-1] == 100.0
+    assert progress == sorted(progress) and progress[-1] == 1.0
+    assert [m['damage'] for m in partial] == [0.0] * 3 + [1.0] * 3
+    x = np.concatenate([m['observables']['OBS_X'] for m in partial])
+    assert len(x) == len(t)
+    assert x[t == 50.0][0] == pytest.approx(10.0 * (1.0 - np.exp(-5.0)), rel=1e-4)
+
+
+def test_damage_event_sets_the_signal():
+    async def scenario():
+        service = await _service()
+        client = await ServiceClient.connect(port=service.port)
+        try:
+            await client.submit({'variant': 'signal', 't_end': 100.0, 'n_points': 101,
+                                 'segments': 2, 'damage': [[0.0, 0.0], [50.0, 1.0]],
+                                 'observables': ['OBS_S', 'OBS_X']}, 'a')
+            return await client.result('a')
+        finally:
+            await client.close()
+            await service.close()
+
+    r = run(scenario())
+    assert r['status'] == 'done'
+    t, s, x = r['t'], r['OBS_S'], r['OBS_X']
+    assert np.all(s[t < 50.0] == 0.0) and np.all(x[t < 50.0] == 0.0)
+    assert s[t == 51.0][0] == pytest.approx(np.exp(-0.1), rel=1e-4)
+    assert s[-1] == pytest.approx(np.exp(-5.0), rel=1e-4)
+    # X' = exp(-0.1 (t - 50)) - 0.1 X after the event
+    assert x[-1] == pytest.approx(50.0 * np.exp(-5.0), rel=1e-4)
+
+
+def test_busy_once_the_queue_is_full():
+    async def scenario():
+        service = await _service(workers=1, max_queue=2)
+        client = await ServiceClient.connect(port=service.port)
+        accepted, busy = [], []
+        try:
+            slow = dict(JOB, t_end=1000.0, n_points=1001, segments=200)
+            for k in range(6):
+                try:
+                    await client.submit(slow, 'job%d' % k)
+                    accepted.append(k)
+                except Busy:
+                    busy.append(k)
+            for k in accepted:
+                await client.cancel('job%d' % k)
+            for k in accepted:
+                [m async for m in client.events('job%d' % k)]
+            return accepted, busy
+        finally:
+            await client.close()
+            await service.close()
+
+    accepted, busy = run(scenario())
+    # one job runs and max_queue wait; the rest are rejected
+    assert accepted[:2] == [0, 1]
+    assert len(accepted) <= 3
+    assert busy and busy == list(range(len(accepted), 6))
+
+
+def test_cancelled_job_ends_cancelled():
+    async def scenario():
+        service = await _service()
+        client = await ServiceClient.connect(port=service.port)
+        try:
+            await client.submit(dict(JOB, t_end=1000.0, n_points=1001, segments=200), 'long')
+            messages = []
+            async for m in client.events('long'):
+                messages.append(m)
+                if m['type'] == 'partial' and m['segment'] == 0:
+                    await client.cancel('long')
+            return messages
+        finally:
+            await client.close()
+            await service.close()
+
+    messages = run(scenario())
+    assert messages[-1]['type'] == 'cancelled'
+    assert len([m for m in messages if m['type'] == 'partial']) < 200
+
+
+def test_only_the_submitting_connection_can_cancel():
+    async def scenario():
+        service = await _service()
+        owner = await ServiceClient.connect(port=service.port)
+        other = await ServiceClient.connect(port=service.port)
+        try:
+            await owner.submit(dict(JOB, t_end=1000.0, n_points=1001, segments=200), 'mine')
+            await other.cancel('mine')
+            refusal = [m async for m in other.events('mine')]
+            messages = []
+            async for m in owner.events('mine'):
+                messages.append(m)
+                if m['type'] == 'partial' and len(messages) > 4:
+                    await owner.cancel('mine')
+            return refusal, messages
+        finally:
+            await owner.close()
+            await other.close()
+            await service.close()
+
+    refusal, messages = run(scenario())
+    assert [m['type'] for m in refusal] == ['error']
+    # the job kept running after the refusal until its owner cancelled it
+    assert len([m for m in messages if m['type'] == 'partial']) >= 3
+    assert messages[-1]['type'] == 'cancelled'